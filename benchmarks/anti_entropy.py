@@ -0,0 +1,79 @@
+# Simulates a partition between two catalog replicas and measures how the anti-entropy process converges
+# Replica B is stopped while replica A receives updates, then B is restarted
+# Reports the time until both replicas hold the same books, and the bytes exchanged by the synchronization
+#
+# Usage: python benchmarks/anti_entropy.py [--books 10000] [--updates 200] [--interval 0.2] [--buckets 256]
+
+from support import start_catalog, free_port, seed_books, StandIn
+import argparse
+import json
+import os
+import random
+import requests
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.2)
+    parser.add_argument('--buckets', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    ports = [free_port(), free_port()]
+    files = [os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite') for _ in ports]
+
+    def start(index):
+        return start_catalog(port=ports[index], DATABASE_FILE=files[index], FRONT_END_ADDRESS=front_end,
+                             CATALOG_ADDRESSES=f'http://127.0.0.1:{ports[1 - index]}',
+                             ANTI_ENTROPY_INTERVAL=args.interval, ANTI_ENTROPY_BUCKETS=args.buckets)
+
+    # Create both databases, then add the same books to both of them
+    processes = [start(0)[0], start(1)[0]]
+    for process in processes:
+        process.terminate()
+        process.wait()
+    for file in files:
+        seed_books(file, args.books)
+
+    (process_a, a), (process_b, b) = start(0), start(1)
+    try:
+        # Partition: B is down while A receives updates
+        process_b.terminate()
+        process_b.wait()
+        ids = [1000 + random.randrange(args.books) for _ in range(args.updates)]
+        for id in ids:
+            requests.put(f'{a}/update/{id}', json={'price': round(random.uniform(5, 50), 2)}).raise_for_status()
+
+        # Heal the partition and wait until both replicas hold the same books
+        start_time = time.monotonic()
+        process_b, b = start(1)
+        expected = requests.get(f'{a}/dump/').json()
+        while requests.get(f'{b}/dump/').json() != expected:
+            if time.monotonic() - start_time > args.timeout:
+                raise TimeoutError('Replicas did not converge')
+            time.sleep(0.05)
+        convergence = time.monotonic() - start_time
+
+        stats = requests.get(f'{b}/stats/anti-entropy').json()
+        print(json.dumps({
+            'books': args.books,
+            'buckets': args.buckets,
+            'updated_books': len(set(ids)),
+            'convergence_seconds': round(convergence, 3),
+            'rows_pulled': stats['rows_pulled'],
+            'divergent_buckets': stats['divergent_buckets'],
+            'bytes_received': stats['bytes_received'],
+            'bytes_of_full_dump': len(requests.get(f'{a}/dump/').content),
+        }))
+    finally:
+        process_a.terminate()
+        process_b.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Measures how long a new catalog replica takes to hold the same books as an existing replica with N books
+#   snapshot:     the new replica copies a snapshot of the existing one before it starts serving,
+#                 then catches up with the replication log (the current default)
+#   anti-entropy: the new replica starts with the initial books, and pulls the different books in the background
+# Books of the existing replica are updated while the new one starts, so the new one has to catch up with them
+#
+# Usage: python benchmarks/bootstrap.py [--books 1000000] [--updates 100] [--modes snapshot anti-entropy]
+#                                       [--deadline 600]
+
+from support import start_catalog, free_port, seed_books, StandIn
+import argparse
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+
+
+def run(mode, books, updates, deadline, front_end):
+    file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+    process, _ = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end)
+    process.terminate()
+    process.wait()
+    seed_books(file, books)
+    source_process, source = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end)
+
+    port = free_port()
+    environment = {'CATALOG_ADDRESSES': source, 'REPLICATION_LOG_INTERVAL': 0.5}
+    if mode == 'anti-entropy':
+        environment.update({'SNAPSHOT_BOOTSTRAP': '0', 'ANTI_ENTROPY_INTERVAL': 1})
+
+    # Update books of the existing replica while the new one starts
+    def update():
+        with requests.Session() as session:
+            for i in range(updates):
+                session.put(f'{source}/update/{1000 + i * (books // updates)}', json={'price': 20.0})
+
+    process = None
+    try:
+        updater = threading.Thread(target=update)
+        updater.start()
+        start = time.monotonic()
+        process, address = start_catalog(port=port, FRONT_END_ADDRESS=front_end, timeout=deadline, **environment)
+        serving_seconds = time.monotonic() - start
+        updater.join()
+
+        # Both replicas hold the same books when their digests are the same
+        # (the existing replica may run out of memory serving the books of the anti-entropy process)
+        converged_seconds = None
+        expected = requests.get(f'{source}/rep/digest').json()
+        snapshot_bytes = requests.get(f'{source}/stats/snapshot').json()['bytes_sent']
+        while time.monotonic() - start < deadline and source_process.poll() is None:
+            try:
+                if requests.get(f'{address}/rep/digest').json() == expected:
+                    converged_seconds = round(time.monotonic() - start, 3)
+                    break
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+
+        return {'mode': mode, 'books': books, 'updates': updates, 'serving_seconds': round(serving_seconds, 3),
+                'converged_seconds': converged_seconds, 'snapshot_bytes': snapshot_bytes,
+                'source_crashed': source_process.poll() is not None}
+    finally:
+        source_process.terminate()
+        source_process.wait()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=1000000)
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--modes', nargs='+', default=['snapshot', 'anti-entropy'])
+    parser.add_argument('--deadline', type=float, default=600)
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    for mode in args.modes:
+        print(json.dumps(run(mode, args.books, args.updates, args.deadline, front_end)))
+
+
+if __name__ == '__main__':
+    main()
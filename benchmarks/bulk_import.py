@@ -0,0 +1,92 @@
+# Measures loading N books into a catalog server, and seeding a replica with them
+#   orm:      one ORM object added to the session per book (like database_init), committed every --batch books
+#   batched:  the /import endpoint, Core inserts in transactions of --batch books
+#   deferred: the /import endpoint, with the search index rebuilt once at the end
+# For the endpoint modes, a second replica pulls the books from the replication log of the first one,
+# and the time until it applied all of them is reported
+#
+# Usage: python benchmarks/bulk_import.py [--books 100000] [--batch 10000]
+
+from support import load_catalog, start_catalog, free_port, StandIn
+import argparse
+import csv
+import json
+import os
+import requests
+import tempfile
+import time
+
+
+def write_csv(books):
+    path = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'books.csv')
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['title', 'topic', 'quantity', 'price'])
+        for i in range(books):
+            writer.writerow([f'Book {i}', f'Topic {i % 100}', 100, 10.0])
+    return path
+
+
+# Add the books one ORM object at a time, in the benchmark process
+def run_orm(books, batch):
+    load_catalog()
+    from book import Book
+    from database import db
+
+    start = time.monotonic()
+    for i in range(books):
+        db.session.add(Book(f'Book {i}', f'Topic {i % 100}', 100, 10.0))
+        if (i + 1) % batch == 0:
+            db.session.commit()
+    db.session.commit()
+    seconds = time.monotonic() - start
+    return {'mode': 'orm', 'books': books, 'seconds': round(seconds, 3), 'rows_per_second': round(books / seconds, 1)}
+
+
+def run_endpoint(mode, path, books, batch, front_end):
+    ports = [free_port(), free_port()]
+
+    def start(index):
+        return start_catalog(port=ports[index], FRONT_END_ADDRESS=front_end, IMPORT_BATCH=batch,
+                             CATALOG_ADDRESSES=f'http://127.0.0.1:{ports[1 - index]}')
+
+    (process_a, a), (process_b, b) = start(0), start(1)
+    try:
+        with open(path, 'rb') as file:
+            response = requests.post(f'{a}/import', data=file, headers={'Content-Type': 'text/csv'},
+                                     params={'defer_indexes': int(mode == 'deferred')})
+        response.raise_for_status()
+        result = response.json()
+
+        # The replica was asked to catch up when the import ended
+        start_time = time.monotonic()
+        while requests.get(f'{b}/stats/replication-log').json()['records_applied'] < books:
+            time.sleep(0.05)
+
+        return {'mode': mode, 'books': result['imported'], 'seconds': round(result['seconds'], 3),
+                'rows_per_second': result['rows_per_second'],
+                'replica_seconds': round(time.monotonic() - start_time, 3)}
+    finally:
+        process_a.terminate()
+        process_b.terminate()
+        process_a.wait()
+        process_b.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=10000)
+    args = parser.parse_args()
+
+    path = write_csv(args.books)
+    front_end = StandIn().address
+    for mode in ['batched', 'deferred']:
+        print(json.dumps(run_endpoint(mode, path, args.books, args.batch, front_end)))
+
+    # The catalog is loaded in this process last, so that its threads do not slow down the other modes
+    print(json.dumps(run_orm(args.books, args.batch)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Measures how long a restarted catalog replica takes to catch up with N updates it missed
+# Compares streaming the replication log of the other replica with the lazy repair of books on read
+#
+# Usage: python benchmarks/catch_up.py [--books 10000] [--updates 100 1000]
+
+from support import start_catalog, free_port, seed_books, StandIn
+import argparse
+import json
+import os
+import requests
+import tempfile
+import time
+
+
+def run(updates, books, mode, front_end):
+    ports = [free_port(), free_port()]
+    files = [os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite') for _ in ports]
+
+    def start(index):
+        return start_catalog(port=ports[index], DATABASE_FILE=files[index], FRONT_END_ADDRESS=front_end,
+                             CATALOG_ADDRESSES=f'http://127.0.0.1:{ports[1 - index]}',
+                             REPLICATION_CATCH_UP='1' if mode == 'log' else '0')
+
+    # Create both databases, then add the same books to both of them
+    for index in range(2):
+        process = start(index)[0]
+        process.terminate()
+        process.wait()
+    for file in files:
+        seed_books(file, books)
+
+    (process_a, a), (process_b, b) = start(0), start(1)
+    try:
+        # B is down while A receives updates of different books
+        process_b.terminate()
+        process_b.wait()
+        ids = [1000 + i for i in range(updates)]
+        session = requests.Session()
+        for id in ids:
+            session.put(f'{a}/update/{id}', json={'price': 20.0}).raise_for_status()
+        expected = session.get(f'{a}/dump/').json()
+
+        start_time = time.monotonic()
+        process_b, b = start(1)
+
+        # The log is streamed in the background until both replicas hold the same books
+        if mode == 'log':
+            while session.get(f'{b}/dump/').json() != expected:
+                time.sleep(0.01)
+
+        # Each book is repaired when it is read
+        else:
+            for id in ids:
+                session.get(f'{b}/query/item/{id}').raise_for_status()
+            assert session.get(f'{b}/dump/').json() == expected
+
+        return {'mode': mode, 'books': books, 'missed_updates': updates,
+                'catch_up_seconds': round(time.monotonic() - start_time, 3)}
+    finally:
+        process_a.terminate()
+        process_b.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--updates', type=int, nargs='+', default=[100, 1000])
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    for updates in args.updates:
+        for mode in ['lazy-repair', 'log']:
+            print(json.dumps(run(updates, args.books, mode, front_end)))
+
+
+if __name__ == '__main__':
+    main()
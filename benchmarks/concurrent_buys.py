@@ -0,0 +1,110 @@
+# Measures how many buy requests the order service can wait on at the same time
+# The catalog server is a stand-in that answers every purchase after a delay, so every buy waits on the catalog
+# Compares a gunicorn worker with threads (gthread) against a gevent worker, with one worker process each
+# Then measures hedged book reads, when the first catalog server is slow and the second one is not
+#
+# Usage: python benchmarks/concurrent_buys.py [--buys 2000] [--catalog-delay 0.2] [--hedge-delay 0.02]
+
+from support import load_order, start_service, summarize, StandIn
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+
+# Send all buy requests at the same time, each on its own connection
+# Returns the number of successful buys
+async def send_buys(port, buys):
+    async def buy(book_id):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'PUT /buy/{book_id} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 0\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response.startswith(b'HTTP/1.1 200')
+
+    results = await asyncio.gather(*(buy(1 + index % 7) for index in range(buys)), return_exceptions=True)
+    return sum(1 for result in results if result is True)
+
+
+# Highest number of threads of the worker processes of a gunicorn server while the function runs
+def peak_threads(process, function):
+    peak = [0]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            for child in open(f'/proc/{process.pid}/task/{process.pid}/children').read().split():
+                for line in open(f'/proc/{child}/status'):
+                    if line.startswith('Threads:'):
+                        peak[0] = max(peak[0], int(line.split()[1]))
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        return function(), peak[0]
+    finally:
+        done.set()
+        sampler.join()
+
+
+def concurrency(args):
+    catalog = StandIn(args.catalog_delay).address
+    for worker_class in ('gthread', 'gevent'):
+        process, address = start_service('bzr-order', server='gunicorn', CATALOG_ADDRESS=catalog,
+                                         WORKER_CLASS=worker_class, WORKERS=1, THREADS=args.threads,
+                                         WORKER_CONNECTIONS=args.buys, HTTP_POOL_SIZE=args.buys)
+        try:
+            time.sleep(2)
+            port = int(address.rsplit(':', 1)[1])
+            start = time.perf_counter()
+            succeeded, threads = peak_threads(process, lambda: asyncio.run(send_buys(port, args.buys)))
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'worker_class': worker_class, 'buys': args.buys, 'succeeded': succeeded,
+                              'seconds': round(elapsed, 2), 'buys_per_second': round(succeeded / elapsed, 1),
+                              'peak_worker_threads': threads}))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def hedging(args):
+    body = json.dumps({'title': 'Book', 'quantity': 10, 'price': 10.0}).encode()
+    slow, fast = StandIn(args.slow_delay, body).address, StandIn(0.0, body).address
+    load_order(CATALOG_ADDRESS=slow, CATALOG_ADDRESSES=fast)
+    from bazar_common import http_client
+
+    urls = [f'{slow}/query/item/1', f'{fast}/query/item/1']
+    reads = {
+        'single': lambda: http_client.get(urls[0], 'catalog.query'),
+        'hedged': lambda: http_client.hedged_get(urls, 'catalog.query', args.hedge_delay),
+    }
+    for name, read in reads.items():
+        samples = []
+        for _ in range(args.reads):
+            start = time.perf_counter()
+            read().raise_for_status()
+            samples.append(time.perf_counter() - start)
+        print(json.dumps({'read': name, 'slow_server_delay': args.slow_delay, 'hedge_delay': args.hedge_delay,
+                          **summarize(samples), 'hedged_requests': http_client.stats()['hedged_requests']}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buys', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--catalog-delay', type=float, default=0.2)
+    parser.add_argument('--reads', type=int, default=50)
+    parser.add_argument('--slow-delay', type=float, default=0.3)
+    parser.add_argument('--hedge-delay', type=float, default=0.02)
+    args = parser.parse_args()
+
+    concurrency(args)
+    hedging(args)
+
+
+if __name__ == '__main__':
+    main()
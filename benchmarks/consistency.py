@@ -0,0 +1,90 @@
+# Compares the latency of book reads with every consistency level (see Replication.read) against the default reads,
+# which check a book that is not known to be up-to-date with one other server at a time (the hop chain)
+# Every default, local and quorum read is of a book that was never read before on any server (a cold read),
+# the reads with bounded staleness are of a few hot books, so most of them are served from the local copy
+# The reads are sent one at a time, in turn to every server
+# All servers run on this machine, so every request between them comes from 127.0.0.1, which the default reads take
+# as every server having been asked already (see replication_get), so their hop chain ends after one hop here,
+# and it grows with the number of servers only when they run on different hosts
+#
+# Usage: python benchmarks/consistency.py [--replicas 3 5] [--reads 300] [--hot 10] [--staleness 1000]
+
+from support import start_catalog, free_port, seed_books, percentile, StandIn
+import argparse
+import itertools
+import json
+import os
+import requests
+import tempfile
+import time
+
+
+def measure(session, addresses, book_ids, consistency):
+    latencies = []
+    errors = 0
+    params = {'consistency': consistency} if consistency is not None else {}
+    for address, book_id in zip(itertools.cycle(addresses), book_ids):
+        start = time.perf_counter()
+        response = session.get(f'{address}/query/item/{book_id}', params=params)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors += 1
+    return {'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2), 'max_ms': round(max(latencies) * 1000, 2),
+            'errors': errors}
+
+
+def run(replicas, args, front_end):
+    addresses = [f'http://127.0.0.1:{free_port()}' for _ in range(replicas)]
+    levels = [None, 'local', 'quorum']
+    books = args.reads * len(levels) + args.hot
+    processes = []
+    try:
+        for address in addresses:
+            # Every server starts with the same books
+            file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+            port = int(address.rsplit(':', 1)[1])
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       SNAPSHOT_BOOTSTRAP='0')
+            process.terminate()
+            process.wait()
+            seed_books(file, books)
+
+            others = '|'.join(other for other in addresses if other != address)
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       CATALOG_ADDRESSES=others)
+            processes.append(process)
+
+        results = []
+        with requests.Session() as session:
+            for index, level in enumerate(levels):
+                first = 1000 + index * args.reads
+                result = measure(session, addresses, range(first, first + args.reads), level)
+                results.append({'replicas': replicas, 'consistency': level or 'default (hop chain)', **result})
+
+            hot = [1000 + len(levels) * args.reads + index % args.hot for index in range(args.reads)]
+            level = f'bounded-staleness={args.staleness:g}'
+            results.append({'replicas': replicas, 'consistency': level, **measure(session, addresses, hot, level)})
+        return results
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--reads', type=int, default=300)
+    parser.add_argument('--hot', type=int, default=10)
+    parser.add_argument('--staleness', type=float, default=1000)
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    for replicas in args.replicas:
+        for result in run(replicas, args, front_end):
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
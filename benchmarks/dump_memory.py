@@ -0,0 +1,95 @@
+# Measures the peak memory of a catalog server while it sends all of its books
+# Each mode is measured on a new server process, so the peak memory of one mode does not hide another
+#   full:   GET /dump/ returning the whole table as one JSON list
+#   pages:  GET /dump/?after_id=&limit= until the last page
+#   stream: GET /dump/?stream=1 returning newline-delimited JSON
+# Reports the peak resident memory of the server (Linux only), the time to the first byte and the total time
+#
+# Usage: python benchmarks/dump_memory.py [--sizes 10000,100000,1000000] [--limit 1000]
+
+from support import start_catalog, seed_books, StandIn
+import argparse
+import json
+import os
+import requests
+import tempfile
+import time
+
+
+# Peak resident memory of a process in megabytes
+def peak_memory(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 1024, 1)
+
+
+# Read a whole response body, returns the time its first byte was received and its size
+def receive(response):
+    chunks = response.iter_content(65536)
+    received = len(next(chunks))
+    first_byte = time.monotonic()
+    return first_byte, received + sum(len(chunk) for chunk in chunks)
+
+
+def fetch_full(address):
+    return receive(requests.get(f'{address}/dump/', stream=True))
+
+
+def fetch_pages(address, limit):
+    first_byte, received, after_id = None, 0, 0
+    with requests.Session() as session:
+        while after_id is not None:
+            response = session.get(f'{address}/dump/', params={'after_id': after_id, 'limit': limit})
+            first_byte = first_byte or time.monotonic()
+            received += len(response.content)
+            after_id = response.headers.get('X-Next-After-Id')
+    return first_byte, received
+
+
+def fetch_stream(address):
+    return receive(requests.get(f'{address}/dump/', params={'stream': 1}, stream=True))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    modes = {
+        'full': fetch_full,
+        'pages': lambda address: fetch_pages(address, args.limit),
+        'stream': fetch_stream,
+    }
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+        process, _ = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end)
+        process.terminate()
+        process.wait()
+        seed_books(file, size)
+
+        result = {'books': size}
+        for mode, fetch in modes.items():
+            process, address = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end, PAGE_LIMIT=args.limit)
+            try:
+                idle = peak_memory(process.pid)
+                start = time.monotonic()
+                first_byte, received = fetch(address)
+                result[mode] = {
+                    'peak_mb': peak_memory(process.pid),
+                    'idle_mb': idle,
+                    'first_byte_ms': round((first_byte - start) * 1000, 2),
+                    'total_ms': round((time.monotonic() - start) * 1000, 2),
+                    'bytes': received,
+                }
+            finally:
+                process.terminate()
+                process.wait()
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
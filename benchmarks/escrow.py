@@ -0,0 +1,132 @@
+# Checks that the catalog servers never sell more copies than the stock of a book, while purchases of the same few
+# books are sent to every server at the same time, and compares the purchase throughput with and without escrow
+# With escrow (ESCROW=1), every server sells from its own share of the stock and only contacts the other servers
+# when its share runs out (see escrow.py), without escrow every purchase is replicated to all servers
+# The purchases continue until every server answers that the books are out of stock or the duration ends,
+# then the copies sold (successful purchases, and the copies recorded as sold by every server) are compared with
+# the stock of every book
+# Exits with status 1 if any book was oversold
+#
+# Usage: python benchmarks/escrow.py [--replicas 3] [--books 5] [--connections 8] [--duration 20]
+#                                    [--modes escrow replication]
+
+from support import start_catalog, free_port, seed_books, StandIn
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import random
+import requests
+import sqlite3
+import sys
+import tempfile
+import time
+
+# Stock of every book added by seed_books
+stock = 100
+
+
+# Buy random books from one server on a keep-alive connection until all of them are out of stock on that server
+# Returns the number of copies bought of every book, and the number of failed purchases
+def connection(address, book_ids, deadline):
+    bought = {book_id: 0 for book_id in book_ids}
+    errors = 0
+    left = list(book_ids)
+    with requests.Session() as session:
+        while len(left) > 0 and time.time() < deadline:
+            book_id = random.choice(left)
+            try:
+                response = session.put(f'{address}/purchase/{book_id}')
+            except requests.RequestException:
+                errors += 1
+                continue
+            if response.status_code == 200:
+                bought[book_id] += 1
+            elif response.status_code == 422:
+                left.remove(book_id)
+            else:
+                errors += 1
+    return bought, errors
+
+
+def run(mode, args, front_end):
+    addresses = [f'http://127.0.0.1:{free_port()}' for _ in range(args.replicas)]
+    book_ids = list(range(1000, 1000 + args.books))
+    files = []
+    processes = []
+    try:
+        for address in addresses:
+            # Every server starts with the same books
+            file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+            port = int(address.rsplit(':', 1)[1])
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       SNAPSHOT_BOOTSTRAP='0')
+            process.terminate()
+            process.wait()
+            seed_books(file, args.books)
+            files.append(file)
+
+            others = '|'.join(other for other in addresses if other != address)
+            environment = {'ESCROW': '1', 'SELF_ADDRESS': address} if mode == 'escrow' else {}
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       CATALOG_ADDRESSES=others, **environment)
+            processes.append(process)
+
+        start = time.time()
+        deadline = start + args.duration
+        with ThreadPoolExecutor(max_workers=args.connections * len(addresses)) as executor:
+            futures = [executor.submit(connection, address, book_ids, deadline)
+                       for address in addresses for _ in range(args.connections)]
+            results = [future.result() for future in futures]
+        elapsed = time.time() - start
+
+        bought = {book_id: sum(result[0][book_id] for result in results) for book_id in book_ids}
+        errors = sum(result[1] for result in results)
+
+        # Copies recorded as sold by every server, which must add up to the successful purchases
+        recorded = {book_id: 0 for book_id in book_ids}
+        if mode == 'escrow':
+            for file in files:
+                database = sqlite3.connect(file)
+                for book_id, sold in database.execute('SELECT book_id, sold FROM escrow_share'):
+                    if book_id in recorded:
+                        recorded[book_id] += sold
+                database.close()
+
+        escrow_stats = [requests.get(f'{address}/stats/escrow').json() for address in addresses] \
+            if mode == 'escrow' else []
+        oversold = [book_id for book_id in book_ids if bought[book_id] > stock or recorded[book_id] > stock]
+        return {'mode': mode, 'replicas': args.replicas, 'books': args.books, 'stock': stock,
+                'sold': sum(bought.values()), 'recorded_sold': sum(recorded.values()) if mode == 'escrow' else None,
+                'oversold': oversold, 'errors': errors, 'seconds': round(elapsed, 2),
+                'purchases_per_second': round(sum(bought.values()) / elapsed, 1),
+                'borrowed': sum(stats['borrowed'] for stats in escrow_stats),
+                'rebalanced': sum(stats['rebalanced'] for stats in escrow_stats),
+                'lost': sum(stats['lost'] for stats in escrow_stats)}
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--books', type=int, default=5)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--modes', nargs='+', default=['escrow', 'replication'], choices=['escrow', 'replication'])
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    oversold = False
+    for mode in args.modes:
+        result = run(mode, args, front_end)
+        print(json.dumps(result))
+        oversold = oversold or len(result['oversold']) > 0
+
+    sys.exit(1 if oversold else 0)
+
+
+if __name__ == '__main__':
+    main()
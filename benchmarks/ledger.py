@@ -0,0 +1,99 @@
+# Compares the throughput of the order ledger with group commit (one fsync for all orders recorded at the same time)
+# against committing every order on its own (one fsync per order), see ledger.py
+# First the ledger is written directly by many threads, then buy requests with idempotency keys are sent to an order
+# server (every buy is recorded twice: before and after it is sent to the catalog, which is a stand-in here)
+# The ledger files are written to --directory (a temporary directory by default), fsync is only as slow as its disk
+#
+# Usage: python benchmarks/ledger.py [--threads 16] [--duration 5] [--directory DIR] [--catalog-delay 0.005]
+
+from support import start_service, percentile, StandIn, root_dir
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import requests
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(root_dir, 'bzr-order'))
+from ledger import Ledger
+
+
+def ledger_file(directory):
+    return os.path.join(tempfile.mkdtemp(prefix='bzr-bench-', dir=directory), 'ledger.sqlite')
+
+
+# Record orders from many threads directly in a ledger until the deadline
+def direct(group_commit, args):
+    ledger = Ledger(ledger_file(args.directory), group_commit, 256, 0)
+
+    def writer(_):
+        recorded = 0
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            order_id = ledger.begin(uuid.uuid4().hex, {'1': 1})
+            ledger.write('UPDATE orders SET status = 200, completed = ? WHERE id = ?', (time.time(), order_id))
+            recorded += 1
+        return recorded
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        recorded = sum(executor.map(writer, range(args.threads)))
+    return {'test': 'direct', 'group_commit': group_commit, 'threads': args.threads,
+            'orders_per_second': round(recorded / args.duration, 1),
+            'orders_per_commit': round(ledger.stats['writes'] / max(1, ledger.stats['commits']), 2)}
+
+
+# Send buy requests with idempotency keys to an order server on keep-alive connections until the deadline
+def served(group_commit, args, catalog):
+    process, order = start_service('bzr-order', CATALOG_ADDRESS=catalog, LEDGER_FILE=ledger_file(args.directory),
+                                   LEDGER_GROUP_COMMIT='1' if group_commit else '0')
+
+    def client(_):
+        latencies = []
+        errors = 0
+        deadline = time.time() + args.duration
+        with requests.Session() as session:
+            while time.time() < deadline:
+                start = time.perf_counter()
+                response = session.put(f'{order}/buy/1', headers={'Idempotency-Key': uuid.uuid4().hex})
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+        return latencies, errors
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            results = list(executor.map(client, range(args.threads)))
+        stats = requests.get(f'{order}/stats/ledger').json()
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = [latency for result in results for latency in result[0]]
+    return {'test': 'order_server', 'group_commit': group_commit, 'threads': args.threads,
+            'buys_per_second': round(len(latencies) / args.duration, 1),
+            'errors': sum(result[1] for result in results),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'orders_per_commit': round(stats['writes'] / max(1, stats['commits']), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--catalog-delay', type=float, default=0.005)
+    args = parser.parse_args()
+
+    for group_commit in (False, True):
+        print(json.dumps(direct(group_commit, args)))
+
+    catalog = StandIn(args.catalog_delay).address
+    for group_commit in (False, True):
+        print(json.dumps(served(group_commit, args, catalog)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Measures N concurrent buyers of the same book through the order service
+# Compares the atomic purchase request against the previous read-then-update loop
+#
+# Usage: python benchmarks/purchase_contention.py [--buyers 1 8 32] [--stock 400]
+
+from support import load_order, start_catalog, StandIn
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import requests
+import time
+
+
+def run(app, routes, http_client, catalog, mode, buyers, stock):
+    routes.BUY_MODE = mode
+    requests.put(f'{catalog}/update/1', json={'quantity': stock}).raise_for_status()
+
+    retries_before = routes.buy_stats['retries']
+    requests_before = http_client.stats()['requests']
+
+    # Every buyer keeps buying until the book is out of stock
+    # Returns the number of successful purchases and the number of failed requests
+    def buyer(_):
+        client = app.test_client()
+        purchased, errors = 0, 0
+        while True:
+            response = client.put('/buy/1')
+            if response.status_code != 200:
+                errors += 1
+                continue
+            if not response.json['success']:
+                return purchased, errors
+            purchased += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=buyers) as executor:
+        results = list(executor.map(buyer, range(buyers)))
+    elapsed = time.perf_counter() - start
+    purchased = sum(result[0] for result in results)
+
+    remaining = requests.get(f'{catalog}/query/item/1').json()['quantity']
+    return {
+        'mode': mode,
+        'buyers': buyers,
+        'purchases_per_second': round(purchased / elapsed, 1),
+        'catalog_requests_per_purchase': round((http_client.stats()['requests'] - requests_before) / purchased, 2),
+        'retries': routes.buy_stats['retries'] - retries_before,
+        'failed_requests': sum(result[1] for result in results),
+        # Purchases that were reported as successful but did not decrease the stock
+        'oversold': purchased - (stock - remaining),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buyers', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--stock', type=int, default=400)
+    args = parser.parse_args()
+
+    catalog_process, catalog = start_catalog(FRONT_END_ADDRESS=StandIn().address)
+    try:
+        app = load_order(CATALOG_ADDRESS=catalog)
+        import routes
+        from bazar_common import http_client
+
+        for buyers in args.buyers:
+            for mode in ['update', 'purchase']:
+                print(json.dumps(run(app, routes, http_client, catalog, mode, buyers, args.stock)))
+    finally:
+        catalog_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
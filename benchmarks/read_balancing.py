@@ -0,0 +1,68 @@
+# Measures the book read throughput of the order service as catalog replicas are added
+# Every replica is a stand-in that serves a limited number of reads at the same time, like a busy catalog server
+# Reads are spread across the replicas by the balancer of the order service
+# The last run adds a replica that refuses connections, which the balancer should eject
+#
+# Usage: python benchmarks/read_balancing.py [--replicas 1 2 4] [--capacity 4] [--delay 0.05] [--readers 32]
+
+from support import load_order, free_port, StandIn
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import time
+
+
+# Read books through the balancer of the order service from many threads until the deadline
+# Runs in its own process, since the order service can only be loaded once per process
+def run(addresses, readers, duration):
+    load_order(CATALOG_ADDRESS=addresses[0], CATALOG_ADDRESSES='|'.join(addresses), HTTP_POOL_SIZE=readers)
+    import routes
+
+    def reader(_):
+        reads, errors = 0, 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            try:
+                if routes.balancer.get('/query/item/1', routes.query_endpoint).status_code == 200:
+                    reads += 1
+                    continue
+            except Exception:
+                pass
+            errors += 1
+        return reads, errors
+
+    with ThreadPoolExecutor(max_workers=readers) as executor:
+        results = list(executor.map(reader, range(readers)))
+    return {'reads_per_second': round(sum(result[0] for result in results) / duration, 1),
+            'errors': sum(result[1] for result in results),
+            'replicas': routes.balancer.snapshot()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--capacity', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=0.05)
+    parser.add_argument('--readers', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    body = json.dumps({'title': 'Book', 'quantity': 10, 'price': 10.0}).encode()
+    stand_ins = [StandIn(args.delay, body, args.capacity).address for _ in range(max(args.replicas))]
+    runs = [(count, stand_ins[:count]) for count in args.replicas]
+    runs.append((f'{len(stand_ins)}+1 down', stand_ins + [f'http://127.0.0.1:{free_port()}']))
+
+    for name, addresses in runs:
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(run, (addresses, args.readers, args.duration))
+        ejections = sum(replica['ejections'] for replica in result.pop('replicas').values())
+
+        # Highest read throughput the replicas that are up can serve
+        capacity = len([address for address in addresses if address in stand_ins]) * args.capacity / args.delay
+        print(json.dumps({'replicas': name, **result, 'ejections': ejections,
+                          'capacity_reads_per_second': round(capacity, 1)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Measures /update latency of the catalog with 2, 4 and 8 replicas
+# The other replicas are local stand-ins: healthy, slow (answer after a delay) or dead (never answer)
+#
+# Usage: python benchmarks/replication_fanout.py [--requests 30] [--peer-latency 0.002] [--slow-delay 0.3]
+
+from support import load_catalog, summarize, StandIn, Blackhole, kept_alive
+import argparse
+import json
+import time
+
+
+def run(client, replication, peers, requests, workers, quorum, deadline):
+    from fanout import FanOut
+
+    replication.catalog_addresses = peers
+    replication.fan_out = FanOut(workers)
+    replication.quorum = quorum
+    replication.deadline = deadline
+
+    samples = []
+    for i in range(requests):
+        # Forget that the book is up-to-date so that both the check and the update phase are sent
+        replication.updated_ids.clear()
+        start = time.perf_counter()
+        response = client.put('/update/1', json={'price': 10.0 + i % 10})
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--peer-latency', type=float, default=0.002)
+    parser.add_argument('--slow-delay', type=float, default=0.3)
+    args = parser.parse_args()
+
+    app = load_catalog()
+    from replication import replication
+    client = app.test_client()
+
+    for replicas in [2, 4, 8]:
+        healthy = [StandIn(args.peer_latency).address for _ in range(replicas - 1)]
+
+        # One of the peers is slow, and from 4 replicas on, another one is dead
+        degraded = [StandIn(args.slow_delay).address] + healthy[1:]
+        if replicas >= 4:
+            dead = Blackhole()
+            kept_alive.append(dead)
+            degraded[1] = dead.address
+
+        # Majority of all replicas, including this one
+        quorum = replicas // 2
+
+        for peers_name, peers in [('healthy', healthy), ('degraded', degraded)]:
+            for mode, workers, mode_quorum, deadline in [('sequential', 1, None, None),
+                                                          ('parallel', 16, None, None),
+                                                          ('parallel-quorum', 16, quorum, 1.0)]:
+                summary = run(client, replication, peers, args.requests, workers, mode_quorum, deadline)
+                result = {'replicas': replicas, 'peers': peers_name, 'mode': mode, **summary}
+                print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Checks that the compiled schemas (see serialization.py) format books into the same bytes as the marshmallow
+# schemas and jsonify, and measures the time each of them takes to format a response
+# Books are formatted as Core rows (Book.get), ORM objects (Book.query) and dicts, with titles and prices that need
+# escaping or unusual float formatting
+# Exits with status 1 if any output differs
+#
+# Usage: python benchmarks/serialization.py [--page 100] [--repeat 2000]
+
+from support import load_catalog
+import argparse
+import json
+import math
+import sys
+import timeit
+
+titles = ['Plain title', 'Quote " and backslash \\', 'Tab\tnewline\ncontrol\x01', 'Café ☃ \U0001f4da',
+          '100% of %s and %(name)s', '</script>', '']
+prices = [10.0, 0.1, 1e16, 1e-7, 123456789.123, -0.0, 2.5e-300, 25]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = load_catalog()
+    from book import Book, item_schema, items_schema, topic_schema, update_schema, replication_schema, dump_schema
+    from database import db
+
+    schemas = {'item': item_schema, 'items': items_schema, 'topic': topic_schema, 'update': update_schema,
+               'replication': replication_schema, 'dump': dump_schema}
+
+    with app.test_request_context():
+        first_id = Book.last_id() + 1
+        rows = [{'id': first_id + index, 'title': title, 'topic': f'Topic {title}', 'quantity': index,
+                 'price': price, 'sequence_number': index}
+                for index, (title, price) in enumerate((title, price) for title in titles for price in prices)]
+        Book.insert_many(rows)
+        page_rows = [{'id': first_id + len(rows) + index, 'title': f'Book {index}', 'topic': 'Page',
+                      'quantity': 100, 'price': 10.0, 'sequence_number': 0} for index in range(args.page)]
+        Book.insert_many(page_rows)
+        db.session.commit()
+
+        # Every book as a Core row, as an ORM object and as a dict, and unusual floats only as dicts
+        books = [Book.get(row['id']) for row in rows] + Book.get_many([row['id'] for row in rows]) + rows
+        books += [{**rows[0], 'price': value} for value in (math.nan, math.inf, -math.inf)]
+        page = [Book.get(row['id']) for row in page_rows]
+
+        mismatches = []
+        for name, schema in schemas.items():
+            cases = [[book] for book in books] + [page] if schema.many else books
+            for case in cases:
+                if schema.jsonify(case).get_data() != schema.schema.jsonify(case).get_data():
+                    mismatches.append({'schema': name, 'output': schema.jsonify(case).get_data().decode()})
+                if schema.dump(case) != schema.schema.dump(case):
+                    mismatches.append({'schema': name, 'dump': repr(schema.dump(case))})
+            for book in books:
+                if schema.dumps(book) != json.dumps(schema.schema.dump(book, many=False)):
+                    mismatches.append({'schema': name, 'line': schema.dumps(book)})
+
+        print(json.dumps({'checked_books': len(books), 'mismatches': len(mismatches)}))
+        for mismatch in mismatches[:10]:
+            print(json.dumps(mismatch))
+
+        # Time to format one response with the schema and jsonify, and with the compiled schema
+        book = Book.get(1)
+        for name, schema in schemas.items():
+            obj = page if schema.many else book
+            marshmallow = timeit.timeit(lambda: schema.schema.jsonify(obj), number=args.repeat) / args.repeat
+            compiled = timeit.timeit(lambda: schema.jsonify(obj), number=args.repeat) / args.repeat
+            print(json.dumps({'schema': name, 'books': len(obj) if schema.many else 1,
+                              'marshmallow_us': round(marshmallow * 1e6, 1), 'compiled_us': round(compiled * 1e6, 1),
+                              'saved_us': round((marshmallow - compiled) * 1e6, 1),
+                              'speedup': round(marshmallow / compiled, 1)}))
+
+    sys.exit(1 if len(mismatches) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
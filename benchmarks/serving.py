@@ -0,0 +1,87 @@
+# Load test of the catalog server as the number of worker processes grows
+# Compares the Flask development server against gunicorn (see bzr-catalog/gunicorn.conf.py) with 1, 2, 4... workers
+# Clients run in separate processes so that they do not compete with each other for the GIL
+# The response cache is disabled, so every request reads the database
+#
+# Usage: python benchmarks/serving.py [--workers 1 2 4] [--threads 8] [--clients 4] [--connections 8] [--duration 5]
+
+from support import start_catalog, seed_books, StandIn
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import requests
+import tempfile
+import time
+
+
+# Send requests on keep-alive connections until the deadline
+# Returns the number of successful and failed requests
+def client(address, connections, books, deadline):
+    def connection(_):
+        completed, errors = 0, 0
+        with requests.Session() as session:
+            while time.time() < deadline:
+                if random.random() < 0.8:
+                    url = f'{address}/query/item/{1000 + random.randrange(books)}'
+                else:
+                    url = f'{address}/query/topic/Topic {random.randrange(100)}?limit=20'
+                try:
+                    if session.get(url).status_code == 200:
+                        completed += 1
+                    else:
+                        errors += 1
+                except requests.RequestException:
+                    errors += 1
+        return completed, errors
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        results = list(executor.map(connection, range(connections)))
+    return sum(result[0] for result in results), sum(result[1] for result in results)
+
+
+def run(address, args):
+    deadline = time.time() + args.duration
+    with multiprocessing.Pool(args.clients) as pool:
+        results = pool.starmap(client, [(address, args.connections, args.books, deadline)] * args.clients)
+    completed = sum(result[0] for result in results)
+    return {'requests_per_second': round(completed / args.duration, 1), 'errors': sum(result[1] for result in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--books', type=int, default=10000)
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+    process, _ = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end)
+    process.terminate()
+    process.wait()
+    seed_books(file, args.books)
+
+    servers = [('flask', 1)] + [('gunicorn', workers) for workers in args.workers]
+    for server, workers in servers:
+        process, address = start_catalog(server=server, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                         WORKERS=workers, THREADS=args.threads, RESPONSE_CACHE_ENTRIES=0)
+        try:
+            # Wait until every worker answers
+            time.sleep(1 + 0.5 * workers)
+            requests.get(f'{address}/query/item/1').raise_for_status()
+            threads = args.threads if server == 'gunicorn' else None
+            print(json.dumps({'server': server, 'workers': workers, 'threads': threads, 'cpus': os.cpu_count(),
+                              **run(address, args)}))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Measures the purchase throughput as the books are split across more shard groups of catalog servers
+# Every group has --replicas servers which replicate the purchases of its books, and every purchase of a random book
+# is sent through the order server, which routes it to the group of the book (see bazar_common/sharding.py)
+# Purchases are also sent directly to the first server of every group, without the order server,
+# to measure the write capacity of the catalog servers alone
+# With --baseline, the same number of servers is also measured as a single group that replicates every purchase
+# to all of them (the setup before sharding)
+# All processes run on this machine, so the throughput cannot grow with more groups than CPUs
+#
+# Usage: python benchmarks/sharding.py [--shards 1 2 4] [--replicas 2] [--books 10000] [--clients 2]
+#                                      [--connections 8] [--duration 5] [--baseline]
+
+from support import start_catalog, start_service, free_port, seed_books, StandIn
+from bazar_common.sharding import Ring
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import requests
+import sqlite3
+import tempfile
+import time
+
+
+# Buy random books on keep-alive connections until the deadline
+# Returns the number of successful and failed purchases
+def client(targets, books, connections, deadline):
+    def connection(_):
+        completed, errors = 0, 0
+        with requests.Session() as session:
+            while time.time() < deadline:
+                book_id = 1000 + random.randrange(books)
+                url = targets[book_id] if isinstance(targets, dict) else f'{targets}/buy/{book_id}'
+                try:
+                    if session.put(url).status_code == 200:
+                        completed += 1
+                    else:
+                        errors += 1
+                except requests.RequestException:
+                    errors += 1
+        return completed, errors
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        results = list(executor.map(connection, range(connections)))
+    return sum(result[0] for result in results), sum(result[1] for result in results)
+
+
+def load(targets, args):
+    deadline = time.time() + args.duration
+    with multiprocessing.Pool(args.clients) as pool:
+        results = pool.starmap(client, [(targets, args.books, args.connections, deadline)] * args.clients)
+    completed = sum(result[0] for result in results)
+    return round(completed / args.duration, 1), sum(result[1] for result in results)
+
+
+def run(shards, replicas, args, front_end):
+    names = [f'shard{index}' for index in range(shards)]
+    ring = Ring(names)
+    groups = {name: [f'http://127.0.0.1:{free_port()}' for _ in range(replicas)] for name in names}
+    environment = {'SHARDS': '|'.join(names)} if shards > 1 else {}
+
+    processes = []
+    try:
+        for name, addresses in groups.items():
+            for address in addresses:
+                # Every server of a group starts with the books of the group only
+                file = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+                port = int(address.rsplit(':', 1)[1])
+                process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                           SNAPSHOT_BOOTSTRAP='0', SHARD=name, **environment)
+                process.terminate()
+                process.wait()
+                seed_books(file, args.books)
+                connection = sqlite3.connect(file)
+                with connection:
+                    connection.executemany('DELETE FROM book WHERE id = ?',
+                                           [(book_id,) for book_id in range(1000, 1000 + args.books)
+                                            if ring.owner(book_id) != name])
+                connection.close()
+
+                others = '|'.join(other for other in addresses if other != address)
+                process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                           CATALOG_ADDRESSES=others, SHARD=name, **environment)
+                processes.append(process)
+
+        shards_setting = '; '.join(f'{name}={" | ".join(addresses)}' for name, addresses in groups.items())
+        order_process, order = start_service('bzr-order', CATALOG_SHARDS=shards_setting)
+        processes.append(order_process)
+
+        direct = {book_id: f'{groups[ring.owner(book_id)][0]}/purchase/{book_id}'
+                  for book_id in range(1000, 1000 + args.books)}
+        direct_rate, direct_errors = load(direct, args)
+        order_rate, order_errors = load(order, args)
+        return {'shards': shards, 'replicas': replicas, 'servers': shards * replicas, 'cpus': os.cpu_count(),
+                'catalog_purchases_per_second': direct_rate, 'catalog_errors': direct_errors,
+                'order_purchases_per_second': order_rate, 'order_errors': order_errors}
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+
+    front_end = StandIn().address
+    for shards in args.shards:
+        print(json.dumps(run(shards, args.replicas, args, front_end)))
+        if args.baseline and shards > 1:
+            print(json.dumps(run(1, shards * args.replicas, args, front_end)))
+
+
+if __name__ == '__main__':
+    main()
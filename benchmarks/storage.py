@@ -0,0 +1,120 @@
+# Mixed read/write load on a catalog server, comparing SQLite settings
+#   default: rollback journal, synchronous=FULL, a new connection for every request (the previous settings)
+#   tuned:   WAL journal, synchronous=NORMAL, memory mapping and a pool of open connections (the current defaults)
+#   postgresql: a PostgreSQL database, if a URL is passed with --database-url
+#               (it must be a throwaway database, its tables are dropped before the run)
+# Reads are item queries with the response cache disabled, writes are purchases of one copy
+# The server runs with gunicorn, with several threads in each of --workers processes
+#
+# Usage: python benchmarks/storage.py [--books 10000] [--writes 0.1] [--clients 2] [--connections 8] [--duration 5]
+#                                     [--workers 1] [--database-url postgresql://user@host/database]
+
+from support import start_catalog, seed_books, summarize, StandIn
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import requests
+import tempfile
+import time
+import warnings
+
+settings = {
+    'default': {'SQLITE_JOURNAL_MODE': 'DELETE', 'SQLITE_SYNCHRONOUS': 'FULL', 'SQLITE_MMAP_SIZE': 0,
+                'SQLITE_CACHE_SIZE': 2 * 1024 * 1024, 'DATABASE_POOL_SIZE': 0},
+    'tuned': {},
+}
+
+
+# Send reads and writes on keep-alive connections until the deadline
+# Returns the latencies of the reads and of the writes, and the number of failed requests
+def client(address, connections, books, writes, deadline):
+    def connection(_):
+        reads_latency, writes_latency, errors = [], [], 0
+        with requests.Session() as session:
+            while time.time() < deadline:
+                book_id = 1000 + random.randrange(books)
+                write = random.random() < writes
+                start = time.perf_counter()
+                if write:
+                    response = session.put(f'{address}/purchase/{book_id}')
+                else:
+                    response = session.get(f'{address}/query/item/{book_id}')
+                if response.status_code != 200:
+                    errors += 1
+                    continue
+                (writes_latency if write else reads_latency).append(time.perf_counter() - start)
+        return reads_latency, writes_latency, errors
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        results = list(executor.map(connection, range(connections)))
+    return [sample for result in results for sample in result[0]], \
+        [sample for result in results for sample in result[1]], sum(result[2] for result in results)
+
+
+# Drop all tables of a database
+def drop_tables(url):
+    from sqlalchemy import MetaData, create_engine
+    engine = create_engine(url)
+    metadata = MetaData()
+    # The indexes of expressions (the search indexes) are dropped along with their tables
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        metadata.reflect(engine)
+    metadata.drop_all(engine)
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--writes', type=float, default=0.1)
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    runs = dict(settings)
+    if args.database_url is not None:
+        runs['postgresql'] = {'DATABASE_URL': args.database_url}
+
+    front_end = StandIn().address
+    for name, environment in runs.items():
+        if 'DATABASE_URL' in environment:
+            database = environment['DATABASE_URL']
+            drop_tables(database)
+        else:
+            database = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+            environment = {**environment, 'DATABASE_FILE': database}
+        process, _ = start_catalog(FRONT_END_ADDRESS=front_end, **environment)
+        process.terminate()
+        process.wait()
+        seed_books(database, args.books)
+
+        process, address = start_catalog(server='gunicorn', FRONT_END_ADDRESS=front_end, WORKERS=args.workers,
+                                         THREADS=args.threads, RESPONSE_CACHE_ENTRIES=0, **environment)
+        try:
+            time.sleep(1.5)
+            deadline = time.time() + args.duration
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.starmap(client, [(address, args.connections, args.books, args.writes, deadline)] *
+                                       args.clients)
+            reads = [sample for result in results for sample in result[0]]
+            writes = [sample for result in results for sample in result[1]]
+            print(json.dumps({'settings': name,
+                              'reads_per_second': round(len(reads) / args.duration, 1),
+                              'writes_per_second': round(len(writes) / args.duration, 1),
+                              'reads': summarize(reads), 'writes': summarize(writes),
+                              'errors': sum(result[2] for result in results)}))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
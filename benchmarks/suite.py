@@ -0,0 +1,304 @@
+# End-to-end load test of N catalog replicas and an order server, started as local processes on loopback ports
+# The front end server is a stand-in that accepts the invalidation requests of the replicas
+# Every workload runs for --duration seconds on a new cluster, whose replicas all start with the same --books books:
+#   reads:        item queries spread across the replicas (like the front end does)
+#   hot-buys:     buys of a few hot books through the order server, which retries purchases rejected with 409
+#   search:       topic and title searches, mixed with item queries
+#   kill-restart: item queries and buys of random books, while the last replica is killed after a quarter
+#                 of the duration and restarted at half of it
+# Reports the throughput, the latency percentiles and the status codes of every kind of request, the retry rate
+# of the buys, and the consistency violations found once the load stopped:
+#   oversold:  purchases reported as successful that did not decrease the stock of the book
+#   diverged:  replicas that did not hold the same books as the first one (by their digests) after --settle seconds
+# Purchases that decreased the stock without being reported as successful (e.g. the buyer timed out) are reported
+# as unacknowledged, they are not a violation
+# The random choices of every client connection are seeded from --seed, and the results are written to --output
+# with the settings, so runs can be repeated and compared with --compare
+#
+# Usage: python benchmarks/suite.py [--replicas 3] [--books 10000] [--duration 10] [--clients 2] [--connections 8]
+#                                   [--workloads reads hot-buys search kill-restart] [--hot 4] [--stock 1000000]
+#                                   [--seed 1] [--settle 10] [--output suite.json]
+#        python benchmarks/suite.py --compare before.json after.json
+
+from support import start_catalog, start_service, free_port, seed_books, percentile, StandIn, root_dir
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import requests
+import subprocess
+import sys
+import tempfile
+import time
+
+# Kinds of requests sent by every workload, with their weights
+workloads = {
+    'reads': {'item': 1},
+    'hot-buys': {'hot-buy': 1},
+    'search': {'topic': 5, 'title': 3, 'item': 2},
+    'kill-restart': {'item': 8, 'buy': 2},
+}
+
+
+# A group of catalog replicas that know each other, and an order server
+# Purchases are sent to the first replica, and book reads of the order server are spread across all of them
+class Cluster:
+
+    def __init__(self, replicas, books, front_end, **environment):
+        self.ports = [free_port() for _ in range(replicas)]
+        self.addresses = [f'http://127.0.0.1:{port}' for port in self.ports]
+        self.files = [os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite') for _ in range(replicas)]
+        self.front_end = front_end
+        self.environment = environment
+        self.processes = [None] * replicas
+
+        # Every replica starts with the same books, so no replica copies the books of another one
+        for index in range(replicas):
+            process, _ = start_catalog(port=self.ports[index], DATABASE_FILE=self.files[index],
+                                       FRONT_END_ADDRESS=front_end, SNAPSHOT_BOOTSTRAP='0')
+            process.terminate()
+            process.wait()
+            seed_books(self.files[index], books)
+
+        for index in range(replicas):
+            self.start(index)
+
+        self.order_process, self.order = start_service('bzr-order', CATALOG_ADDRESS=self.addresses[0],
+                                                       CATALOG_ADDRESSES='|'.join(self.addresses[1:]))
+
+    def start(self, index):
+        others = '|'.join(address for address in self.addresses if address != self.addresses[index])
+        self.processes[index], _ = start_catalog(port=self.ports[index], DATABASE_FILE=self.files[index],
+                                                 FRONT_END_ADDRESS=self.front_end, CATALOG_ADDRESSES=others,
+                                                 **self.environment)
+
+    def kill(self, index):
+        self.processes[index].kill()
+        self.processes[index].wait()
+
+    def stop(self):
+        for process in self.processes + [self.order_process]:
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+# Send requests of a workload on keep-alive connections until the deadline
+# Returns the latencies and the status codes of every kind of request, and the purchases of every book
+def client(workload, replicas, order, books, hot, seed, deadline, connections):
+    kinds = list(workloads[workload])
+    weights = list(workloads[workload].values())
+
+    def connection(index):
+        generator = random.Random(seed * 1000 + index)
+        latencies = {kind: [] for kind in kinds}
+        statuses = {kind: {} for kind in kinds}
+        purchases = {}
+        with requests.Session() as session:
+            while time.time() < deadline:
+                kind = generator.choices(kinds, weights)[0]
+                book_id = 1000 + generator.randrange(books)
+                replica = generator.choice(replicas)
+                if kind == 'item':
+                    method, url = 'GET', f'{replica}/query/item/{book_id}'
+                elif kind == 'topic':
+                    method, url = 'GET', f'{replica}/query/topic/Topic {generator.randrange(100)}?limit=20'
+                elif kind == 'title':
+                    method, url = 'GET', f'{replica}/query/title/{generator.randrange(books)}?limit=20'
+                else:
+                    if kind == 'hot-buy':
+                        book_id = 1000 + generator.randrange(hot)
+                    method, url = 'PUT', f'{order}/buy/{book_id}'
+
+                start = time.perf_counter()
+                try:
+                    response = session.request(method, url, timeout=10)
+                    status = str(response.status_code)
+                    if method == 'PUT' and response.status_code == 200 and response.json()['success']:
+                        purchases[book_id] = purchases.get(book_id, 0) + 1
+                except requests.RequestException as error:
+                    status = type(error).__name__
+                latencies[kind].append(time.perf_counter() - start)
+                statuses[kind][status] = statuses[kind].get(status, 0) + 1
+        return latencies, statuses, purchases
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        return list(executor.map(connection, range(connections)))
+
+
+# Merge the results of all client connections
+def merge(results):
+    latencies, statuses, purchases = {}, {}, {}
+    for connection_latencies, connection_statuses, connection_purchases in results:
+        for kind, samples in connection_latencies.items():
+            latencies.setdefault(kind, []).extend(samples)
+        for kind, counts in connection_statuses.items():
+            for status, count in counts.items():
+                statuses.setdefault(kind, {})[status] = statuses.setdefault(kind, {}).get(status, 0) + count
+        for book_id, count in connection_purchases.items():
+            purchases[book_id] = purchases.get(book_id, 0) + count
+    return latencies, statuses, purchases
+
+
+def report(samples, statuses, duration):
+    successful = sum(count for status, count in statuses.items() if status.startswith('2'))
+    result = {'requests': len(samples), 'requests_per_second': round(len(samples) / duration, 1),
+              'errors': len(samples) - successful, 'statuses': statuses}
+    if len(samples) > 0:
+        for percent in [50, 95, 99]:
+            result[f'p{percent}_ms'] = round(percentile(samples, percent) * 1000, 2)
+        result['max_ms'] = round(max(samples) * 1000, 2)
+    return result
+
+
+# Wait until every replica holds the same books as the first one, returns the replicas that did not
+def diverged_replicas(addresses, settle):
+    end = time.monotonic() + settle
+    while True:
+        digests = {}
+        for address in addresses:
+            try:
+                digests[address] = requests.get(f'{address}/rep/digest', timeout=10).json()['digest']
+            except requests.RequestException:
+                digests[address] = None
+        diverged = [address for address in addresses[1:] if digests[address] != digests[addresses[0]]]
+        if len(diverged) == 0 or time.monotonic() > end:
+            return diverged
+        time.sleep(0.5)
+
+
+def run(workload, args, front_end):
+    cluster = Cluster(args.replicas, args.books, front_end)
+    try:
+        # The hot books have enough stock to never run out during the run
+        for i in range(args.hot):
+            requests.put(f'{cluster.addresses[0]}/update/{1000 + i}', json={'quantity': args.stock}).raise_for_status()
+
+        buy_stats_before = requests.get(f'{cluster.order}/stats/buy').json()
+        start = time.time()
+        deadline = start + args.duration
+        clients = [(workload, cluster.addresses, cluster.order, args.books, args.hot, args.seed * 100 + index,
+                    deadline, args.connections) for index in range(args.clients)]
+        with multiprocessing.Pool(args.clients) as pool:
+            pending = pool.starmap_async(client, clients)
+
+            # Kill the last replica after a quarter of the duration, and restart it at half of it
+            events = []
+            if workload == 'kill-restart':
+                time.sleep(max(0.0, start + args.duration / 4 - time.time()))
+                cluster.kill(len(cluster.addresses) - 1)
+                events.append({'event': 'killed', 'seconds': round(time.time() - start, 3)})
+                time.sleep(max(0.0, start + args.duration / 2 - time.time()))
+                cluster.start(len(cluster.addresses) - 1)
+                events.append({'event': 'restarted', 'seconds': round(time.time() - start, 3)})
+
+            results = [result for connections in pending.get() for result in connections]
+        duration = time.time() - start
+        latencies, statuses, purchases = merge(results)
+        buy_stats = requests.get(f'{cluster.order}/stats/buy').json()
+
+        # Every book that was bought must have lost exactly as many copies as the purchases reported as successful
+        oversold, unacknowledged = 0, 0
+        for book_id, count in purchases.items():
+            initial = args.stock if book_id < 1000 + args.hot else 100
+            remaining = requests.get(f'{cluster.addresses[0]}/query/item/{book_id}').json()['quantity']
+            oversold += max(0, count - (initial - remaining))
+            unacknowledged += max(0, (initial - remaining) - count)
+
+        attempts = buy_stats['attempts'] - buy_stats_before['attempts']
+        retries = buy_stats['retries'] - buy_stats_before['retries']
+        diverged = diverged_replicas(cluster.addresses, args.settle)
+        return {
+            'workload': workload,
+            'seconds': round(duration, 3),
+            'requests': {kind: report(samples, statuses[kind], duration) for kind, samples in latencies.items()},
+            'buys': {
+                'attempts': attempts,
+                'retries': retries,
+                'retry_rate': round(retries / attempts, 4) if attempts > 0 else None,
+                'budget_exhausted': buy_stats['budget_exhausted'] - buy_stats_before['budget_exhausted'],
+                'purchases': sum(purchases.values()),
+                'unacknowledged': unacknowledged,
+            },
+            'violations': {'oversold': oversold, 'diverged': diverged},
+            'events': events,
+        }
+    finally:
+        cluster.stop()
+
+
+# Print the change of the throughput and of the p99 latency of every kind of request between two result files
+def compare(before_path, after_path):
+    with open(before_path) as file:
+        before = json.load(file)
+    with open(after_path) as file:
+        after = json.load(file)
+
+    for workload, result in after['workloads'].items():
+        previous = before['workloads'].get(workload)
+        if previous is None:
+            continue
+        for kind, requests_after in result['requests'].items():
+            requests_before = previous['requests'].get(kind)
+            if requests_before is None or requests_before['requests_per_second'] == 0:
+                continue
+            print(json.dumps({
+                'workload': workload,
+                'kind': kind,
+                'requests_per_second': [requests_before['requests_per_second'], requests_after['requests_per_second']],
+                'throughput_change': round(requests_after['requests_per_second'] /
+                                           requests_before['requests_per_second'] - 1, 4),
+                'p99_ms': [requests_before.get('p99_ms'), requests_after.get('p99_ms')],
+                'errors': [requests_before['errors'], requests_after['errors']],
+            }))
+        print(json.dumps({'workload': workload, 'violations': [previous['violations'], result['violations']]}))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--workloads', nargs='+', default=list(workloads), choices=list(workloads))
+    parser.add_argument('--hot', type=int, default=4)
+    parser.add_argument('--stock', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--settle', type=float, default=10)
+    parser.add_argument('--output', default='suite.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+
+    front_end = StandIn().address
+    results = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'environment': {'commit': git_commit(), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'workloads': {},
+    }
+    for workload in args.workloads:
+        result = run(workload, args, front_end)
+        results['workloads'][workload] = result
+        print(json.dumps(result))
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Root directory of the repository
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The modules shared by the services (see bzr-common) are imported from the repository, whether or not the package
+# is installed, in this process and in the servers it starts
+common_dir = os.path.join(root_dir, 'bzr-common')
+sys.path.insert(0, common_dir)
+
+
+# Import the catalog service in this process, using a temporary database file
+# Returns the catalog Flask application instance
+def load_catalog(**environment):
+    os.environ['DATABASE_FILE'] = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+    os.environ.update({key: str(value) for key, value in environment.items()})
+    sys.path.insert(0, os.path.join(root_dir, 'bzr-catalog'))
+    import app
+    app.start()
+    return app.app
+
+
+# Import the order service in this process, using a temporary ledger file
+# Returns the order Flask application instance
+def load_order(**environment):
+    os.environ['LEDGER_FILE'] = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'ledger.sqlite')
+    os.environ.update({key: str(value) for key, value in environment.items()})
+    sys.path.insert(0, os.path.join(root_dir, 'bzr-order'))
+    import app
+    return app.app
+
+
+# Return a free local port
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# Wait until a server accepts connections on the given local port
+def wait_for_port(port, timeout=30.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Nothing is listening on port {port}')
+
+
+# Command lines that start a service with the development server, or with gunicorn (see gunicorn.conf.py)
+servers = {
+    'flask': [sys.executable, 'app.py'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
+}
+
+
+# Start a service as a separate process
+# Returns the process and the address of the service
+def start_service(service, port=None, server='flask', timeout=30.0, **environment):
+    port = port if port is not None else free_port()
+    env = dict(os.environ)
+    env.update({key: str(value) for key, value in environment.items()})
+    env['PORT'] = str(port)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [common_dir, env.get('PYTHONPATH')]))
+    # Order servers record their orders in a temporary ledger file, rather than in the service directory
+    if service == 'bzr-order' and 'LEDGER_FILE' not in environment:
+        env['LEDGER_FILE'] = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'ledger.sqlite')
+    process = subprocess.Popen(servers[server], cwd=os.path.join(root_dir, service), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, timeout)
+    return process, f'http://127.0.0.1:{port}'
+
+
+# Start a catalog server as a separate process with its own temporary database
+# Returns the process and the address of the server
+def start_catalog(port=None, server='flask', timeout=30.0, **environment):
+    if 'DATABASE_FILE' not in environment:
+        environment['DATABASE_FILE'] = os.path.join(tempfile.mkdtemp(prefix='bzr-bench-'), 'db.sqlite')
+    return start_service('bzr-catalog', port=port, server=server, timeout=timeout, **environment)
+
+
+# Insert books directly into the database file (or the database URL) of a stopped catalog server
+def seed_books(database, count, start_id=1000, topics=100):
+    if '://' in database:
+        seed_books_url(database, count, start_id, topics)
+        return
+
+    connection = sqlite3.connect(database)
+    with connection:
+        connection.executemany('INSERT INTO book (id, title, topic, quantity, price, sequence_number) '
+                               'VALUES (?, ?, ?, ?, ?, 0)',
+                               ((start_id + i, f'Book {i}', f'Topic {i % topics}', 100, 10.0) for i in range(count)))
+    connection.close()
+
+
+def seed_books_url(url, count, start_id, topics):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        connection.execute(text('INSERT INTO book (id, title, topic, quantity, price, sequence_number) '
+                                'VALUES (:id, :title, :topic, 100, 10.0, 0)'),
+                           [{'id': start_id + i, 'title': f'Book {i}', 'topic': f'Topic {i % topics}'}
+                            for i in range(count)])
+    engine.dispose()
+
+
+# Return the value at the given percentile (0-100) of a list of samples
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+# Return the p50 and p99 of a list of samples, in milliseconds
+def summarize(samples):
+    return {'p50_ms': round(percentile(samples, 50) * 1000, 2), 'p99_ms': round(percentile(samples, 99) * 1000, 2)}
+
+
+# Serve empty JSON objects after a delay on the given listening socket, used by StandIn
+def serve_stand_in(listener, delay, body, capacity):
+    slots = threading.Semaphore(capacity) if capacity is not None else None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if length > 0:
+                self.rfile.read(length)
+            if slots is not None:
+                with slots:
+                    time.sleep(delay)
+            else:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_PUT = do_DELETE = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(listener.getsockname(), Handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+# A local HTTP server that answers every request with the same body (an empty JSON object by default) after a delay
+# Used as a stand-in for catalog replicas and the front end server
+# It runs in a separate process so that it does not compete with the measured service for the GIL
+# With a capacity, at most that many requests are served at the same time, like a server with limited resources
+class StandIn:
+
+    def __init__(self, delay: float = 0.0, body: bytes = b'{}', capacity: int = None):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1024)
+        self.address = f'http://127.0.0.1:{listener.getsockname()[1]}'
+        self.process = multiprocessing.Process(target=serve_stand_in, args=(listener, delay, body, capacity), daemon=True)
+        self.process.start()
+        listener.close()
+
+
+# A local socket that accepts connections but never answers
+# Used as a stand-in for a replica that hangs until the request times out
+class Blackhole:
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(1024)
+        self.address = f'http://127.0.0.1:{self.socket.getsockname()[1]}'
+
+
+# Stand-ins and blackholes are kept alive until the benchmark process exits
+kept_alive = []
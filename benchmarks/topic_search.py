@@ -0,0 +1,55 @@
+# Measures the latency of topic and title searches as the catalog grows
+# Every search is run with the full-text search index, and with the ILIKE scan of the book table it replaced
+#
+# Usage: python benchmarks/topic_search.py [--sizes 10000,100000,1000000] [--topics 1000] [--requests 50]
+
+from support import load_catalog, seed_books, summarize
+import argparse
+import json
+import random
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--topics', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    app = load_catalog()
+    from book import Book
+    from database import db
+    from flask_app import DATABASE_FILE
+
+    # Searches of one topic, of a topic by prefix, and of one title
+    searches = {
+        'topic': lambda: (f'Topic {random.randrange(args.topics)}', 'topic'),
+        'topic_prefix': lambda: (f'top {random.randrange(args.topics // 10)}', 'topic'),
+        'title': lambda: (f'Book {random.randrange(1000)}', 'title'),
+    }
+
+    seeded = 0
+    for size in sorted(int(size) for size in args.sizes.split(',')):
+        # Books are added to the same database, so each size only inserts the books it adds to the previous one
+        seed_books(DATABASE_FILE, size - seeded, start_id=1000 + seeded, topics=args.topics)
+        seeded = size
+
+        with app.app_context():
+            for name, search in searches.items():
+                result = {'books': size, 'search': name}
+                for mode, enabled in (('ilike', False), ('fts', True)):
+                    Book.search_index_enabled = enabled
+                    samples = []
+                    for _ in range(args.requests):
+                        query, column = search()
+                        start = time.perf_counter()
+                        Book.search(query, column=column).all()
+                        samples.append(time.perf_counter() - start)
+                    result[mode] = summarize(samples)
+                print(json.dumps(result))
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
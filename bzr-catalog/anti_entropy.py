@@ -0,0 +1,274 @@
+from flask_app import app, ANTI_ENTROPY_INTERVAL, ANTI_ENTROPY_BUCKETS
+from book import Book, LogRecord, record_change, dump_schema
+from database import db
+from replication import replication
+from requests import RequestException
+from flask import request, jsonify
+from bazar_common import http_client, metrics
+import hashlib
+import threading
+import time
+
+# 1 second timeout for all connection
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_REP_DIGEST and TIMEOUT_REP_ROWS variables)
+digest_endpoint = http_client.register_endpoint('rep.digest', 0.1, 1)
+rows_endpoint = http_client.register_endpoint('rep.rows', 0.1, 5)
+
+
+# 64-bit hash of a version of a book
+def book_hash(id, sequence_number) -> int:
+    return int.from_bytes(hashlib.sha1(f'{id}:{sequence_number}'.encode()).digest()[:8], 'big')
+
+
+# Digest of the whole book table
+# Books are split into buckets by their ID, and every bucket is summarized by the XOR of the hashes of its books
+# Two servers hold the same version of every book of a bucket if the hashes of that bucket are equal
+# The digest is kept up-to-date with the replication log instead of reading every book in every round:
+# a change of a book replaces the hash of its previous version with the hash of the new version
+# Every worker process keeps its own digest, and reads the changes of the other processes from the log
+# (like ResponseCache.synchronize)
+class Digest:
+
+    def __init__(self, buckets: int):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # Offset of the last record of the log applied to the digest, None until the whole table was read
+        self.offset = None
+
+        # Sequence number of every book, and hash of every bucket
+        self.sequence_numbers = {}
+        self.hashes = [0] * buckets
+
+        # Number of times the whole table was read
+        self.rebuilds = 0
+
+    # Set the sequence number of a book, the lock must be held
+    def set(self, id, sequence_number):
+        previous = self.sequence_numbers.get(id)
+        if previous == sequence_number:
+            return
+
+        bucket = id % self.buckets
+        if previous is not None:
+            self.hashes[bucket] ^= book_hash(id, previous)
+        self.hashes[bucket] ^= book_hash(id, sequence_number)
+        self.sequence_numbers[id] = sequence_number
+
+    # Read the whole table, the lock must be held
+    # The offset is read first, in the same transaction, so the changes committed later are applied from the log
+    def rebuild(self):
+        offset = LogRecord.last_offset()
+        self.sequence_numbers = {}
+        self.hashes = [0] * self.buckets
+        for id, sequence_number in db.session.query(Book.id, Book.sequence_number):
+            self.set(id, sequence_number)
+        self.offset = offset
+        self.rebuilds += 1
+
+    # Apply the changes recorded in the log since the last update
+    # The whole table is read again if some of the records were removed before they were applied
+    # (see CatchUp.truncate_log), or the offsets of the records have gaps, or the log was reset
+    def update(self):
+        if self.offset is None:
+            self.rebuild()
+            return
+
+        records = db.session.query(LogRecord.id, LogRecord.book_id, LogRecord.sequence_number) \
+            .filter(LogRecord.id > self.offset).order_by(LogRecord.id).all()
+        if len(records) == 0:
+            if LogRecord.last_offset() < self.offset:
+                self.rebuild()
+            return
+
+        # The offsets only grow, so they have no gaps if the records go from the next offset to the last one
+        if records[0].id != self.offset + 1 or records[-1].id != self.offset + len(records):
+            self.rebuild()
+            return
+
+        for record in records:
+            self.set(record.book_id, record.sequence_number)
+        self.offset = records[-1].id
+
+    def get(self) -> list:
+        with self.lock:
+            self.update()
+            return [f'{bucket_hash:016x}' for bucket_hash in self.hashes]
+
+
+# The digest of the buckets of this server, other numbers of buckets are computed from the whole table
+book_digest = Digest(ANTI_ENTROPY_BUCKETS)
+
+
+def digest(buckets: int) -> list:
+    return (book_digest if buckets == book_digest.buckets else Digest(buckets)).get()
+
+
+# Get all books of the given buckets
+def rows(buckets: int, bucket_ids: list) -> list:
+    return Book.query.filter(Book.bucket(buckets).in_(bucket_ids)).order_by(Book.id).all()
+
+
+# Background process that regularly compares the books of this server with all other servers
+# and pulls the books that are newer on other servers in bulk
+class AntiEntropy:
+
+    def __init__(self, replication, interval: float, buckets: int):
+        self.replication = replication
+        self.interval = interval
+        self.buckets = buckets
+        self.thread = None
+
+        # Reads are kept up-to-date by this process, so they do not need to wait for other servers
+        # This is set in every worker process, while the process itself only runs in the leader (see app.py)
+        if self.enabled():
+            self.replication.read_repair = False
+
+        # Counters of the synchronization
+        self.lock = threading.Lock()
+        self.stats = {
+            'rounds': 0,
+            # Bytes of digests and books received from other servers, and served to other servers
+            'bytes_received': 0,
+            'bytes_sent': 0,
+            # Number of buckets found to be different, and number of newer books pulled from other servers
+            'divergent_buckets': 0,
+            'rows_pulled': 0,
+            # Time when this server first differed from another server since it last converged
+            'diverged_since': None,
+            # Number of seconds the last divergence took to converge
+            'last_convergence_seconds': None,
+            'last_round_seconds': None,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Whether synchronization is enabled and there are other servers
+    def enabled(self) -> bool:
+        return self.interval > 0 and len(self.replication.catalog_addresses) > 0
+
+    # Start the background thread, if synchronization is enabled
+    def start(self):
+        if not self.enabled():
+            return
+
+        self.thread = threading.Thread(target=self.run, name='anti-entropy', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with app.app_context():
+                try:
+                    self.synchronize()
+
+                # Keep synchronizing in the next rounds even if this round failed
+                except Exception:
+                    app.logger.exception('Anti-entropy round failed')
+                finally:
+                    db.session.remove()
+
+    # Run one round of synchronization with every other server
+    def synchronize(self):
+        start = time.monotonic()
+        converged = True
+        for server in self.replication.catalog_addresses:
+            try:
+                if not self.synchronize_with(server):
+                    converged = False
+
+            # Ignore non-alive servers
+            except RequestException:
+                metrics.peer_failures.inc(server, 'anti_entropy')
+
+        now = time.time()
+        with self.lock:
+            self.stats['rounds'] += 1
+            self.stats['last_round_seconds'] = round(time.monotonic() - start, 6)
+            if not converged and self.stats['diverged_since'] is None:
+                self.stats['diverged_since'] = now
+            elif converged and self.stats['diverged_since'] is not None:
+                self.stats['last_convergence_seconds'] = round(now - self.stats['diverged_since'], 6)
+                self.stats['diverged_since'] = None
+
+    # Compare the digests of this server and another server, and pull the newer books of all different buckets
+    # Returns whether both servers already held the same books
+    def synchronize_with(self, server) -> bool:
+        response = http_client.get(f'{server}/rep/digest', digest_endpoint, params={'buckets': self.buckets})
+        self.count('bytes_received', len(response.content))
+        if response.status_code != 200:
+            return True
+
+        remote_digest = response.json()['digest']
+        local_digest = digest(self.buckets)
+        divergent = [bucket for bucket in range(self.buckets) if remote_digest[bucket] != local_digest[bucket]]
+        if len(divergent) == 0:
+            return True
+
+        self.count('divergent_buckets', len(divergent))
+
+        # Books of different buckets can no longer be assumed to be up-to-date,
+        # so the next update of any of them checks all other servers first
+        self.replication.updated_ids.difference_update(
+            [id for id in list(self.replication.updated_ids) if int(id) % self.buckets in divergent])
+
+        response = http_client.get(f'{server}/rep/rows', rows_endpoint,
+                                   params={'buckets': self.buckets, 'ids': ','.join(map(str, divergent))})
+        self.count('bytes_received', len(response.content))
+        if response.status_code != 200:
+            return False
+
+        # Apply all books that are newer on the other server in a single transaction
+        local_books = {book.id: book for book in rows(self.buckets, divergent)}
+        pulled = 0
+        for item in response.json()['books']:
+            book = local_books.get(item['id'])
+            if book is None:
+                book = Book(item['title'], item['topic'], item['quantity'], item['price'])
+                book.id = item['id']
+                book.sequence_number = item['sequence_number']
+                db.session.add(book)
+                record_change(book, topic_changed=True, replicated=True)
+                pulled += 1
+            elif book.sequence_number < item['sequence_number']:
+                Book.update(item['id'], commit=False, title=item['title'], quantity=item['quantity'],
+                            topic=item['topic'], price=item['price'], sequence_number=item['sequence_number'],
+                            replicated=True)
+                pulled += 1
+        db.session.commit()
+
+        self.count('rows_pulled', pulled)
+        return False
+
+
+anti_entropy = AntiEntropy(replication, ANTI_ENTROPY_INTERVAL, ANTI_ENTROPY_BUCKETS)
+
+
+@app.route('/rep/digest', methods=['GET'])
+def replication_digest():
+    buckets = int(request.args.get('buckets', ANTI_ENTROPY_BUCKETS))
+    response = jsonify({'digest': digest(buckets)})
+    anti_entropy.count('bytes_sent', response.content_length)
+    return response
+
+
+@app.route('/rep/rows', methods=['GET'])
+def replication_rows():
+    buckets = int(request.args.get('buckets', ANTI_ENTROPY_BUCKETS))
+    bucket_ids = [int(bucket) for bucket in request.args.get('ids', '').split(',') if bucket.strip() != '']
+    response = jsonify({'books': dump_schema.dump(rows(buckets, bucket_ids))})
+    anti_entropy.count('bytes_sent', response.content_length)
+    return response
+
+
+# Anti-entropy statistics endpoint
+@app.route('/stats/anti-entropy', methods=['GET'])
+def anti_entropy_stats():
+    with anti_entropy.lock:
+        return {**anti_entropy.stats, 'digest_rebuilds': book_digest.rebuilds}
+
+
+metrics.register_stats('anti-entropy', anti_entropy_stats)
@@ -6,11 +6,57 @@ import errorhandles
 
 # Import the routes
 import routes
+import importer
+
+# This creates and migrates the database
+# If it was just created, it copies the books of another catalog server, or adds the initial books if none answers
+from database import create_database, reset_database, database_lock
+from snapshot import snapshots
+create_database(restore=snapshots.bootstrap)
+
+from cache import publisher
+from replication_log import catch_up
+from anti_entropy import anti_entropy
+from escrow import escrow
+from workers import Leader
+from bazar_common import http_client
+
+# The process that holds the leader lock runs the background processes, the lock is held as long as this object lives
+leader = Leader(database_lock('leader'))
+
+
+# Start the background processes that run once per server
+def start_leader():
+    # Catch up with the replication logs of the other catalog servers in the background
+    catch_up.start()
+
+    # Start synchronizing the books with the other catalog servers in the background
+    anti_entropy.start()
+
+    # Start rebalancing the escrow shares with the other catalog servers in the background
+    escrow.start()
+
+
+# Start the threads of this process
+# When the server runs several worker processes, this is called in every worker (see gunicorn.conf.py)
+def start():
+    # Start sending cache invalidations to the front end server in the background
+    publisher.start()
+
+    # The background processes that change books run in only one of the processes
+    leader.start(start_leader)
+
+
+# Start a worker process of gunicorn, after it loaded the application
+# With preloading, the application was loaded by the parent process before forking the worker,
+# so its connections are dropped and its threads (which are not carried over) are started again
+def start_worker():
+    reset_database()
+    http_client.reset()
+    start()
 
-# This creates the database file if it does not exist and adds the books to it
-from database import create_database
-create_database()
 
 # Run Flask application instance
 if __name__ == '__main__':
+    start()
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,201 @@
+from flask_app import SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, \
+    SQLITE_BUSY_TIMEOUT, DATABASE_POOL_SIZE
+from sqlalchemy import event, func, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+from workers import FileLock, AdvisoryLock
+from contextlib import contextmanager
+import sqlite3
+
+# Storage backends of the catalog database, chosen by the scheme of the database URL (see flask_app.py)
+# A backend holds everything that depends on the database server:
+#   1. The engine options, and the settings applied to every new connection
+#   2. The locks shared by the processes that use the database
+#   3. The full-text search index of the titles and topics of books
+#   4. The statement that decrements the stock of a book and returns the updated book
+#   5. The time the statements of a transaction wait for the locks of other transactions
+
+
+# Engine options shared by all backends
+# Keep a pool of open connections shared by all threads, instead of opening a connection for every request
+def pool_options():
+    if DATABASE_POOL_SIZE <= 0:
+        return {'poolclass': NullPool}
+    return {'poolclass': QueuePool, 'pool_size': DATABASE_POOL_SIZE, 'max_overflow': DATABASE_POOL_SIZE}
+
+
+# SQLite database file, shared by the processes of a single host
+# SQLite allows a single writer at a time, writes of other connections wait for it (see SQLITE_BUSY_TIMEOUT)
+class SQLiteBackend:
+
+    def __init__(self, url):
+        self.url = url
+
+        # SQLite returns the rows changed by an UPDATE statement since version 3.35
+        # RETURNING does not apply the type of the column, so whole prices would be returned as integers without the cast
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            self.decrement_statement = text(
+                'UPDATE book SET quantity = quantity - :amount, sequence_number = sequence_number + 1 '
+                'WHERE id = :id AND quantity >= :amount '
+                'RETURNING id, title, topic, quantity, CAST(price AS REAL) AS price, sequence_number')
+        else:
+            self.decrement_statement = None
+
+    # Every connection keeps up to 256 prepared statements, so the statements of the hot paths are compiled once
+    def engine_options(self):
+        return {
+            'connect_args': {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT, 'cached_statements': 256},
+            **pool_options(),
+        }
+
+    def configure_engine(self, engine):
+        event.listen(engine, 'connect', self.configure_connection)
+
+    # Apply the SQLite settings of flask_app.py to a new connection
+    def configure_connection(self, connection, connection_record):
+        cursor = connection.cursor()
+        cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        # A negative cache size is a number of kibibytes instead of pages
+        cursor.execute(f'PRAGMA cache_size={-(SQLITE_CACHE_SIZE // 1024)}')
+        cursor.close()
+
+    # The processes that share the database file lock files next to it
+    def lock(self, engine, name):
+        return FileLock(f'{self.url.database}.{name}.lock')
+
+    # Wait at most the given number of seconds for the write lock in the statements run inside the block
+    # A statement that waits longer raises OperationalError (database is locked)
+    @contextmanager
+    def lock_timeout(self, session, seconds):
+        connection = session.connection()
+        connection.exec_driver_sql(f'PRAGMA busy_timeout={int(seconds * 1000)}')
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql(f'PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}')
+
+    # Full-text search index of the titles and topics of books
+    # SQLite keeps it in sync with the book table through triggers, quantity and price updates do not touch it
+    search_index_statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5(title, topic, content='book', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS book_search_insert AFTER INSERT ON book BEGIN "
+        "INSERT INTO book_search(rowid, title, topic) VALUES (new.id, new.title, new.topic); END",
+        "CREATE TRIGGER IF NOT EXISTS book_search_delete AFTER DELETE ON book BEGIN "
+        "INSERT INTO book_search(book_search, rowid, title, topic) VALUES ('delete', old.id, old.title, old.topic); END",
+        "CREATE TRIGGER IF NOT EXISTS book_search_update AFTER UPDATE OF title, topic ON book BEGIN "
+        "INSERT INTO book_search(book_search, rowid, title, topic) VALUES ('delete', old.id, old.title, old.topic); "
+        "INSERT INTO book_search(rowid, title, topic) VALUES (new.id, new.title, new.topic); END",
+    ]
+
+    # Create the search index, and index the books that were added before it existed
+    # If SQLite was built without FTS5, no index is created and searches scan the book table instead
+    def create_search_index(self, session):
+        try:
+            for statement in self.search_index_statements:
+                session.execute(text(statement))
+            session.execute(text("INSERT INTO book_search(book_search) VALUES ('rebuild')"))
+            session.commit()
+        except OperationalError:
+            session.rollback()
+
+    # Stop updating the search index while many books are added, create_search_index indexes them all at once
+    # The index is kept, so searches still find the books that were added before
+    def drop_search_index(self, session):
+        for trigger in ('book_search_insert', 'book_search_delete', 'book_search_update'):
+            session.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+        session.commit()
+
+    def search_index_exists(self, session):
+        return session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'book_search'")).first() is not None
+
+    # Condition of the books whose column contains words starting with every given word
+    def search_filter(self, table, column, words):
+        match = f'{column} : (' + ' '.join(f'"{word}"*' for word in words) + ')'
+        return text(f'{table.name}.id IN (SELECT rowid FROM book_search WHERE book_search MATCH :match)') \
+            .bindparams(match=match)
+
+
+# PostgreSQL server, which can be shared by the processes of several hosts
+# Writers only wait for each other when they change the same rows
+class PostgresBackend:
+
+    def __init__(self, url):
+        self.url = url
+
+    # Statement of the purchase hot path, which decrements the stock of a book and returns the updated book
+    # The UPDATE locks the row, so a concurrent purchase of the same book waits, then checks the stock again
+    decrement_statement = text(
+        'UPDATE book SET quantity = quantity - :amount, sequence_number = sequence_number + 1 '
+        'WHERE id = :id AND quantity >= :amount '
+        'RETURNING id, title, topic, quantity, price, sequence_number')
+
+    # Connections are checked before they are used, since the server may close them (e.g. when it restarts)
+    def engine_options(self):
+        return {'pool_pre_ping': True, **pool_options()}
+
+    def configure_engine(self, engine):
+        pass
+
+    # The processes that share the database can run on other hosts, so they use advisory locks of the server
+    def lock(self, engine, name):
+        return AdvisoryLock(engine, f'bazar.catalog.{name}')
+
+    # Wait at most the given number of seconds for row locks in the rest of the transaction
+    # A statement that waits longer raises OperationalError (lock timeout), which aborts the transaction, so the
+    # setting ends with it instead of being restored after the block
+    @contextmanager
+    def lock_timeout(self, session, seconds):
+        session.execute(text(f"SET LOCAL lock_timeout = '{int(seconds * 1000)}ms'"))
+        yield
+
+    # Full-text search indexes of the titles and topics of books, which PostgreSQL keeps in sync with the book table
+    # The 'simple' configuration splits words without stemming them, like the SQLite index
+    search_index_statements = [
+        "CREATE INDEX IF NOT EXISTS book_title_search ON book USING gin (to_tsvector('simple', title))",
+        "CREATE INDEX IF NOT EXISTS book_topic_search ON book USING gin (to_tsvector('simple', topic))",
+    ]
+
+    def create_search_index(self, session):
+        for statement in self.search_index_statements:
+            session.execute(text(statement))
+        session.commit()
+
+    # Drop the search indexes while many books are added, create_search_index indexes them all at once
+    # Searches scan the book table in the meantime
+    def drop_search_index(self, session):
+        session.execute(text('DROP INDEX IF EXISTS book_title_search'))
+        session.execute(text('DROP INDEX IF EXISTS book_topic_search'))
+        session.commit()
+
+    def search_index_exists(self, session):
+        return session.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'book_topic_search'")).first() \
+            is not None
+
+    # Condition of the books whose column contains words starting with every given word
+    # The expression must be the same as the expression of the index, so that the index is used
+    def search_filter(self, table, column, words):
+        query = ' & '.join(f'{word}:*' for word in words)
+        return func.to_tsvector(text("'simple'"), table.c[column]).op('@@')(func.to_tsquery(text("'simple'"), query))
+
+
+# Backend of every URL scheme
+backends = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgresBackend,
+    'postgres': PostgresBackend,
+}
+
+
+# Create the backend of a database URL
+def create_backend(url):
+    url = make_url(url)
+    if url.get_backend_name() not in backends:
+        raise ValueError(f'Unsupported database: {url.get_backend_name()} (supported: {", ".join(backends)})')
+
+    # SQLAlchemy only accepts the postgresql scheme
+    if url.get_backend_name() == 'postgres':
+        url = url.set(drivername=url.drivername.replace('postgres', 'postgresql', 1))
+    return backends[url.get_backend_name()](url)
@@ -1,4 +1,175 @@
-from database import db, marshmallow, database_init
+from flask_app import SHARDS, SHARD, SHARD_VIRTUAL_NODES, ANTI_ENTROPY_BUCKETS
+from database import db, marshmallow, backend, database_init, database_migrations, database_setup
+from bazar_common.sharding import Ring
+from serialization import CompiledSchema
+from sqlalchemy import select, update, inspect, text, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+import json
+import re
+import time
+from response_cache import invalidate_book, invalidate_new_books
+
+
+# Define the replication log, an append-only table with a record of every change of a book
+# Each record holds the whole book after the change, so records can be applied in any server in order of their offset
+class LogRecord(db.Model):
+    __tablename__ = 'replication_log'
+
+    # The offset of the record in the log
+    id = db.Column(db.Integer, primary_key=True)
+
+    # The book after the change
+    book_id = db.Column(db.Integer, nullable=False, index=True)
+    sequence_number = db.Column(db.Integer, nullable=False,)
+    title = db.Column(db.String(200), nullable=False,)
+    topic = db.Column(db.String(200), nullable=False,)
+    quantity = db.Column(db.Integer, nullable=False,)
+    price = db.Column(db.Float, nullable=False)
+
+    # Whether the change was copied from another server, which holds the change in its own log
+    # Such records are only kept for the response caches of the other worker processes (see response_cache.py),
+    # and are not sent to the other servers, so a change is not sent back to the server it was copied from
+    replicated = db.Column(db.Boolean, nullable=False, default=False)
+
+    # Static method to add a record of a book to the log, in the transaction that changed the book
+    # The record is inserted with a Core statement, without creating an ORM object
+    @classmethod
+    def append(cls, book, replicated=False):
+        db.session.execute(LogRecord.__table__.insert(), {
+            'book_id': book.id,
+            'sequence_number': book.sequence_number,
+            'title': book.title,
+            'topic': book.topic,
+            'quantity': book.quantity,
+            'price': book.price,
+            'replicated': replicated,
+        })
+
+    # Static method to add records of many new books to the log with a single statement
+    # rows are dicts of all fields of the books, including their IDs
+    @classmethod
+    def append_many(cls, rows, replicated=False):
+        db.session.execute(LogRecord.__table__.insert(), [{
+            'book_id': row['id'],
+            'sequence_number': row['sequence_number'],
+            'title': row['title'],
+            'topic': row['topic'],
+            'quantity': row['quantity'],
+            'price': row['price'],
+            'replicated': replicated,
+        } for row in rows])
+
+    # Static method to remove the records up to an offset, without committing
+    # Returns the number of removed records
+    @classmethod
+    def truncate(cls, offset):
+        return db.session.execute(LogRecord.__table__.delete().where(LogRecord.id <= offset)).rowcount
+
+    # Static method to get the records after an offset, in order
+    @classmethod
+    def after(cls, offset):
+        return LogRecord.query.filter(LogRecord.id > offset).order_by(LogRecord.id)
+
+    # Static method to get the offset of the last record
+    @classmethod
+    def last_offset(cls):
+        return db.session.query(db.func.max(LogRecord.id)).scalar() or 0
+
+    # Static method to get the books changed after an offset
+    # Returns (book ID, whether the title or topic changed) pairs, a book without an earlier record is a new book
+    # Every record is read with the previous record of its book in a single query, the previous record is found with
+    # the index of the book IDs
+    @classmethod
+    def changes_after(cls, offset):
+        previous = aliased(LogRecord)
+        earlier = aliased(LogRecord)
+        previous_id = select(db.func.max(earlier.id)) \
+            .where(earlier.book_id == LogRecord.book_id, earlier.id < LogRecord.id) \
+            .scalar_subquery()
+        rows = db.session.query(LogRecord.book_id, LogRecord.title, LogRecord.topic, previous.title, previous.topic) \
+            .outerjoin(previous, previous.id == previous_id) \
+            .filter(LogRecord.id > offset) \
+            .order_by(LogRecord.id)
+        return [(book_id, (previous_title, previous_topic) != (title, topic))
+                for book_id, title, topic, previous_title, previous_topic in rows]
+
+
+# Define the offset of the last record applied from the replication log of every other server
+class LogOffset(db.Model):
+    __tablename__ = 'replication_offset'
+
+    server = db.Column(db.String(200), primary_key=True)
+    offset = db.Column(db.Integer, nullable=False, default=0,)
+
+
+# Define the offset of the last record of the replication log of this server read by every other server
+# The records that every other server has read are removed from the log (see replication_log.py)
+class LogReader(db.Model):
+    __tablename__ = 'replication_reader'
+
+    server = db.Column(db.String(200), primary_key=True)
+    offset = db.Column(db.Integer, nullable=False, default=0,)
+
+
+# Define the purchases made with an idempotency key (Idempotency-Key header), sent by the order servers with the
+# idempotency key of their orders (see ledger.py of the order service)
+# A purchase with a key that was already used is not made again, and gets the response of the first purchase, so an
+# order server can send an order again when it does not know whether the first attempt bought the books
+# Keys are only known by the server that made the purchase, every order server sends the purchases of a book to the
+# same server of its group (the primary)
+class PurchaseKey(db.Model):
+    __tablename__ = 'purchase_key'
+
+    key = db.Column(db.String(200), primary_key=True)
+
+    # Books of the purchase, as a JSON object of book IDs and number of copies
+    items = db.Column(db.Text, nullable=False)
+
+    # Response of the purchase, the status is NULL while the purchase is made, and stays NULL if the server stopped
+    # before its response was recorded: the outcome of the purchase is unknown, so it is never made again
+    status = db.Column(db.Integer)
+    response = db.Column(db.LargeBinary)
+    content_type = db.Column(db.String(200))
+    created = db.Column(db.Float, nullable=False)
+
+    # Static method to record a purchase with a key before it is made, and commit it
+    # Returns False if the key was already used
+    @classmethod
+    def begin(cls, key, items) -> bool:
+        try:
+            db.session.execute(PurchaseKey.__table__.insert(), {'key': key, 'items': json.dumps(items),
+                                                                'created': time.time()})
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    # Static method to record the response of a purchase recorded with begin, and commit it
+    @classmethod
+    def complete(cls, key, response):
+        db.session.execute(update(PurchaseKey.__table__).where(PurchaseKey.__table__.c.key == key).values(
+            status=response.status_code, response=response.get_data(), content_type=response.content_type))
+        db.session.commit()
+
+    # Static method to remove a purchase recorded with begin that was not made, so its key can be used again
+    @classmethod
+    def release(cls, key):
+        db.session.execute(PurchaseKey.__table__.delete().where(PurchaseKey.__table__.c.key == key))
+        db.session.commit()
+
+    @classmethod
+    def find(cls, key):
+        return db.session.execute(select(PurchaseKey.__table__).where(PurchaseKey.__table__.c.key == key)).first()
+
+
+# Record a change of a book in the transaction that changed it
+# The change is added to the replication log, and the cached responses of the book are invalidated once committed
+# replicated is True for a change copied from another server
+def record_change(book, topic_changed=False, replicated=False):
+    LogRecord.append(book, replicated)
+    invalidate_book(book.id, topic_changed)
 
 
 # Define the Book class that overrides SQLAlchemy's Model class
@@ -21,24 +192,86 @@ class Book(db.Model):
         self.price = price
         self.sequence_number = 0
 
-    # Static method to search for books based on the topic
+    # Whether the full-text search index is available, it is checked when the server starts
+    search_index_enabled = False
+
+    # Static method to search for books based on the topic (or the title)
+    # Returns books whose topic contains words starting with every word of the query string, ignoring case
+    # e.g. "dist sys" matches "Distributed Systems"
+    @classmethod
+    def search(cls, topic, column='topic'):
+        words = re.findall(r'\w+', topic)
+
+        # Without the search index, return books that contain the query string, ignoring case
+        if not Book.search_index_enabled or len(words) == 0:
+            return Book.query.filter(getattr(Book, column).ilike(f'%{topic}%')).order_by(Book.id)
+
+        return Book.query.filter(backend.search_filter(Book.__table__, column, words)).order_by(Book.id)
+
+    # Ring of the shard groups the books are split across (see bazar_common/sharding.py)
+    ring = Ring(SHARDS, SHARD_VIRTUAL_NODES) if len(SHARDS) > 0 else None
+
+    # Whether a book belongs to the shard group of this server, every book does if the books are not sharded
     @classmethod
-    def search(cls, topic):
-        # Returns books that contain the query string, ignoring case
-        return Book.query.filter(Book.topic.ilike(f'%{topic}%'))
+    def owned(cls, id) -> bool:
+        return Book.ring is None or Book.ring.owner(id) == SHARD
 
     # Static method to get a book using its ID
+    # The book is read with a Core statement and returned as a read-only row, without loading an ORM object
+    # Use Book.update to change it
     @classmethod
     def get(cls, id):
-        return Book.query.get(id)
+        # IDs are passed as strings from the URIs, a string that is not a number is not the ID of any book
+        try:
+            id = int(id)
+        except ValueError:
+            return None
+        return db.session.execute(select(Book.__table__).where(Book.__table__.c.id == id)).first()
+
+    # Static method to get many books using their IDs in a single query
+    @classmethod
+    def get_many(cls, ids):
+        return Book.query.filter(Book.id.in_(ids)).all()
+
+    # Static method to add many new books with a single statement, and record them in the replication log
+    # rows are dicts of all fields of the books, including their IDs
+    # If commit is False, the caller is responsible for committing the transaction
+    # replicated is True when the books were copied from another server (see LogRecord.replicated)
+    @classmethod
+    def insert_many(cls, rows, commit=True, replicated=False):
+        if len(rows) == 0:
+            return
+        db.session.execute(Book.__table__.insert(), rows)
+        LogRecord.append_many(rows, replicated)
+        invalidate_new_books()
+
+        if commit:
+            db.session.commit()
+
+    # Static method to get the bucket of the books when they are split into a number of buckets (see anti_entropy.py)
+    # The number is written into the statement instead of being bound, so that the index of the buckets can be used
+    @classmethod
+    def bucket(cls, buckets: int):
+        return Book.id % literal_column(str(int(buckets)))
+
+    # Static method to get the ID of the last book
+    @classmethod
+    def last_id(cls):
+        return db.session.query(db.func.max(Book.id)).scalar() or 0
 
     # Static method to update the fields of a book given its ID
     # If the field is not passed (or passed as None), it will not be affected
+    # If commit is False, the caller is responsible for committing the transaction
+    # The row of the book is locked until the transaction ends, so concurrent changes of the book are not lost
+    # (SQLite locks the whole database when the book is written instead)
+    # replicated is True when the fields were copied from another server (see LogRecord.replicated)
     @classmethod
-    def update(cls, id, title=None, quantity=None, topic=None, price=None, sequence_number=None):
-        book = Book.query.get(id)
+    def update(cls, id, title=None, quantity=None, topic=None, price=None, sequence_number=None, commit=True,
+               replicated=False):
+        book = Book.query.filter(Book.id == id).with_for_update().populate_existing().first()
         if book is None:
             return None
+        topic_changed = (title is not None and title != book.title) or (topic is not None and topic != book.topic)
         book.title = title if title is not None else book.title
         book.quantity = quantity if quantity is not None and quantity >= 0 else book.quantity
         book.topic = topic if topic is not None else book.topic
@@ -51,17 +284,134 @@ class Book(db.Model):
         else:
             book.sequence_number = sequence_number
 
-        db.session.commit()
+        # Record the change
+        record_change(book, topic_changed, replicated)
+
+        if commit:
+            db.session.commit()
         return book
 
-    # Dump method to view all rows
+    # Static method to buy copies of a book given its ID
+    # Checking the stock and decrementing it is done in a single UPDATE statement,
+    # so concurrent purchases can never sell more copies than there are in stock
+    # Returns the updated book, or None if the book does not exist or does not have enough copies
+    # If commit is False, the caller is responsible for committing or rolling back the transaction
+    @classmethod
+    def purchase(cls, id, amount=1, commit=True):
+        book = Book.decrement(id, amount)
+        if book is not None:
+            record_change(book)
+
+        if commit:
+            db.session.commit()
+        return book
+
+    # Static method to decrement the stock of a book, if it has enough copies
+    # Returns the updated book as a read-only row, or None if the stock was not decremented
+    @classmethod
+    def decrement(cls, id, amount):
+        # Update and read the book with a single statement, if the backend supports it
+        if backend.decrement_statement is not None:
+            return db.session.execute(backend.decrement_statement, {'id': id, 'amount': amount}).first()
+
+        table = Book.__table__
+        purchased = db.session.execute(update(table)
+                                       .where(table.c.id == id, table.c.quantity >= amount)
+                                       .values(quantity=table.c.quantity - amount,
+                                               sequence_number=table.c.sequence_number + 1)).rowcount
+        return Book.get(id) if purchased > 0 else None
+
+    # Static method to take the next version of a book for an update sent by another server, without committing
+    # The sequence number is only changed if the book is not newer than the version the update was made from,
+    # checked and changed by a single statement, so an update cannot overwrite a version written after it was checked
+    # (the statement locks the book, or the whole database with SQLite, until the transaction ends)
+    @classmethod
+    def claim(cls, id, sequence_number) -> bool:
+        table = Book.__table__
+        return db.session.execute(update(table).where(table.c.id == id, table.c.sequence_number <= sequence_number)
+                                  .values(sequence_number=sequence_number + 1)).rowcount == 1
+
+    # Static method to buy copies of many books in a single transaction
+    # items maps each book ID to the number of copies to buy
+    # Either all books are bought, or none of them if any book does not have enough copies
+    # Returns the IDs of the books that do not have enough copies
+    # The books are updated (and their rows locked) in order of their IDs,
+    # so two purchases of the same books cannot wait for each other's locks forever (deadlock)
+    @classmethod
+    def purchase_many(cls, items, commit=True):
+        out_of_stock = []
+        for id, amount in sorted(items.items()):
+            purchased = Book.query.filter(Book.id == id, Book.quantity >= amount) \
+                .update({Book.quantity: Book.quantity - amount, Book.sequence_number: Book.sequence_number + 1},
+                        synchronize_session=False)
+            if purchased == 0:
+                out_of_stock.append(id)
+
+        if len(out_of_stock) > 0:
+            db.session.rollback()
+            return out_of_stock
+
+        # Reload the books from the database in the same transaction, and record the changes
+        db.session.expire_all()
+        for id in items:
+            record_change(Book.query.get(id))
+
+        if commit:
+            db.session.commit()
+        return out_of_stock
+
+    # Dump method to view all rows, in order of their IDs
     @classmethod
     def dump(cls):
-        return Book.query.all()
+        return Book.query.order_by(Book.id)
+
+
+# Create the search index of the titles and topics of books, and index the books that were added before it existed
+def create_search_index():
+    backend.create_search_index(db.session)
+
+
+# Create the indexes of the replication log in databases that were created before the indexes were added
+def create_log_indexes():
+    for index in LogRecord.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+# Add the column of the records copied from other servers to replication logs created before it was added
+def add_log_replicated():
+    if 'replicated' not in {column['name'] for column in inspect(db.engine).get_columns('replication_log')}:
+        db.session.execute(text('ALTER TABLE replication_log ADD COLUMN replicated BOOLEAN NOT NULL DEFAULT FALSE'))
+
+
+database_migrations += [
+    create_log_indexes,
+    create_search_index,
+    add_log_replicated,
+]
+
+
+# Use the search index if it exists
+def enable_search_index():
+    Book.search_index_enabled = backend.search_index_exists(db.session)
+
+
+# Index the books by their anti-entropy bucket, so the books of a few buckets are read without reading the whole table
+# The index depends on the number of buckets, which may change between two starts of the server
+def create_bucket_index():
+    db.session.execute(text(f'CREATE INDEX IF NOT EXISTS book_bucket_{ANTI_ENTROPY_BUCKETS} '
+                            f'ON book ((id % {ANTI_ENTROPY_BUCKETS}))'))
+    db.session.commit()
+
+
+database_setup += [
+    enable_search_index,
+    create_bucket_index,
+]
 
 
 # Add the 7 books as an initial entry to the database
-database_init += [
+# The books have the IDs 1 to 7, and only the books of the shard group of this server are added
+initial_books = [
     Book('How to get a good grade in DOS in 20 minutes a day', 'Distributed Systems', 10, 25.00),
     Book('RPCs for Dummies', 'Distributed Systems', 5, 50.00),
     Book('Xen and the Art of Surviving Graduate School', 'Graduate School', 10, 15.00),
@@ -70,6 +420,9 @@ database_init += [
     Book('Why theory classes are so hard', 'University Problems', 25, 10.00),
     Book('Spring in the Pioneer Valley', 'Developer Life', 25, 10.00),
 ]
+for id, book in enumerate(initial_books, 1):
+    book.id = id
+database_init += [book for book in initial_books if Book.owned(book.id)]
 
 
 # Define Marshmallow Formatter Schema class for query-by-topic response fields
@@ -84,6 +437,12 @@ class ItemSchema(marshmallow.Schema):
         fields = ('title', 'quantity', 'price')
 
 
+# Define Marshmallow Formatter Schema class for batch query-by-item response fields
+class ItemsSchema(marshmallow.Schema):
+    class Meta:
+        fields = ('id', 'title', 'quantity', 'price')
+
+
 # Define Marshmallow Formatter Schema class for update response fields
 class UpdateSchema(marshmallow.Schema):
     class Meta:
@@ -96,11 +455,12 @@ class ReplicationSchema(marshmallow.Schema):
         fields = ('sequence_number', 'title', 'quantity', 'topic', 'price')
 
 
-# Instantiate an object from each schema class
-item_schema = ItemSchema()
-topic_schema = TopicSchema(many=True)
-update_schema = UpdateSchema()
-replication_schema = ReplicationSchema()
+# Instantiate an object from each schema class, compiled into a faster encoder of the same JSON (see serialization.py)
+item_schema = CompiledSchema(ItemSchema())
+items_schema = CompiledSchema(ItemsSchema(many=True))
+topic_schema = CompiledSchema(TopicSchema(many=True))
+update_schema = CompiledSchema(UpdateSchema())
+replication_schema = CompiledSchema(ReplicationSchema())
 
 
 # Dump
@@ -109,4 +469,13 @@ class DumpSchema(marshmallow.Schema):
         fields = ('id', 'sequence_number', 'title', 'quantity', 'topic', 'price')
 
 
-dump_schema = DumpSchema(many=True)
\ No newline at end of file
+dump_schema = CompiledSchema(DumpSchema(many=True))
+
+
+# Replication log
+class LogRecordSchema(marshmallow.Schema):
+    class Meta:
+        fields = ('id', 'book_id', 'sequence_number', 'title', 'topic', 'quantity', 'price')
+
+
+log_record_schema = LogRecordSchema()
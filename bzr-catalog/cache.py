@@ -1,13 +1,151 @@
-from flask_app import FRONT_END_ADDRESS
-import requests
+from flask_app import FRONT_END_ADDRESS, INVALIDATION_WINDOW, INVALIDATION_BATCH, INVALIDATION_RETRIES, \
+    INVALIDATION_QUEUE, app
+from fanout import FanOut
+from collections import OrderedDict
+from bazar_common import http_client, metrics, tracing
+import threading
+import time
+
+# 1 second timeout for all connection
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_INVALIDATE variable)
+invalidate_endpoint = http_client.register_endpoint('invalidate', 0.1, 1)
+
+
+# Sends invalidation requests to the front end server in the background
+# Requests to invalidate the same key within a short window are sent only once,
+# and pending keys are sent in batches of concurrent requests
+class InvalidationPublisher:
+
+    def __init__(self, address, window: float, batch_size: int, retries: int, max_queue: int):
+        self.address = address
+        self.window = window
+        self.batch_size = batch_size
+        self.retries = retries
+        self.max_queue = max_queue
+        self.thread = None
+        self.fan_out = FanOut(8, 'invalidation')
+
+        # Keys waiting to be sent, mapped to the number of times sending them failed
+        self.pending = OrderedDict()
+
+        # Spans of the traced requests that queued keys, the invalidations of a key are part of the trace of the
+        # request that queued it first
+        self.spans = {}
+        self.condition = threading.Condition()
+
+        self.stats = {
+            # Keys added to the queue, and keys that were already waiting in the queue
+            'queued': 0,
+            'coalesced': 0,
+            # Keys sent to the front end, failed attempts that were retried, and keys that were given up on
+            'sent': 0,
+            'retried': 0,
+            'dropped': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+        }
+
+    # Start the background thread, if there is a front end server to send invalidations to
+    def start(self):
+        if self.address is None:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='invalidation', daemon=True)
+        self.thread.start()
+
+    # Add a key to the queue, this never waits for the front end server
+    def publish(self, kind, value):
+        if self.address is None:
+            return
+
+        key = (kind, str(value))
+        with self.condition:
+            if key in self.pending:
+                self.stats['coalesced'] += 1
+            elif len(self.pending) >= self.max_queue:
+                self.stats['dropped'] += 1
+            else:
+                self.pending[key] = 0
+                self.stats['queued'] += 1
+                span = tracing.current()
+                if span is not None:
+                    self.spans[key] = span
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            # Wait for the first key, then for the window, so that duplicate keys are collapsed
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+            time.sleep(self.window)
+
+            with self.condition:
+                batch = {}
+                while len(self.pending) > 0 and len(batch) < self.batch_size:
+                    key, failures = self.pending.popitem(last=False)
+                    batch[key] = failures
+
+            self.send(batch)
+
+    # Send a batch of keys concurrently, keys that failed are queued again until they run out of retries
+    def send(self, batch):
+        def send_key(key):
+            kind, value = key
+            with self.condition:
+                span = self.spans.get(key)
+            # The request runs in a copy of the context of the publisher thread (see FanOut.broadcast),
+            # so the span does not need to be deactivated
+            if span is not None:
+                tracing.activate(span)
+            return http_client.delete(f'{self.address}/invalidate/{kind}/{value}', invalidate_endpoint)
+
+        result = self.fan_out.broadcast(list(batch), send_key)
+
+        with self.condition:
+            self.stats['batches'] += 1
+            self.stats['last_batch_size'] = len(batch)
+            for key, failures in batch.items():
+                response = result.responses.get(key)
+                if response is not None and response.status_code < 500:
+                    self.stats['sent'] += 1
+                    self.spans.pop(key, None)
+                elif failures < self.retries and key not in self.pending:
+                    self.pending[key] = failures + 1
+                    self.stats['retried'] += 1
+                else:
+                    self.stats['dropped'] += 1
+                    self.spans.pop(key, None)
+
+            # Failed keys are retried after the next window
+            if len(self.pending) > 0:
+                self.condition.notify()
+
+    def snapshot(self):
+        with self.condition:
+            return {**self.stats, 'queue_depth': len(self.pending)}
+
+
+publisher = InvalidationPublisher(FRONT_END_ADDRESS, INVALIDATION_WINDOW, INVALIDATION_BATCH, INVALIDATION_RETRIES,
+                                  INVALIDATION_QUEUE)
 
 
 # Send a request to the front end server to invalidate a book
 def invalidate_item(book_id):
-    requests.delete(f'{FRONT_END_ADDRESS}/invalidate/item/{book_id}')
+    publisher.publish('item', book_id)
 
 
 # Send a request to the front end server to invalidate a topic
 # The topic data does not change, so this is not of any use right now
 def invalidate_topic(book_topic):
-    requests.delete(f'{FRONT_END_ADDRESS}/invalidate/topic/{book_topic}')
+    publisher.publish('topic', book_topic)
+
+
+# Invalidation statistics endpoint
+@app.route('/stats/invalidation', methods=['GET'])
+def invalidation_stats():
+    return publisher.snapshot()
+
+
+metrics.register_stats('invalidation', publisher.snapshot)
@@ -1,21 +1,30 @@
 from flask import Flask
-from flask_app import app
+from flask_app import app, DATABASE_URL, DATABASE_FILE
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
+from sqlalchemy import inspect
+from backends import create_backend
 import os
 
 # Base directory for database
 database_dir = os.path.abspath(os.path.dirname(__file__))
 
+# Storage backend of the database, SQLite unless a database URL is set
+backend = create_backend(DATABASE_URL or f"sqlite:///{os.path.join(database_dir, DATABASE_FILE)}")
+
 
 def configure_database(app: Flask):
     # Initialize database configurations
-    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(database_dir, 'db.sqlite')}"
+    app.config['SQLALCHEMY_DATABASE_URI'] = str(backend.url)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = backend.engine_options()
 
     # Create Database instance
     db = SQLAlchemy(app)
 
+    # Apply the settings of the backend to every new connection
+    backend.configure_engine(db.get_engine(app))
+
     # Create Marshmallow instance
     marshmallow = Marshmallow(app)
 
@@ -25,15 +34,62 @@ def configure_database(app: Flask):
 # Create global Database and Marshmallow instances
 db, marshmallow = configure_database(app)
 
+
+# Define the version of the database schema, the number of migrations applied to it
+# Each applied migration adds a row with its number
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True)
+
+
 # Objects that should be initially added when the database is created
 database_init = []
 
+# Functions that change the schema of the database after its tables are created, in order
+# Each function is called once for every database, new migrations must be added at the end of the list
+database_migrations = []
+
+# Functions that set up the server after the database is migrated, they are called every time the server starts
+database_setup = []
+
 
-# Create the database if it does not exist and add all initial objects
-def create_database():
-    if not db or os.path.exists(os.path.join(database_dir, 'db.sqlite')):
+# Lock shared by all processes that use the database
+# The setup lock is held while the database is created and migrated, and the leader lock by the process that runs the
+# background processes
+def database_lock(name):
+    return backend.lock(db.engine, name)
+
+
+# Create the tables that do not exist, apply the migrations that were not applied yet,
+# and add all initial objects if the database was just created
+# If a restore function is passed, it is called instead when the database was just created,
+# and the initial objects are only added if it returns False
+# Worker processes (or servers sharing the database) that start at the same time set up the database one after the other
+def create_database(restore=None):
+    if not db:
         return
-    db.create_all()
-    for item in database_init:
-        db.session.add(item)
-    db.session.commit()
+    with database_lock('setup'):
+        created = len(set(db.metadata.tables) & set(inspect(db.engine).get_table_names())) == 0
+        db.create_all()
+
+        version = db.session.query(db.func.max(SchemaVersion.version)).scalar() or 0
+        for number, migrate in enumerate(database_migrations[version:], version + 1):
+            migrate()
+            db.session.add(SchemaVersion(version=number))
+            db.session.commit()
+
+        for setup in database_setup:
+            setup()
+
+        if created and not (restore is not None and restore()):
+            for item in database_init:
+                db.session.add(item)
+            db.session.commit()
+        db.session.remove()
+
+
+# Close the database connections inherited from the parent process, a connection must not be used by two processes
+# The parent process keeps using its connections, so they are dropped without being closed
+def reset_database():
+    db.engine.dispose(close=False)
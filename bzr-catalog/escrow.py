@@ -0,0 +1,352 @@
+from flask_app import app, ESCROW, SELF_ADDRESS, ESCROW_INTERVAL, ESCROW_BATCH, ESCROW_LOW
+from book import Book
+from response_cache import invalidate_book
+from database import db
+from replication import replication, Replication
+from requests import RequestException
+from flask import request
+from sqlalchemy import select, update, insert, func
+from sqlalchemy.exc import IntegrityError
+from bazar_common import http_client, metrics
+import threading
+import time
+
+# 1 second timeout for all connection
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_REP_ESCROW variable)
+escrow_endpoint = http_client.register_endpoint('rep.escrow', 0.1, 1)
+
+
+# Share of the stock of a book held by this server
+# The stock is the quantity of the book the shares were split from, and the version is the sequence number of the
+# book at that time, the shares are split again whenever the book is updated (even to the same quantity)
+class EscrowShare(db.Model):
+    __tablename__ = 'escrow_share'
+
+    book_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    stock = db.Column(db.Integer, nullable=False)
+    share = db.Column(db.Integer, nullable=False)
+
+    # Number of copies sold by this server from its shares
+    sold = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Sells copies of books without contacting the other servers (escrow)
+# The quantity of a book set by an update is the stock, which every server splits into the same shares,
+# in the order of the addresses of all servers, so the shares of all servers add up to the stock
+# A server sells copies from its own share only, and when its share runs low, another server gives it part of its
+# own share: the giver takes the copies out of its share before answering, and the receiver adds them when
+# it gets the answer, so copies are never held by two servers at once (copies of an answer that was lost are never
+# sold, rather than sold twice)
+# Purchases are never propagated, so the quantity (and the sequence number) of the book stays the one of the update,
+# and reads show the share of this server plus the last known shares of the other servers
+# Copies are only given and taken for the same version of a book, which all servers agree on, since the sequence
+# number of an update is replicated with it
+# Purchases must be sent to the purchase endpoint (BUY_MODE=purchase in the order servers), since an update of the
+# quantity sets a new stock
+class Escrow:
+
+    def __init__(self, replication, enabled: bool, address, interval: float, batch_size: int, low: float):
+        self.replication = replication
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.low = low
+        self.thread = None
+
+        # All servers in the same order on every server, the position of a server decides its share
+        self.servers = sorted(set(replication.catalog_addresses) | {address}) if enabled else []
+        self.rank = self.servers.index(address) if enabled else 0
+
+        # Last known shares of the other servers, by book ID and server, with the version they were split from
+        self.known = {}
+
+        # Counters of the escrow
+        self.lock = threading.Lock()
+        self.stats = {
+            # Copies sold, and purchases rejected because not enough copies were left on any server
+            'sold': 0,
+            'out_of_stock': 0,
+            # Stocks split into shares
+            'splits': 0,
+            # Copies received from other servers when a purchase needed them, and in the background rounds
+            'borrowed': 0,
+            'rebalanced': 0,
+            # Copies given to other servers, and copies given by other servers for a stock that had changed
+            'given': 0,
+            'lost': 0,
+            'rounds': 0,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Share of a stock of the server at the given position
+    def initial_share(self, stock, rank):
+        return stock // len(self.servers) + (1 if rank < stock % len(self.servers) else 0)
+
+    # Return the version, the stock and the share of this server of a book, splitting the stock if the book was updated
+    # Returns None if the book does not exist
+    def ensure(self, id):
+        table = EscrowShare.__table__
+        # The share is read before the book, so that a version is never replaced by an older one
+        row = db.session.execute(select(table.c.version, table.c.stock, table.c.share)
+                                 .where(table.c.book_id == id)).first()
+        book = Book.get(id)
+        if book is None:
+            return None
+        if row is not None and row.version == book.sequence_number:
+            return row.version, row.stock, row.share
+
+        share = self.initial_share(book.quantity, self.rank)
+        try:
+            if row is None:
+                db.session.execute(insert(table).values(book_id=book.id, version=book.sequence_number,
+                                                        stock=book.quantity, share=share, sold=0))
+            else:
+                # Only one process splits a version, the others try again with the new version
+                result = db.session.execute(update(table).where(table.c.book_id == book.id,
+                                                                table.c.version == row.version)
+                                            .values(version=book.sequence_number, stock=book.quantity, share=share))
+                if result.rowcount == 0:
+                    db.session.commit()
+                    return self.ensure(id)
+            invalidate_book(book.id)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return self.ensure(id)
+
+        self.count('splits')
+        return book.sequence_number, book.quantity, share
+
+    # Take copies out of the share of this server, without committing, returns whether there were enough copies
+    # The cached responses of the book are invalidated once the copies are committed
+    def take(self, id, version, amount, sold=True) -> bool:
+        table = EscrowShare.__table__
+        values = {'share': table.c.share - amount}
+        if sold:
+            values['sold'] = table.c.sold + amount
+        result = db.session.execute(update(table)
+                                    .where(table.c.book_id == id, table.c.version == version,
+                                           table.c.share >= amount)
+                                    .values(**values))
+        if result.rowcount == 1:
+            invalidate_book(id)
+        return result.rowcount == 1
+
+    # Add copies given by another server to the share of this server, returns whether the version was still the same
+    def add(self, id, version, amount) -> bool:
+        table = EscrowShare.__table__
+        result = db.session.execute(update(table).where(table.c.book_id == id, table.c.version == version)
+                                    .values(share=table.c.share + amount))
+        if result.rowcount == 1:
+            invalidate_book(id)
+        db.session.commit()
+        if result.rowcount == 0:
+            self.count('lost', amount)
+        return result.rowcount == 1
+
+    # Buy copies of many books from the shares of this server, passed as {book ID: number of copies}
+    # If a share does not hold enough copies, the other servers are asked for the missing copies once
+    # Either all books are bought, or none of them
+    def purchase_many(self, items) -> list:
+        splits = {}
+        for id in items:
+            split = self.ensure(id)
+            if split is None:
+                raise Replication.BookNotFoundError()
+            splits[id] = split
+
+        out_of_stock = self.take_all(items, splits)
+        if len(out_of_stock) > 0:
+            for id in out_of_stock:
+                version, stock, share = self.ensure(id)
+                if share < items[id]:
+                    self.borrow(id, version, stock, items[id] - share)
+                splits[id] = self.ensure(id)
+
+            out_of_stock = self.take_all(items, splits)
+            if len(out_of_stock) > 0:
+                self.count('out_of_stock')
+                raise Replication.OutOfStockError(out_of_stock)
+
+        self.count('sold', sum(items.values()))
+        return [self.book(id) for id in items]
+
+    def purchase(self, id, amount: int = 1):
+        try:
+            id = int(id)
+        except ValueError:
+            raise Replication.BookNotFoundError()
+        return self.purchase_many({id: amount})[0]
+
+    # Take the copies of all books in a single transaction, returns the books that did not have enough copies
+    # splits maps each book ID to its version, stock and share (see ensure)
+    def take_all(self, items, splits) -> list:
+        out_of_stock = [id for id, amount in sorted(items.items()) if not self.take(id, splits[id][0], amount)]
+        if len(out_of_stock) > 0:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        return out_of_stock
+
+    # Ask the other servers for copies of a book, the servers with the largest known shares first
+    # Returns the number of copies received
+    def borrow(self, id, version, stock, amount, counter='borrowed') -> int:
+        received = 0
+        for server in sorted(self.servers, key=lambda server: -self.known_share(id, version, stock, server)):
+            if server == self.servers[self.rank]:
+                continue
+            try:
+                response = http_client.post(f'{server}/rep/escrow/transfer', escrow_endpoint,
+                                            json={'book_id': id, 'version': version, 'amount': amount - received})
+            except RequestException:
+                metrics.peer_failures.inc(server, 'escrow')
+                continue
+            if response.status_code != 200:
+                continue
+
+            granted = response.json()['granted']
+            self.remember(id, version, server, response.json()['share'])
+            if granted > 0 and self.add(id, version, granted):
+                received += granted
+                self.count(counter, granted)
+            if received >= amount:
+                break
+        return received
+
+    # Give copies of a book to another server, returns the number of copies given and the remaining share
+    def give(self, id, version, amount):
+        current = self.ensure(id)
+        if current is None or current[0] != version:
+            return 0, 0
+        share = current[2]
+        granted = min(amount, share)
+        if granted <= 0 or not self.take(id, version, granted, sold=False):
+            db.session.rollback()
+            return 0, share
+        db.session.commit()
+        self.count('given', granted)
+        return granted, share - granted
+
+    def remember(self, id, version, server, share):
+        with self.lock:
+            self.known.setdefault(id, {})[server] = (version, share)
+
+    # Last known share of another server, or its initial share of the stock if it is not known for the current version
+    def known_share(self, id, version, stock, server):
+        with self.lock:
+            known = self.known.get(id, {}).get(server)
+        if known is not None and known[0] == version:
+            return known[1]
+        return self.initial_share(stock, self.servers.index(server))
+
+    # A book with its quantity replaced by the copies left on all servers, as far as this server knows
+    def book(self, id):
+        book = Book.get(id)
+        if book is None:
+            return None
+        version, stock, share = self.ensure(id)
+        others = sum(self.known_share(id, version, stock, server)
+                     for server in self.servers if server != self.servers[self.rank])
+        return {**book._mapping, 'quantity': share + others}
+
+    # Start the background thread that rebalances the shares, if there are other servers
+    def start(self):
+        if not self.enabled or self.interval <= 0 or len(self.servers) < 2:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='escrow', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with app.app_context():
+                try:
+                    self.rebalance()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Escrow rebalancing failed')
+                finally:
+                    db.session.remove()
+            time.sleep(self.interval)
+
+    # Ask the other servers for half of the difference between their shares and the share of this server,
+    # for books whose share fell below the low fraction of its initial share
+    def rebalance(self):
+        table = EscrowShare.__table__
+        rows = db.session.execute(select(table.c.book_id, table.c.version, table.c.stock, table.c.share)
+                                  .where(table.c.stock > 0,
+                                         table.c.share * len(self.servers) < self.low * table.c.stock)
+                                  .order_by(func.random()).limit(self.batch_size)).all()
+        db.session.commit()
+        self.count('rounds')
+        if len(rows) == 0:
+            return
+
+        # Learn the shares of the other servers
+        ids = ','.join(str(row.book_id) for row in rows)
+        for server in self.servers:
+            if server == self.servers[self.rank]:
+                continue
+            try:
+                response = http_client.get(f'{server}/rep/escrow', escrow_endpoint, params={'ids': ids})
+            except RequestException:
+                metrics.peer_failures.inc(server, 'escrow')
+                continue
+            if response.status_code == 200:
+                for id, known in response.json()['shares'].items():
+                    self.remember(int(id), known['version'], server, known['share'])
+
+        for row in rows:
+            richest = max((server for server in self.servers if server != self.servers[self.rank]),
+                          key=lambda server: self.known_share(row.book_id, row.version, row.stock, server))
+            difference = self.known_share(row.book_id, row.version, row.stock, richest) - row.share
+            if difference >= 2:
+                self.borrow(row.book_id, row.version, row.stock, difference // 2, counter='rebalanced')
+
+
+escrow = Escrow(replication, ESCROW, SELF_ADDRESS, ESCROW_INTERVAL, ESCROW_BATCH, ESCROW_LOW)
+
+
+# Shares of books held by this server, the IDs are passed as a comma separated list (/rep/escrow?ids=1,2,3)
+@app.route('/rep/escrow', methods=['GET'])
+def replication_escrow():
+    try:
+        ids = [int(book_id) for book_id in request.args.get('ids', '').split(',') if book_id.strip() != '']
+    except ValueError:
+        return {'message': 'Book IDs must be numbers'}, 400
+
+    shares = {}
+    for id in ids:
+        current = escrow.ensure(id)
+        if current is not None:
+            shares[id] = {'version': current[0], 'stock': current[1], 'share': current[2]}
+    return {'shares': shares}
+
+
+# Give copies of a book to the requesting server, passed as {"book_id": 1, "version": 3, "amount": 2}
+# The copies are only given if this server split the same version of the book
+@app.route('/rep/escrow/transfer', methods=['POST'])
+def replication_escrow_transfer():
+    data = request.get_json(silent=True) or {}
+    try:
+        id, version, amount = int(data['book_id']), int(data['version']), int(data['amount'])
+    except (KeyError, TypeError, ValueError):
+        return {'message': 'book_id, version and amount must be numbers'}, 400
+
+    granted, share = escrow.give(id, version, amount)
+    return {'granted': granted, 'share': share}
+
+
+# Escrow statistics endpoint
+@app.route('/stats/escrow', methods=['GET'])
+def escrow_stats():
+    with escrow.lock:
+        return dict(escrow.stats)
+
+
+metrics.register_stats('escrow', escrow_stats)
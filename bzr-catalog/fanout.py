@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests import RequestException, ReadTimeout
+from bazar_common import metrics
+import contextvars
+import time
+
+# Duration of every fan-out by the reason it returned, and servers that were not waited for
+fanout_seconds = metrics.Histogram('bazar_fanout_seconds', 'Time to send a request to a group of servers',
+                                   ('name', 'outcome'))
+fanout_pending = metrics.Counter('bazar_fanout_pending_total', 'Servers that did not answer before a fan-out returned',
+                                 ('name',))
+
+
+# The outcome of sending one request to a group of servers
+class FanOutResult:
+    def __init__(self):
+        # Responses of servers that answered before the fan-out returned, keyed by server address
+        self.responses = {}
+
+        # Servers that could not be reached (connection error or timeout)
+        self.failed = []
+
+        # Servers that did not answer yet when the fan-out returned
+        self.pending = []
+
+        # Servers that received the request but did not answer before the timeout of the client (part of failed)
+        # Unlike the other failed servers, they may still process the request
+        self.timed_out = []
+
+    # Number of servers that answered with a successful (2xx) status code, or with a response accepted by answered
+    def acknowledged(self, answered=None):
+        if answered is None:
+            return len([response for response in self.responses.values() if response.ok])
+        return len([response for response in self.responses.values() if answered(response)])
+
+
+# Sends the same request to many servers concurrently using a bounded thread pool
+class FanOut:
+
+    # The name labels the metrics of the fan-outs
+    def __init__(self, max_workers: int, name: str = 'fanout'):
+        self.max_workers = max_workers
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fanout')
+
+    # Call send(server) for every server at the same time and wait for the responses
+    #   quorum: stop waiting once this many servers acknowledged (None waits for all of them)
+    #   deadline: maximum number of seconds to wait (None waits until every request finishes)
+    #   stop: a predicate on a response, stop waiting as soon as it returns True for any response
+    #   answered: a predicate on a response, whether it counts towards the quorum (by default, a 2xx status code)
+    # Requests that are still running when this returns keep running in the background
+    def broadcast(self, servers, send, quorum: int = None, deadline: float = None, stop=None,
+                  answered=None) -> FanOutResult:
+        start = time.perf_counter()
+        outcome = 'complete'
+        result = FanOutResult()
+        # Every request runs in a copy of the context of the caller, so it belongs to the trace of the caller
+        futures = {self.executor.submit(contextvars.copy_context().run, send, server): server for server in servers}
+        not_done = set(futures)
+        end = None if deadline is None else time.monotonic() + deadline
+
+        while len(not_done) > 0:
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                outcome = 'deadline'
+                break
+
+            done, not_done = wait(not_done, timeout=remaining, return_when=FIRST_COMPLETED)
+
+            stopped = False
+            for future in done:
+                server = futures[future]
+                try:
+                    result.responses[server] = future.result()
+                except RequestException as error:
+                    result.failed.append(server)
+                    if isinstance(error, ReadTimeout):
+                        result.timed_out.append(server)
+                    continue
+
+                # A response that makes the outcome certain, no need to wait for the others
+                if stop is not None and stop(result.responses[server]):
+                    stopped = True
+
+            if stopped:
+                outcome = 'stopped'
+                break
+
+            # Enough servers acknowledged the request
+            if quorum is not None and result.acknowledged(answered) >= quorum:
+                outcome = 'quorum'
+                break
+
+        result.pending = [futures[future] for future in not_done]
+        fanout_seconds.observe(time.perf_counter() - start, self.name, outcome)
+        if len(result.pending) > 0:
+            fanout_pending.inc(self.name, value=len(result.pending))
+        return result
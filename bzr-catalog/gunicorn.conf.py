@@ -0,0 +1,35 @@
+# Production server settings, used with: gunicorn --config gunicorn.conf.py app:app
+# The settings are read from the environment variables, like the settings of the application (see flask_app.py)
+# Sending SIGHUP to the main gunicorn process replaces the workers gracefully, finishing the requests they serve
+from os import environ
+
+# Get the application port from the environment variables
+bind = f"0.0.0.0:{environ.get('PORT', 5000)}"
+
+# Number of worker processes, and number of threads serving requests in each worker
+# The application reads WORKERS as well, so it knows whether other workers change the database
+workers = int(environ.get('WORKERS', 1))
+threads = int(environ.get('THREADS', 8))
+
+# Load the application once in the main process before forking the workers (PRELOAD=1),
+# instead of loading it in every worker
+preload_app = environ.get('PRELOAD', '0') != '0'
+
+# Number of seconds a worker may not respond before it is killed and replaced, including while it loads the application
+# A new server copying the books of another server before it starts (see snapshot.py) takes longer with a large
+# catalog, so it needs a longer timeout, or PRELOAD=1 to copy them in the main process
+timeout = int(environ.get('TIMEOUT', 30))
+
+# Number of seconds a worker has to finish its requests when it is stopped or replaced
+graceful_timeout = int(environ.get('GRACEFUL_TIMEOUT', 30))
+
+# Replace every worker after it served this many requests (0 to never replace them), with some jitter
+# so that the workers are not all replaced at the same time
+max_requests = int(environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+
+# Start the threads of every worker, and drop the connections it inherited from the main process
+def post_worker_init(worker):
+    import app
+    app.start_worker()
@@ -0,0 +1,52 @@
+# Bulk import of books from a CSV or newline-delimited JSON file (see importer.py)
+# CSV files start with a header line naming the fields: title, topic, quantity, price and optionally id
+#
+# Usage: python import_books.py <file> [--format csv|ndjson] [--defer-indexes] [--url http://192.168.1.13:5000]
+#
+# With --url, the file is streamed to the import endpoint of a running catalog server,
+# which also invalidates its caches and lets the other catalog servers pull the new books
+# Without it, the books are added directly to the database configured by the environment variables
+# (the catalog servers using the database should not be running)
+
+import argparse
+import csv
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=['csv', 'ndjson'])
+    parser.add_argument('--defer-indexes', action='store_true')
+    parser.add_argument('--url')
+    args = parser.parse_args()
+
+    # Guess the format from the file extension
+    data_format = args.format or ('csv' if args.file.endswith('.csv') else 'ndjson')
+
+    if args.url is not None:
+        import requests
+        with open(args.file, 'rb') as file:
+            response = requests.post(f'{args.url.rstrip("/")}/import', data=file,
+                                     params={'format': data_format, 'defer_indexes': int(args.defer_indexes)})
+        print(json.dumps(response.json()))
+        return 0 if response.status_code == 200 else 1
+
+    # Loading the application creates and migrates the database
+    import app
+    from importer import importer, readers, Importer
+    with open(args.file, 'rb') as file:
+        try:
+            print(json.dumps(importer.run(readers[data_format](file), defer_indexes=args.defer_indexes)))
+        except (ValueError, csv.Error) as error:
+            print(json.dumps({'message': str(error)}))
+            return 1
+        except Importer.BookExistsError:
+            print(json.dumps({'message': 'Some books already exist'}))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+from flask_app import app, IMPORT_BATCH
+from book import Book
+from database import db, backend, database_lock
+from replication import replication
+from sqlalchemy.exc import IntegrityError
+from flask import request
+from bazar_common import http_client, metrics
+import cache
+import csv
+import json
+import threading
+import time
+
+# 1 second timeout for all connection
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_REP_CATCH_UP variable)
+catch_up_endpoint = http_client.register_endpoint('rep.catch_up', 0.1, 1)
+
+
+# Decode the lines of a binary stream one at a time
+# The input streams of WSGI servers only have the read and readline methods of files, so they cannot be wrapped in
+# io.TextIOWrapper
+def text_lines(stream):
+    for line in iter(stream.readline, b''):
+        yield line.decode('utf-8')
+
+
+# Read books from CSV text, with a header line naming the fields (title, topic, quantity, price and optionally id)
+def read_csv(stream):
+    return csv.DictReader(text_lines(stream))
+
+
+# Read books from newline-delimited JSON text, one object per line
+def read_ndjson(stream):
+    for line in text_lines(stream):
+        if line.strip() != '':
+            yield json.loads(line)
+
+
+readers = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+# Adds many books to the catalog, in large transactions of Core inserts instead of one ORM object at a time
+# The books are recorded in the replication log, so other servers pull them in bulk when they catch up
+# instead of receiving them one by one
+class Importer:
+
+    class InvalidBookError(ValueError):
+        pass
+
+    class BookExistsError(RuntimeError):
+        pass
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+
+        # Counters of all imports
+        self.lock = threading.Lock()
+        self.stats = {'imports': 0, 'books': 0, 'seconds': 0.0, 'last_rows_per_second': None}
+
+    # Convert an imported record to the fields of a book, the line is the number of the record in the input
+    def book(self, record, line):
+        try:
+            book = {
+                'title': str(record['title']),
+                'topic': str(record['topic']),
+                'quantity': int(record.get('quantity') or 0),
+                'price': float(record['price']),
+                'sequence_number': 0,
+            }
+            if record.get('id') not in (None, ''):
+                book['id'] = int(record['id'])
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            raise self.InvalidBookError(f'Record {line} is not a valid book: {error!r}')
+
+        if book['title'] == '' or book['topic'] == '' or book['quantity'] < 0 or book['price'] < 0:
+            raise self.InvalidBookError(f'Record {line} is not a valid book')
+
+        # Books of the other shard groups must be imported into their own servers
+        if 'id' in book and not Book.owned(book['id']):
+            raise self.InvalidBookError(f'Record {line} belongs to the shard {Book.ring.owner(book["id"])}')
+        return book
+
+    # Add the books of an iterable of records, in transactions of batch_size books
+    # Books without an ID get the IDs after the last book (that belong to the shard group of this server)
+    # With defer_indexes, the search index is not updated for every book, but rebuilt once at the end
+    # Books of the transactions that were committed before an invalid record are kept
+    # Returns the number of added books and the time it took
+    def run(self, records, defer_indexes: bool = False) -> dict:
+        start = time.monotonic()
+        imported = 0
+        try:
+            # Imports of the processes sharing the database run one after the other, so their IDs do not collide
+            with database_lock('import'):
+                if defer_indexes:
+                    backend.drop_search_index(db.session)
+                try:
+                    batch = []
+                    for line, record in enumerate(records, 1):
+                        batch.append(self.book(record, line))
+                        if len(batch) >= self.batch_size:
+                            imported += self.insert(batch)
+                            batch = []
+                    if len(batch) > 0:
+                        imported += self.insert(batch)
+                finally:
+                    if defer_indexes:
+                        backend.create_search_index(db.session)
+        finally:
+            seconds = time.monotonic() - start
+            rows_per_second = round(imported / seconds, 1) if seconds > 0 else None
+            with self.lock:
+                self.stats['imports'] += 1
+                self.stats['books'] += imported
+                self.stats['seconds'] = round(self.stats['seconds'] + seconds, 6)
+                self.stats['last_rows_per_second'] = rows_per_second
+
+            # The other servers pull the new books from the replication log, even those of a failed import
+            if imported > 0:
+                self.notify_replicas()
+
+        return {'imported': imported, 'seconds': round(seconds, 6), 'rows_per_second': rows_per_second}
+
+    # Add a batch of books in a single transaction
+    def insert(self, books) -> int:
+        next_id = Book.last_id() + 1
+        for book in books:
+            if 'id' not in book:
+                while not Book.owned(next_id):
+                    next_id += 1
+                book['id'] = next_id
+                next_id += 1
+
+        try:
+            Book.insert_many(books)
+        except IntegrityError:
+            db.session.rollback()
+            raise self.BookExistsError()
+
+        # Topic queries of the front end server now miss the new books
+        for topic in {book['topic'] for book in books}:
+            cache.invalidate_topic(topic)
+        return len(books)
+
+    # Ask all other servers to catch up with the replication log of this server
+    def notify_replicas(self):
+        def send(server):
+            return http_client.post(f'{server}/rep/catch-up', catch_up_endpoint)
+
+        replication.fan_out.broadcast(replication.catalog_addresses, send)
+
+
+importer = Importer(IMPORT_BATCH)
+
+
+# Bulk import endpoint
+# The books are sent as CSV (Content-Type: text/csv) or as newline-delimited JSON, and read while they are received
+# Pass ?defer_indexes=1 to rebuild the search index once after the import, which is faster for large imports
+# (searches of other requests miss the new books until the import ends)
+@app.route('/import', methods=['POST'])
+def import_books():
+    data_format = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if data_format not in readers:
+        return {'message': 'Invalid format', 'supportedFormats': list(readers)}, 400
+
+    try:
+        result = importer.run(readers[data_format](request.stream),
+                              defer_indexes=request.args.get('defer_indexes', '0') != '0')
+
+    # If a record is not a valid book (or the input is not valid CSV or JSON), return an error message
+    except (ValueError, csv.Error) as error:
+        return {'message': str(error)}, 400
+
+    # If a book with the same ID already exists, return a fail response
+    except Importer.BookExistsError:
+        return {'message': 'Some books already exist'}, 409
+
+    return result
+
+
+# Bulk import statistics endpoint
+@app.route('/stats/import', methods=['GET'])
+def import_stats():
+    with importer.lock:
+        return dict(importer.stats)
+
+
+metrics.register_stats('import', import_stats)
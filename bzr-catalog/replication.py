@@ -1,17 +1,42 @@
 import random
+import time
 
-from flask_app import CATALOG_ADDRESSES, app
+from flask_app import CATALOG_ADDRESSES, REPLICATION_QUORUM, REPLICATION_DEADLINE, REPLICATION_WORKERS, \
+    REPLICATION_LOCK_TIMEOUT, app
 from requests import RequestException
+from sqlalchemy.exc import IntegrityError, OperationalError
 from book import Book, replication_schema
+from serialization import json_body
+from database import db, backend
+from fanout import FanOut
 from flask import request
-
-import requests
+from bazar_common import http_client, metrics
 
 
 # 1 second timeout for all connection
 # 100 millisecond timeout for connection establishment
 # (assuming that the maximum time for an operation was calculated)
-timeout = (0.1, 1)
+# Each one can be overridden with the TIMEOUT_REP_CHECK, TIMEOUT_REP_UPDATE and TIMEOUT_REP_GET variables
+check_endpoint = http_client.register_endpoint('rep.check', 0.1, 1)
+update_endpoint = http_client.register_endpoint('rep.update', 0.1, 1)
+get_endpoint = http_client.register_endpoint('rep.get', 0.1, 1)
+
+# Replication requests rejected by another server because this server held an older version of a book,
+# and requests that were not acknowledged by enough servers in time
+conflicts = metrics.Counter('bazar_replication_conflicts_total', 'Replication requests rejected because of a newer '
+                            'version of a book', ('operation',))
+# Reads with a consistency level, by whether they were served from the local copy without contacting other servers,
+# or by a quorum read that found the local copy current or replaced it with a newer one
+consistent_reads = metrics.Counter('bazar_consistent_reads_total', 'Book reads with a consistency level',
+                                   ('level', 'outcome'))
+quorum_failures = metrics.Counter('bazar_replication_quorum_failures_total', 'Replication requests not acknowledged by '
+                                  'enough servers', ('operation',))
+
+
+# Whether a server answered a check or a read of a book, servers without the book answer as well (404),
+# they just do not have a newer copy
+def answered(response):
+    return response.status_code in (200, 404)
 
 
 class Replication:
@@ -25,12 +50,37 @@ class Replication:
     class BookNotFoundError(RuntimeError):
         pass
 
-    def __init__(self, catalog_addresses):
+    class QuorumNotReachedError(RuntimeError):
+        pass
+
+    class OutOfStockError(RuntimeError):
+        pass
+
+    def __init__(self, catalog_addresses, quorum: int = None, deadline: float = None, workers: int = 16):
         self.catalog_addresses = catalog_addresses
         if type(self.catalog_addresses) is not list:
             self.catalog_addresses = []
+        # IDs of books known to be up-to-date
+        # Every worker process has its own set, so a book may be checked once by every worker
+        # A worker whose set is outdated finds out when another server rejects its update, and checks again
         self.updated_ids = set([])
 
+        # Number of peer acknowledgements to wait for in each phase, and the time limit to wait for them
+        self.quorum = quorum
+        self.deadline = deadline
+
+        # Thread pool used to send requests to all other servers concurrently
+        self.fan_out = FanOut(workers, 'replication')
+
+        # Whether reads check other servers for newer versions of books that are not recorded as up-to-date
+        # This is disabled when books are kept up-to-date by the anti-entropy process
+        self.read_repair = True
+
+        # Time (monotonic) of the last quorum read of every book, reads with bounded staleness are served from the
+        # local copy of a book until it is older than their bound
+        # Every worker process has its own times, like the up-to-date books
+        self.verified = {}
+
     def update(self, id, book_info) -> Book:
         # If no other catalog servers are registered, no need for replication measures
         if len(self.catalog_addresses) == 0:
@@ -46,79 +96,285 @@ class Replication:
 
         sequence_number = book.sequence_number
 
-        # If book is not recorded as up-to-date
+        # If book is not recorded as up-to-date, check servers for latest version of book
         if id not in self.updated_ids:
-            # Check servers for latest version of book
-            max_sequence_number = sequence_number
-            max_item = None
+            self.check(id, sequence_number)
+
+        # If none of the checks fail, send an update request to all servers
+        self.propagate(id, sequence_number, book_info)
+
+        # Update the local book with the information
+        book = Book.update(id, **book_info)
 
-            for server in self.catalog_addresses:
-                # Should spawn threads to handle multiple concurrent requests
-                try:
-                    # Request other servers to check the book sequence_number
-                    data = {'sequence_number': sequence_number}
-                    response = requests.get(f'{server}/rep/check/{id}',
-                                            json=data, timeout=timeout)
+        # Mark book as updated
+        self.updated_ids.add(id)
+
+        return book
 
-                    # If object is out of date, update the object of maximum sequence number
-                    if response.status_code == 409:
-                        if max_sequence_number < response.json()['sequence_number']:
-                            max_sequence_number = response.json()['sequence_number']
-                            max_item = response.json()
+    def purchase(self, id, amount: int = 1) -> Book:
+        # If no other catalog servers are registered, no need for replication measures
+        if len(self.catalog_addresses) == 0:
+            book = Book.purchase(id, amount)
+            if book is None:
+                raise self.OutOfStockError()
+            return book
 
-                # Ignore non-alive servers
-                except RequestException:
-                    pass
+        book = Book.get(id)
+        if book is None:
+            raise self.BookNotFoundError()
 
-            # After checking with servers, book might be in 2 states:
+        # If book is not recorded as up-to-date, check servers for latest version of book
+        if id not in self.updated_ids:
+            self.check(id, book.sequence_number)
+
+        # Decrement the local stock without committing it, the transaction keeps other writers of this book waiting
+        # until all servers received the new quantity
+        # Purchases are serialized on every server: the transaction stays open for the round trip to the other servers,
+        # and with SQLite it holds the write lock of the whole database, so every other write of this server waits
+        # for it (purchases of other books, log appends, catch-up), and updates sent by other servers are rejected
+        # after REPLICATION_LOCK_TIMEOUT, so two servers buying at the same time may reject each other and retry
+        # (with PostgreSQL only the row of the book is locked)
+        # The purchase is not committed before the other servers are asked, since the updates hold the new quantity
+        # rather than the change: a purchase given back after a rejection would overwrite the purchases of the book
+        # made in the meantime
+        book = Book.purchase(id, amount, commit=False)
+        if book is None:
+            db.session.rollback()
+            raise self.OutOfStockError()
 
-            # 1. Up-to-date: Just mark it as up-to-date
+        # Send the new quantity to all servers, with the sequence number the book had before the purchase
+        try:
+            self.propagate(id, book.sequence_number - 1, {'quantity': book.quantity}, strict=True)
+        except (self.OutdatedError, self.QuorumNotReachedError):
+            db.session.rollback()
+            raise
 
-            # 2. Out-of-date: Server responds with the up-to-date book
-            # so local book is updated to the most up-to-date version
+        db.session.commit()
 
-            # In both states, book should be marked as up-to-date
-            self.updated_ids.add(id)
+        # Mark book as updated
+        self.updated_ids.add(id)
 
-            # If one of the checks fails
-            if max_item is not None:
-                # Update local book with the failed book
-                Book.update(id, **max_item)
+        return book
 
-                # Raise an error that the update request wasn't valid
-                raise self.OutdatedError()
+    def purchase_many(self, items) -> list:
+        books = Book.get_many(list(items))
+        if len(books) < len(items):
+            raise self.BookNotFoundError()
 
-        # If none of the checks fail, send an update request to all servers
-        for server in self.catalog_addresses:
-            # Should spawn threads to handle multiple concurrent requests
-            try:
-                # Request other servers to update the book
-                data = {'sequence_number': sequence_number, **book_info}
-                response = requests.put(f'{server}/rep/update/{id}',
-                                        json=data, timeout=timeout)
+        # Books that are not recorded as up-to-date are checked with all servers in a single request per server
+        if len(self.catalog_addresses) > 0:
+            not_updated = {book.id: book.sequence_number for book in books if book.id not in self.updated_ids}
+            if len(not_updated) > 0:
+                self.check_many(not_updated)
 
-                # If object is out of date, raise an error that the update wasn't valid
-                if response.status_code == 409:
-                    raise self.OutdatedError()
+        # Decrement the local stock of all books, only committing it right away if there is no other server
+        # Like a single purchase, the transaction stays open while the other servers are asked (see purchase)
+        out_of_stock = Book.purchase_many(items, commit=len(self.catalog_addresses) == 0)
+        if len(out_of_stock) > 0:
+            raise self.OutOfStockError(out_of_stock)
 
-            # Ignore non-alive servers
-            except RequestException:
-                pass
+        books = Book.get_many(list(items))
+        if len(self.catalog_addresses) == 0:
+            return books
+
+        # Send the new quantities to all servers, with the sequence numbers the books had before the purchase
+        try:
+            self.propagate_many({book.id: {'sequence_number': book.sequence_number - 1, 'quantity': book.quantity}
+                                 for book in books}, strict=True)
+        except (self.OutdatedError, self.QuorumNotReachedError):
+            db.session.rollback()
+            raise
+
+        db.session.commit()
+
+        # Mark books as updated
+        self.updated_ids.update(items)
+
+        return books
+
+    def get_many(self, ids) -> list:
+        books = Book.get_many(ids)
+
+        # Books that are not recorded as up-to-date are checked with all servers in a single request per server
+        not_updated = {book.id: book.sequence_number for book in books if book.id not in self.updated_ids}
+        if len(self.catalog_addresses) == 0 or len(not_updated) == 0 or not self.read_repair:
+            return books
+
+        try:
+            self.check_many(not_updated)
+
+        # Some books were updated to a newer version, so read them again
+        except self.OutdatedError:
+            return Book.get_many(ids)
+
+        # If not enough servers answered, assume copies of this server are the correct copies
+        except self.QuorumNotReachedError:
+            pass
+
+        return books
+
+    # Send a request to all other servers at the same time (see FanOut.broadcast)
+    # Servers that could not be reached, rejections and missed quorums are counted in the metrics of the operation
+    def broadcast(self, operation, send, **kwargs):
+        result = self.fan_out.broadcast(self.catalog_addresses, send, **kwargs)
+        for server in result.failed:
+            metrics.peer_failures.inc(server, operation)
+        if any(response.status_code == 409 for response in result.responses.values()):
+            conflicts.inc(operation)
+        elif kwargs.get('quorum') is not None and result.acknowledged(kwargs.get('answered')) < kwargs['quorum']:
+            quorum_failures.inc(operation)
+        return result
+
+    # Request all other servers to check the book sequence_number at the same time
+    # If any server has a newer version, the local book is updated to it and OutdatedError is raised
+    def check(self, id, sequence_number):
+        body = json_body({'sequence_number': sequence_number})
+
+        def send(server):
+            return http_client.get(f'{server}/rep/check/{id}', check_endpoint, **body)
+
+        # Non-alive servers are ignored, and any 409 response makes the update invalid
+        result = self.broadcast('check', send,
+                               quorum=self.quorum, deadline=self.deadline, answered=answered,
+                               stop=lambda response: response.status_code == 409)
+
+        # Check servers for latest version of book
+        max_sequence_number = sequence_number
+        max_item = None
+        for response in result.responses.values():
+            # If object is out of date, update the object of maximum sequence number
+            if response.status_code == 409:
+                if max_sequence_number < response.json()['sequence_number']:
+                    max_sequence_number = response.json()['sequence_number']
+                    max_item = response.json()
+
+        # After checking with servers, book might be in 2 states:
+
+        # 1. Up-to-date: Just mark it as up-to-date
+
+        # 2. Out-of-date: Server responds with the up-to-date book
+        # so local book is updated to the most up-to-date version
+
+        # In both states, book should be marked as up-to-date
+
+        # If one of the checks fails
+        if max_item is not None:
+            self.updated_ids.add(id)
 
-        # Update the local book with the information
-        book = Book.update(id, **book_info)
+            # Update local book with the failed book
+            Book.update(id, replicated=True, **max_item)
+
+            # Raise an error that the update request wasn't valid
+            raise self.OutdatedError()
+
+        # If not enough servers answered the check in time, the book cannot be considered up-to-date
+        if self.quorum is not None and result.acknowledged(answered) < self.quorum:
+            raise self.QuorumNotReachedError()
 
-        # Mark book as updated
         self.updated_ids.add(id)
 
-        return book
+    # Request all other servers to check the sequence numbers of many books in a single request per server
+    # sequence_numbers maps each book ID to its local sequence number
+    # Books with a newer version on any server are updated to it and OutdatedError is raised
+    def check_many(self, sequence_numbers):
+        body = json_body({'sequence_numbers': sequence_numbers})
+
+        def send(server):
+            return http_client.get(f'{server}/rep/check', check_endpoint, **body)
+
+        result = self.broadcast('check', send,
+                               quorum=self.quorum, deadline=self.deadline, answered=answered)
+
+        # Find the newest version of every outdated book
+        max_items = {}
+        for response in result.responses.values():
+            if response.status_code == 409:
+                for id, item in response.json()['books'].items():
+                    id = int(id)
+                    if item['sequence_number'] > max_items.get(id, {}).get('sequence_number', sequence_numbers[id]):
+                        max_items[id] = item
+
+        # If one of the checks fails, update local books with the failed books
+        if len(max_items) > 0:
+            for id, item in max_items.items():
+                Book.update(id, commit=False, replicated=True, **item)
+            db.session.commit()
+            self.updated_ids.update(sequence_numbers)
+            raise self.OutdatedError()
+
+        # If not enough servers answered the check in time, the books cannot be considered up-to-date
+        if self.quorum is not None and result.acknowledged(answered) < self.quorum:
+            raise self.QuorumNotReachedError()
+
+        self.updated_ids.update(sequence_numbers)
+
+    # Send an update request of many books to all other servers in a single request per server
+    # books_info maps each book ID to its sequence number and the updated fields
+    def propagate_many(self, books_info, strict: bool = False):
+        body = json_body({'books': books_info})
+
+        def send(server):
+            return http_client.put(f'{server}/rep/update', update_endpoint, **body)
+
+        result = self.broadcast('update', send,
+                               quorum=self.quorum, deadline=self.deadline,
+                               stop=lambda response: response.status_code == 409)
+
+        # If any object is out of date, raise an error that the update wasn't valid
+        # The books are no longer known to be up-to-date, so a retry checks all servers first
+        if any(response.status_code == 409 for response in result.responses.values()):
+            self.updated_ids.difference_update(books_info)
+            raise self.OutdatedError()
+
+        # Not enough servers acknowledged the update in time
+        if self.quorum is not None and result.acknowledged() < self.quorum:
+            raise self.QuorumNotReachedError()
+
+        # With strict and no quorum, every server that received the update must answer (see strict_failed)
+        if strict and self.strict_failed(result):
+            self.updated_ids.difference_update(books_info)
+            raise self.QuorumNotReachedError()
+
+    # Send an update request of the book to all other servers at the same time
+    def propagate(self, id, sequence_number, book_info, strict: bool = False):
+        body = json_body({'sequence_number': sequence_number, **book_info})
+
+        def send(server):
+            return http_client.put(f'{server}/rep/update/{id}', update_endpoint, **body)
+
+        result = self.broadcast('update', send,
+                               quorum=self.quorum, deadline=self.deadline,
+                               stop=lambda response: response.status_code == 409)
+
+        # If object is out of date, raise an error that the update wasn't valid
+        # The book is no longer known to be up-to-date, so a retry checks all servers first
+        if any(response.status_code == 409 for response in result.responses.values()):
+            self.updated_ids.discard(id)
+            raise self.OutdatedError()
+
+        # Not enough servers acknowledged the update in time
+        if self.quorum is not None and result.acknowledged() < self.quorum:
+            raise self.QuorumNotReachedError()
+
+        # With strict and no quorum, every server that received the update must answer (see strict_failed)
+        if strict and self.strict_failed(result):
+            self.updated_ids.discard(id)
+            raise self.QuorumNotReachedError()
+
+    # Whether the outcome of an update is unknown on some server, because it was still running when the fan-out
+    # returned or the server did not answer before the timeout
+    # Purchases propagate with strict, since they roll back the local purchase if the update fails: a server that may
+    # still apply the update would keep a quantity that no server committed
+    # Without a quorum every server is expected to answer, a server that could not be reached does not count
+    def strict_failed(self, result):
+        return self.quorum is None and len(result.pending) + len(result.timed_out) > 0
 
     def get(self, id, max_sequence_number: int = None, requesters: list = None) -> Book:
 
         book = Book.get(id)
 
-        # If item is tracked as up-to-date, return
-        if id in self.updated_ids:
+        # If item is tracked as up-to-date, or reads do not check other servers, return
+        if id in self.updated_ids or not self.read_repair:
             return book
 
         if book is None:
@@ -143,19 +399,19 @@ class Replication:
         while len(available_servers) > 0:
             try:
                 server = random.choice(available_servers)
-                response = requests.get(f'{server}/rep/get/{id}',
-                                        json={
-                                            'requesters': requesters if requesters is not None else [],
-                                            'sequence_number':
-                                                max_sequence_number
-                                                if max_sequence_number is not None
-                                                and max_sequence_number > sequence_number
-                                                else sequence_number
-                                        },
-                                        timeout=timeout)
+                response = http_client.get(f'{server}/rep/get/{id}', get_endpoint,
+                                           json={
+                                               'requesters': requesters if requesters is not None else [],
+                                               'sequence_number':
+                                                   max_sequence_number
+                                                   if max_sequence_number is not None
+                                                   and max_sequence_number > sequence_number
+                                                   else sequence_number
+                                           })
                 break
             except RequestException:
                 if server is not None:
+                    metrics.peer_failures.inc(server, 'read')
                     available_servers.remove(server)
 
         # If no server was left, assume copy of this server is the correct copy
@@ -186,18 +442,101 @@ class Replication:
         # This means that at this point in the code, the returned item is considered the up-to-date item
 
         # Update the book with the retrieved book
-        Book.update(id, **response.json())
+        Book.update(id, replicated=True, **response.json())
 
         # Mark this item as updated
         self.updated_ids.add(id)
 
         return Book.get(id)
 
+    # Read a book with a consistency level (see parse_consistency)
+    #   local: the copy of this server, without contacting other servers
+    #   quorum: the newest of the copies of a majority of the servers
+    #   bounded: the copy of this server if a quorum read of the book happened less than staleness seconds ago,
+    #            or a quorum read otherwise
+    def read(self, id, level, staleness: float = None) -> Book:
+        if level == 'bounded':
+            verified = self.verified.get(id)
+            if verified is not None and time.monotonic() - verified <= staleness:
+                consistent_reads.inc(level, 'local')
+                return Book.get(id)
+            return self.quorum_get(id, level)
+
+        if level == 'quorum':
+            return self.quorum_get(id, level)
+
+        consistent_reads.inc(level, 'local')
+        return Book.get(id)
+
+    # Read a book from a majority of the servers, counting this server
+    # All other servers are asked for their copies at the same time, and the read returns as soon as enough of them
+    # answered, with the copy of the highest sequence number, which replaces the local copy if it is newer
+    # A book that this server does not hold yet (it was added on another server) is added from the newest copy
+    def quorum_get(self, id, level='quorum') -> Book:
+        book = Book.get(id)
+        if book is None and len(self.catalog_addresses) == 0:
+            raise self.BookNotFoundError()
+
+        outcome = 'current'
+        if len(self.catalog_addresses) > 0:
+            # Number of other servers that make a majority with this server
+            needed = (len(self.catalog_addresses) + 1) // 2
+
+            def send(server):
+                return http_client.get(f'{server}/rep/read/{id}', get_endpoint)
+
+            result = self.broadcast('read', send, quorum=needed, deadline=self.deadline, answered=answered)
+            if result.acknowledged(answered) < needed:
+                raise self.QuorumNotReachedError()
+
+            newest = max((response.json() for response in result.responses.values() if response.status_code == 200),
+                         key=lambda item: item['sequence_number'], default=None)
+            if newest is not None and (book is None or newest['sequence_number'] > book.sequence_number):
+                if book is None:
+                    self.add(id, newest)
+                else:
+                    Book.update(id, replicated=True, **newest)
+                book = Book.get(id)
+                outcome = 'repaired'
+
+            if book is None:
+                raise self.BookNotFoundError()
+
+        consistent_reads.inc(level, outcome)
+        self.verified[id] = time.monotonic()
+        self.updated_ids.add(id)
+        return book
+
+    # Add a book copied from another server
+    # If it was added by another request at the same time, the copy of that request is kept
+    def add(self, id, item):
+        try:
+            Book.insert_many([{'id': id, **item}], replicated=True)
+        except IntegrityError:
+            db.session.rollback()
+
     def get_catalog_addresses_pure(self):
         return [address.replace('http://', "").replace('https://', "") for address in self.catalog_addresses]
 
 
-replication = Replication(CATALOG_ADDRESSES)
+# Parse a consistency level of a read, formatted as "local", "quorum" or "bounded-staleness=<milliseconds>"
+# Returns the level and the staleness bound in seconds, or raises ValueError
+def parse_consistency(value):
+    if value in ('local', 'quorum'):
+        return value, None
+    if value.startswith('bounded-staleness='):
+        staleness = float(value[len('bounded-staleness='):])
+        if staleness >= 0:
+            return 'bounded', staleness / 1000
+    raise ValueError(value)
+
+
+replication = Replication(CATALOG_ADDRESSES, quorum=REPLICATION_QUORUM, deadline=REPLICATION_DEADLINE,
+                          workers=REPLICATION_WORKERS)
+
+# Number of books known to be up-to-date, which are read and updated without checking the other servers
+metrics.Gauge('bazar_replication_updated_ids', 'Books known to be up-to-date',
+              function=lambda: len(replication.updated_ids))
 
 
 @app.route('/rep/update/<book_id>', methods=['PUT'])
@@ -206,22 +545,28 @@ def replication_update(book_id):
 
     book_id = int(book_id)
 
-    book = Book.get(book_id)
-
     # If local book is newer than the edit request, reject update
-    if book.sequence_number > book_info['sequence_number']:
+    # The update is also rejected if a local purchase holds the book for longer than REPLICATION_LOCK_TIMEOUT, since
+    # the server that sent it may time out, give up on its purchase and never know that this server applied it
+    try:
+        with backend.lock_timeout(db.session, REPLICATION_LOCK_TIMEOUT):
+            claimed = Book.claim(book_id, book_info['sequence_number'])
+    except OperationalError:
+        claimed = False
+    if not claimed:
+        db.session.rollback()
+        book = Book.get(book_id)
+        if book is None:
+            return {'message': 'Not found'}, 404
         return replication_schema.jsonify(book), 409  # 409 Conflict
 
-    # Update the book with the retrieved book
-    Book.update(book_id, **book_info)
-
-    # Server responds with the old sequence number, so format response before updating
-    response = replication_schema.jsonify(Book.get(book_id))
+    # Update the book with the retrieved book, and the sequence number taken by the claim
+    book = Book.update(book_id, commit=False, replicated=True,
+                       **{**book_info, 'sequence_number': book_info['sequence_number'] + 1})
+    db.session.commit()
 
-    # Update sequence number manually
-    Book.update(book_id, sequence_number=book_info['sequence_number']+1)
-
-    return response
+    # Server responds with the old sequence number
+    return {**replication_schema.dump(book), 'sequence_number': book_info['sequence_number']}
 
 
 @app.route('/rep/get/<book_id>', methods=['GET'])
@@ -258,6 +603,15 @@ def replication_get(book_id):
     return replication_schema.jsonify(book)
 
 
+# Local copy of a book, used by quorum reads of other servers (never forwarded to other servers)
+@app.route('/rep/read/<book_id>', methods=['GET'])
+def replication_read(book_id):
+    book = Book.get(book_id)
+    if book is None:
+        return {'message': 'Not found'}, 404
+    return replication_schema.jsonify(book)
+
+
 @app.route('/rep/check/<book_id>', methods=['GET'])
 def replication_check(book_id):
     book_info = request.json
@@ -265,9 +619,54 @@ def replication_check(book_id):
     book_id = int(book_id)
 
     book = Book.get(book_id)
+    if book is None:
+        return {'message': 'Not found'}, 404
 
     # If local book is newer than the check request, respond that its not valid
     if book.sequence_number > book_info['sequence_number']:
         return replication_schema.jsonify(book), 409  # 409 Conflict
 
     return {}
+
+
+@app.route('/rep/update', methods=['PUT'])
+def replication_update_many():
+    books_info = {int(book_id): book_info for book_id, book_info in request.json['books'].items()}
+
+    books = {book.id: book for book in Book.get_many(list(books_info))}
+
+    # If any local book is newer than the edit request, reject the whole update
+    # The books are claimed in order of their IDs, so two updates of the same books cannot wait for each other
+    # If a local purchase holds them for too long, all books are rejected (see replication_update)
+    try:
+        with backend.lock_timeout(db.session, REPLICATION_LOCK_TIMEOUT):
+            newer = [book_id for book_id in sorted(books)
+                     if not Book.claim(book_id, books_info[book_id]['sequence_number'])]
+    except OperationalError:
+        newer = list(books)
+    if len(newer) > 0:
+        db.session.rollback()
+        return {'books': {book.id: replication_schema.dump(book) for book in Book.get_many(newer)}}, 409  # 409 Conflict
+
+    # Update all books with the retrieved books in a single transaction, with the sequence numbers taken by the claims
+    for book_id in books:
+        book_info = books_info[book_id]
+        Book.update(book_id, commit=False, replicated=True,
+                    **{**book_info, 'sequence_number': book_info['sequence_number'] + 1})
+    db.session.commit()
+
+    return {}
+
+
+@app.route('/rep/check', methods=['GET'])
+def replication_check_many():
+    sequence_numbers = {int(book_id): sequence_number
+                        for book_id, sequence_number in request.json['sequence_numbers'].items()}
+
+    # Respond with all local books that are newer than the check request
+    newer = {book.id: replication_schema.dump(book) for book in Book.get_many(list(sequence_numbers))
+             if book.sequence_number > sequence_numbers[book.id]}
+    if len(newer) > 0:
+        return {'books': newer}, 409  # 409 Conflict
+
+    return {}
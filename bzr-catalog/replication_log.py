@@ -0,0 +1,253 @@
+from flask_app import app, REPLICATION_CATCH_UP, REPLICATION_LOG_INTERVAL, REPLICATION_LOG_BATCH, \
+    REPLICATION_LOG_TRUNCATE, SELF_ADDRESS
+from book import Book, LogRecord, LogOffset, LogReader
+from database import db
+from replication import replication
+from response_cache import synchronize_changes
+from requests import RequestException
+from flask import request, Response, stream_with_context
+from sqlalchemy import select
+from bazar_common import http_client, metrics
+import json
+import threading
+import time
+
+# 5 second timeout for every chunk of the log
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_REP_LOG variable)
+log_endpoint = http_client.register_endpoint('rep.log', 0.1, 5)
+
+
+# Background process that streams the replication logs of all other servers
+# and applies the records that are newer than the local books
+# With truncate, the records of the local log that every other server has read are removed after every catch-up
+class CatchUp:
+
+    def __init__(self, replication, enabled: bool, interval: float, batch_size: int, truncate: bool,
+                 self_address: str = None):
+        self.replication = replication
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.truncate = truncate
+        self.self_address = self_address
+        self.thread = None
+
+        # Held while catching up, so that a triggered catch-up does not run along with the background one
+        self.running = threading.Lock()
+
+        # Counters of the catch-up
+        self.lock = threading.Lock()
+        self.stats = {
+            # Number of records received from other servers, and the number of them that were newer than local books
+            'records_received': 0,
+            'records_applied': 0,
+            'batches': 0,
+            # Number of records removed from the local log after every other server read them
+            'records_truncated': 0,
+            # Number of seconds the last catch-up with all other servers took
+            'last_catch_up_seconds': None,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Start the background thread, if catching up is enabled and there are other servers
+    def start(self):
+        if not self.enabled or len(self.replication.catalog_addresses) == 0:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='catch-up', daemon=True)
+        self.thread.start()
+
+    # Catch up once in the background, unless a catch-up is already running
+    # Used when another server added many books to its log (see importer.py)
+    def trigger(self):
+        if len(self.replication.catalog_addresses) == 0:
+            return
+
+        threading.Thread(target=self.catch_up, name='catch-up-once', daemon=True).start()
+
+    def run(self):
+        while True:
+            self.catch_up()
+            if self.interval <= 0:
+                return
+            time.sleep(self.interval)
+
+    # Catch up with the logs of all other servers
+    def catch_up(self):
+        if not self.running.acquire(blocking=False):
+            return
+
+        try:
+            start = time.monotonic()
+            with app.app_context():
+                for server in self.replication.catalog_addresses:
+                    try:
+                        self.catch_up_with(server)
+
+                    # Ignore non-alive servers
+                    except RequestException:
+                        metrics.peer_failures.inc(server, 'catch_up')
+
+                    # Keep catching up with the other servers even if one of them failed
+                    except Exception:
+                        db.session.rollback()
+                        app.logger.exception(f'Catching up with {server} failed')
+
+                if self.truncate:
+                    self.truncate_log()
+
+                db.session.remove()
+
+            with self.lock:
+                self.stats['last_catch_up_seconds'] = round(time.monotonic() - start, 6)
+        finally:
+            self.running.release()
+
+    # Stream the records of the log of another server after the last applied offset, and apply them in batches
+    def catch_up_with(self, server):
+        offset = LogOffset.query.get(server)
+        if offset is None:
+            offset = LogOffset(server=server, offset=0)
+            db.session.add(offset)
+
+        # The other server records how far this server read its log, if it knows the address of this server
+        params = {'after': offset.offset}
+        if self.self_address is not None:
+            params['reader'] = self.self_address
+        response = http_client.get(f'{server}/rep/log', log_endpoint, params=params, stream=True)
+        with response:
+            if response.status_code != 200:
+                return
+
+            # If the log of the other server is shorter than the last applied offset, it was recreated,
+            # so start again from its beginning
+            last_offset = int(response.headers.get('X-Last-Offset', 0))
+            if last_offset < offset.offset:
+                offset.offset = 0
+                db.session.commit()
+                return self.catch_up_with(server)
+
+            batch = []
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) >= self.batch_size:
+                    self.apply(offset, batch)
+                    batch = []
+
+            if len(batch) > 0:
+                self.apply(offset, batch)
+
+            # The records up to the last offset that were not sent were copied from other servers, so the next
+            # catch-up (and the truncation of the log of the other server) starts after them
+            if offset.offset < last_offset:
+                offset.offset = last_offset
+                db.session.commit()
+
+    # Apply a batch of log records in a single transaction, together with the new offset
+    def apply(self, offset, records):
+        books = {book.id: book for book in Book.get_many({record['book_id'] for record in records})}
+
+        # Books that do not exist locally are added together, with a single statement (see Book.insert_many)
+        new_books = {}
+        applied = 0
+        for record in records:
+            book = books.get(record['book_id'])
+
+            if book is None:
+                new_book = new_books.get(record['book_id'])
+                if new_book is None or new_book['sequence_number'] < record['sequence_number']:
+                    new_books[record['book_id']] = {'id': record['book_id'], 'title': record['title'],
+                                                    'topic': record['topic'], 'quantity': record['quantity'],
+                                                    'price': record['price'],
+                                                    'sequence_number': record['sequence_number']}
+                    applied += 1
+
+            # Books are only updated if the record is newer
+            elif book.sequence_number < record['sequence_number']:
+                Book.update(book.id, commit=False, title=record['title'], quantity=record['quantity'],
+                            topic=record['topic'], price=record['price'],
+                            sequence_number=record['sequence_number'], replicated=True)
+                applied += 1
+
+        Book.insert_many(list(new_books.values()), commit=False, replicated=True)
+        offset.offset = records[-1]['id']
+        db.session.commit()
+
+        self.count('batches')
+        self.count('records_received', len(records))
+        self.count('records_applied', applied)
+
+    # Remove the records of the local log that every other server has read
+    # The last records are kept, so the offsets keep growing and the other worker processes can still read the
+    # changes of their response caches (see ResponseCache.synchronize)
+    def truncate_log(self):
+        readers = {reader.server: reader.offset for reader in LogReader.query.all()}
+        if any(server not in readers for server in self.replication.catalog_addresses):
+            return
+
+        offset = min([readers[server] for server in self.replication.catalog_addresses] +
+                     [LogRecord.last_offset() - synchronize_changes])
+        if offset <= 0:
+            return
+
+        truncated = LogRecord.truncate(offset)
+        db.session.commit()
+        self.count('records_truncated', truncated)
+
+
+catch_up = CatchUp(replication, REPLICATION_CATCH_UP, REPLICATION_LOG_INTERVAL, REPLICATION_LOG_BATCH,
+                   REPLICATION_LOG_TRUNCATE, SELF_ADDRESS)
+
+
+# Stream the records of the replication log after an offset as newline delimited JSON
+# Parameters: after (offset of the last record the requester has, default 0), limit (maximum number of records),
+# reader (address of the requester, one of the other servers, which read the log up to after)
+# Only the changes made on this server are sent, the changes copied from other servers are in their own logs
+@app.route('/rep/log', methods=['GET'])
+def replication_log():
+    after = int(request.args.get('after', 0))
+    limit = request.args.get('limit')
+    reader = request.args.get('reader')
+    last_offset = LogRecord.last_offset()
+
+    if reader in replication.catalog_addresses:
+        db.session.merge(LogReader(server=reader, offset=after))
+        db.session.commit()
+
+    # Records are read as rows instead of ORM objects, and every batch of them is sent as one chunk
+    def generate():
+        columns = [column for column in LogRecord.__table__.c if column.name != 'replicated']
+        statement = select(*columns).where(LogRecord.id > after, LogRecord.replicated.is_(False)) \
+            .order_by(LogRecord.id)
+        if limit is not None:
+            statement = statement.limit(int(limit))
+        result = db.session.execute(statement, execution_options={'yield_per': REPLICATION_LOG_BATCH})
+        for records in result.partitions():
+            yield ''.join(json.dumps(dict(record._mapping)) + '\n' for record in records)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Last-Offset': str(last_offset)})
+
+
+# Catch up with the logs of the other servers now, in the background
+# Sent by a server after it added many books (see importer.py)
+@app.route('/rep/catch-up', methods=['POST'])
+def replication_catch_up():
+    catch_up.trigger()
+    return {'message': 'Catching up'}, 202
+
+
+# Catch-up statistics endpoint
+@app.route('/stats/replication-log', methods=['GET'])
+def replication_log_stats():
+    with catch_up.lock:
+        return dict(catch_up.stats)
+
+
+metrics.register_stats('replication-log', replication_log_stats)
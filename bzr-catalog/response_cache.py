@@ -0,0 +1,164 @@
+from flask_app import app, RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL
+from database import db
+from collections import OrderedDict
+from sqlalchemy import event
+from bazar_common import metrics
+import threading
+import time
+
+
+# Largest number of changes read from the replication log when the cache is synchronized with the other worker
+# processes, with more changes the whole cache is cleared
+synchronize_changes = 100
+
+
+# In-process cache of serialized query responses, keyed by (query method, parameter)
+# Entries are evicted when they are older than the TTL, or in least recently used order when the cache is full
+class ResponseCache:
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # Maps each key to its response body and the time it expires at, in least recently used order
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+
+        # Incremented on every invalidation, responses computed before an invalidation are not stored
+        self.generation = 0
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+        # Offset of the last replication log record whose book was invalidated, see synchronize
+        self.offset = None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self.remove(key)
+                entry = None
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    # Store a response body, if nothing was invalidated since the given generation
+    def put(self, key, body: bytes, generation: int):
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (body, time.monotonic() + self.ttl)
+            self.bytes_used += len(body)
+
+            # Evict the least recently used entries until the cache fits its limits
+            while len(self.entries) > self.max_entries or self.bytes_used > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    # Remove an entry, the lock must be held
+    def remove(self, key):
+        body, _ = self.entries.pop(key)
+        self.bytes_used -= len(body)
+
+    # Remove the entry of a key, or all entries of a query method if the parameter is None
+    def invalidate(self, method, param=None):
+        with self.lock:
+            self.generation += 1
+            self.stats['invalidations'] += 1
+            for key in [key for key in self.entries if key[0] == method and (param is None or key[1] == param)]:
+                self.remove(key)
+
+    # Remove all entries
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.bytes_used = 0
+
+    # Invalidate the responses of books changed by the other worker processes of this server
+    # Every change of a book is recorded in the replication log, so the books changed since the last synchronization
+    # are the records after the last seen offset
+    # changes_after(offset) returns (book ID, whether the title or topic changed) pairs
+    def synchronize(self, last_offset: int, changes_after, max_changes: int = synchronize_changes):
+        with self.lock:
+            offset = self.offset
+            self.offset = last_offset
+        if offset is None or offset == last_offset:
+            return
+
+        # Dropping everything is cheaper than reading a long list of changes (or the log was reset)
+        if last_offset - offset > max_changes or last_offset < offset:
+            self.clear()
+            return
+
+        for book_id, topic_changed in changes_after(offset):
+            for method, param in book_keys(book_id, topic_changed):
+                self.invalidate(method, param)
+
+    def snapshot(self):
+        with self.lock:
+            requests = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': round(self.stats['hits'] / requests, 4) if requests > 0 else None,
+                'entries': len(self.entries),
+                'bytes_used': self.bytes_used,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+
+
+# Invalidate the cached responses of a book once the transaction that changed it is committed
+# Invalidating before the commit would let a concurrent read store the old version again
+# If the title or the topic changed (or the book is new), all topic and title query responses are invalidated
+def invalidate_book(book_id, topic_changed=False):
+    db.session.info.setdefault('invalidate', set()).update(book_keys(book_id, topic_changed))
+
+
+# Invalidate the cached topic and title query responses once the transaction that added new books is committed
+# Missing books are never cached, so there are no item responses of new books to invalidate
+def invalidate_new_books():
+    db.session.info.setdefault('invalidate', set()).update([('topic', None), ('title', None)])
+
+
+# Keys of the cached responses that hold a book
+def book_keys(book_id, topic_changed):
+    keys = [('item', str(book_id))]
+    if topic_changed:
+        keys += [('topic', None), ('title', None)]
+    return keys
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed(session):
+    for method, param in session.info.pop('invalidate', set()):
+        response_cache.invalidate(method, param)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_rolled_back(session, previous_transaction):
+    session.info.pop('invalidate', None)
+
+
+# Response cache statistics endpoint
+@app.route('/stats/response-cache', methods=['GET'])
+def response_cache_stats():
+    return response_cache.snapshot()
+
+
+metrics.register_stats('response-cache', response_cache.snapshot)
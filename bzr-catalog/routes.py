@@ -1,18 +1,42 @@
-from flask import request
-from flask_app import app
-from book import Book, topic_schema, item_schema, update_schema, dump_schema
-from replication import replication, Replication
+from flask import request, Response, stream_with_context
+from flask_app import app, PAGE_LIMIT, STREAM_BATCH, WORKERS
+from database import db
+from book import Book, LogRecord, PurchaseKey, topic_schema, item_schema, items_schema, update_schema, dump_schema
+from replication import replication, Replication, parse_consistency
+from response_cache import response_cache
+from escrow import escrow
 import cache
+import json
+
+
+# Response to requests for a book of another shard group, which this server does not hold (see bazar_common/sharding.py)
+# Returns None if the book belongs to the shard group of this server
+def misdirected(book_ids):
+    for book_id in book_ids:
+        if str(book_id).isnumeric() and not Book.owned(book_id):
+            return {'message': 'Book belongs to another shard', 'shard': Book.ring.owner(book_id)}, 421
+    return None
 
 
 # Query-by-item request handler
-def query_by_item(book_id):
+# The consistency level is a level and a staleness bound parsed by parse_consistency, or None for the default reads,
+# which check the other servers one at a time for a book that is not known to be up-to-date
+def query_by_item(book_id, consistency=None):
+    if not str(book_id).isnumeric():
+        return None
+
     # Use the replication get method to make sure that the queried book is not outdated
+    # Books are tracked by their integer IDs (see Replication.updated_ids)
     try:
-        return replication.get(book_id)
+        book = replication.get(int(book_id)) if consistency is None else replication.read(int(book_id), *consistency)
     except (Replication.CouldNotGetUpdatedError, Replication.BookNotFoundError):
         return None
 
+    # With escrow, the quantity of the book is the stock it was split from, so the copies left are returned instead
+    if escrow.enabled and book is not None:
+        return escrow.book(book.id)
+    return book
+
 
 # Query-by-topic request handler
 # The data returned by topic queries cannot be updated by end users
@@ -22,22 +46,90 @@ def query_by_topic(book_topic):
     return Book.search(book_topic)
 
 
+# Query-by-title request handler
+def query_by_title(book_title):
+    # Use static method to get books by title
+    return Book.search(book_title, column='title')
+
+
 # Define query methods
-# For each method, two fields are defined:
+# For each method, four fields are defined:
 #   1. A query handler, which references the handler function that handles the query
 #   2. A schema object, which formats the response message
+#   3. A cache key function, which maps the parameter to the key of the cached response
+#   4. Whether the query returns a list of books that can be paginated and streamed
 queries = {
     'item': {
         'query_handler': query_by_item,
-        'schema': item_schema
+        'schema': item_schema,
+        # Book IDs are cached under their number, so that /query/item/01 is invalidated along with /query/item/1
+        'cache_key': lambda param: str(int(param)) if param.isnumeric() else param,
+        'paginated': False
     },
     'topic': {
         'query_handler': query_by_topic,
-        'schema': topic_schema
+        'schema': topic_schema,
+        'cache_key': lambda param: param,
+        'paginated': True
+    },
+    'title': {
+        'query_handler': query_by_title,
+        'schema': topic_schema,
+        'cache_key': lambda param: param,
+        'paginated': True
     }
 }
 
 
+# Whether the request asks for a page or a stream of books instead of the whole list
+def is_paginated():
+    return any(name in request.args for name in ('after_id', 'limit', 'stream'))
+
+
+# Respond with the books of a query (ordered by ID), paginated and streamed as requested
+# Pages are selected with ?after_id=<last ID of the previous page>&limit=<number of books>,
+# if there are more books after a page, the X-Next-After-Id header holds the after_id of the next page
+# With ?stream=1 the books are sent as newline-delimited JSON while they are read from the database,
+# so the whole list is never held in memory
+def paginated_response(books, schema):
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = int(request.args.get('limit', 0))
+    except ValueError:
+        return {'message': 'after_id and limit must be numbers'}, 400
+
+    if limit < 0:
+        return {'message': 'limit must not be negative'}, 400
+
+    books = books.filter(Book.id > after_id)
+
+    if request.args.get('stream', '0') != '0':
+        # Streams are not limited unless a limit is passed
+        if limit > 0:
+            books = books.limit(limit)
+
+        # Every batch of books read from the database is sent as one chunk
+        def generate():
+            lines = []
+            for book in books.yield_per(STREAM_BATCH):
+                lines.append(schema.dumps(book) + '\n')
+                if len(lines) >= STREAM_BATCH:
+                    yield ''.join(lines)
+                    lines = []
+            if len(lines) > 0:
+                yield ''.join(lines)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # Pages hold at most PAGE_LIMIT books
+    limit = min(limit, PAGE_LIMIT) if limit > 0 else PAGE_LIMIT
+    page = books.limit(limit).all()
+    response = schema.jsonify(page)
+    if len(page) == limit:
+        response.headers['X-Next-After-Id'] = str(page[-1].id)
+    return response
+
+
 # Query endpoint
 @app.route('/query/<method>/<param>', methods=['GET'])
 def query(method, param):
@@ -45,6 +137,40 @@ def query(method, param):
     if method not in queries:
         return {'message': 'Invalid query method', 'supportedQueryMethods': list(queries.keys())}, 404
 
+    # Books of other shard groups are not held by this server
+    response = misdirected([param]) if method == 'item' else None
+    if response is not None:
+        return response
+
+    # Pages and streams of books are not cached
+    if queries[method]['paginated'] and is_paginated():
+        return paginated_response(queries[method]['query_handler'](param), queries[method]['schema'])
+
+    # Reads of a book can choose their consistency level (?consistency=local, quorum or bounded-staleness=<ms>)
+    if method == 'item' and 'consistency' in request.args:
+        return query_item_consistent(param, request.args['consistency'])
+
+    # With escrow, the copies left of a book include the shares of the other servers and the copies sold by the other
+    # worker processes, which change without invalidating the responses of this process, so books are not cached
+    if method == 'item' and escrow.enabled:
+        book = query_by_item(param)
+        if book is None:
+            return {'message': 'Not found'}, 404
+        return item_schema.jsonify(book)
+
+    # Drop the cached responses of books that were changed by the other worker processes
+    if WORKERS > 1:
+        response_cache.synchronize(LogRecord.last_offset(), LogRecord.changes_after)
+
+    # If the response of this query is cached, return it without querying the database
+    cache_key = (method, queries[method]['cache_key'](param))
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return app.response_class(body, mimetype='application/json')
+
+    # Responses computed while a book is being changed are not cached
+    generation = response_cache.generation
+
     # Call the query handler and pass it the parameter from the URI
     result = queries[method]['query_handler'](param)
 
@@ -53,11 +179,57 @@ def query(method, param):
         return {'message': 'Not found'}, 404
 
     # Otherwise, return the query result, formatted using the schema object
-    return queries[method]['schema'].jsonify(result)
+    response = queries[method]['schema'].jsonify(result)
+    response_cache.put(cache_key, response.get_data(), generation)
+    return response
+
+
+# Query-by-item with a consistency level
+# Local reads may be served from the response cache, which holds the local copies of books, but quorum reads
+# and reads with bounded staleness are not, and none of them are cached, since only default reads are read-repaired
+# (with escrow, books are never cached, see query)
+def query_item_consistent(book_id, value):
+    try:
+        consistency = parse_consistency(value)
+    except ValueError:
+        return {'message': 'Invalid consistency level',
+                'supportedConsistencyLevels': ['local', 'quorum', 'bounded-staleness=<ms>']}, 400
+
+    if not book_id.isnumeric():
+        return {'message': 'Not found'}, 404
+
+    if consistency[0] == 'local' and not escrow.enabled:
+        if WORKERS > 1:
+            response_cache.synchronize(LogRecord.last_offset(), LogRecord.changes_after)
+        body = response_cache.get(('item', queries['item']['cache_key'](book_id)))
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+
+    try:
+        book = query_by_item(book_id, consistency)
+    except Replication.QuorumNotReachedError:
+        return {'message': 'Book could not be read because not enough replicas responded'}, 503
+
+    if book is None:
+        return {'message': 'Not found'}, 404
+    return item_schema.jsonify(book)
+
+
+# Batch query-by-item endpoint
+# The IDs are passed as a comma separated list (/query/items?ids=1,2,3), IDs that do not exist are left out
+@app.route('/query/items', methods=['GET'])
+def query_items():
+    try:
+        ids = [int(book_id) for book_id in request.args.get('ids', '').split(',') if book_id.strip() != '']
+    except ValueError:
+        return {'message': 'Book IDs must be numbers'}, 400
+
+    # Use the replication method to make sure that none of the queried books is outdated
+    return items_schema.jsonify(replication.get_many(ids))
 
 
 # Update endpoint
-@app.route('/update/<book_id>', methods=['PUT'])
+@app.route('/update/<int:book_id>', methods=['PUT'])
 def update(book_id):
     # Extract the JSON data from the request
     book_data = request.json
@@ -66,6 +238,11 @@ def update(book_id):
     if book_data is None:
         book_data = {}
 
+    # Books of other shard groups are not held by this server
+    response = misdirected([book_id])
+    if response is not None:
+        return response
+
     book = Book.get(book_id)
 
     # If the book is None, that means that it doesn't exist in the database, so return an error message
@@ -83,6 +260,10 @@ def update(book_id):
     except Replication.OutdatedError:
         return {'message': 'Update could not be processed because the item is not up to date'}, 409
 
+    # If not enough replicas acknowledged the update in time, return an unavailable response
+    except Replication.QuorumNotReachedError:
+        return {'message': 'Update could not be processed because not enough replicas responded'}, 503
+
     # Invalidate cache
     cache.invalidate_item(book_id)
     cache.invalidate_topic(book.topic)
@@ -97,7 +278,163 @@ def update(book_id):
     return update_schema.jsonify(book)
 
 
+# Make a purchase, returns the response of the purchase
+# place makes the purchase and returns a response tuple
+# With an Idempotency-Key header, a purchase with the same key is only made once, and every later purchase with the
+# key gets the response of the first one (see PurchaseKey)
+# Purchases that were not made because the books were outdated or not enough replicas answered are not recorded,
+# so they can be made again with the same key
+def purchased(items, place):
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        return place()
+
+    items = {str(book_id): amount for book_id, amount in items.items()}
+    if not PurchaseKey.begin(key, items):
+        purchase_key = PurchaseKey.find(key)
+        if purchase_key is None:
+            return {'message': 'The purchase with this idempotency key could not be recorded, please try again'}, 503
+        if json.loads(purchase_key.items) != items:
+            return {'message': 'Idempotency key was already used for another purchase'}, 422
+
+        # The purchase is still being made, or its outcome is unknown, it is retried like an outdated purchase
+        if purchase_key.status is None:
+            return {'message': 'The purchase with this idempotency key is in progress'}, 409
+
+        response = app.response_class(purchase_key.response, status=purchase_key.status,
+                                      content_type=purchase_key.content_type)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    try:
+        response = app.make_response(place())
+    except Exception:
+        db.session.rollback()
+        PurchaseKey.release(key)
+        raise
+
+    if response.status_code in (409, 503):
+        PurchaseKey.release(key)
+    else:
+        PurchaseKey.complete(key, response)
+    return response
+
+
+# Purchase endpoint
+# Buys copies of a book in a single request, the number of copies can be passed as {"amount": n} (default 1)
+# Purchases can be made once with an Idempotency-Key header (see purchased)
+@app.route('/purchase/<int:book_id>', methods=['PUT'])
+def purchase(book_id):
+    # If no data was passed (or the request was not JSON formatted), treat it like an empty JSON object
+    purchase_data = request.get_json(silent=True)
+    if purchase_data is None:
+        purchase_data = {}
+
+    # The amount must be a positive number
+    amount = purchase_data.get('amount', 1)
+    if type(amount) is not int or amount <= 0:
+        return {'message': 'Amount must be a positive integer'}, 400
+
+    # Books of other shard groups are not held by this server
+    response = misdirected([book_id])
+    if response is not None:
+        return response
+
+    return purchased({book_id: amount}, lambda: purchase_book(book_id, amount))
+
+
+def purchase_book(book_id, amount):
+    book = Book.get(book_id)
+
+    # If the book is None, that means that it doesn't exist in the database, so return an error message
+    if book is None:
+        return {'message': 'Not found'}, 404
+
+    # Use the replication method to buy the book and make sure all other replicas get the updated book
+    # With escrow, the copies are taken from the share of this server instead, without contacting the other servers
+    try:
+        book = escrow.purchase(book_id, amount) if escrow.enabled else replication.purchase(book_id, amount)
+
+    # If the book does not have enough copies, return a fail response
+    except Replication.OutOfStockError:
+        return {'message': 'Book is out of stock'}, 422
+
+    # If the purchase failed, return a fail response
+    except Replication.OutdatedError:
+        return {'message': 'Purchase could not be processed because the item is not up to date'}, 409
+
+    # If not enough replicas acknowledged the purchase in time, return an unavailable response
+    except Replication.QuorumNotReachedError:
+        return {'message': 'Purchase could not be processed because not enough replicas responded'}, 503
+
+    # Invalidate cache
+    cache.invalidate_item(book_id)
+
+    # Otherwise, return the updated information of the book formatted with the schema object
+    return update_schema.jsonify(book)
+
+
+# Bulk purchase endpoint
+# Buys copies of many books in a single request, passed as {"items": {"<book ID>": <amount>, ...}}
+# Either all books are bought, or none of them
+# Purchases can be made once with an Idempotency-Key header (see purchased)
+@app.route('/purchase', methods=['PUT'])
+def purchase_many():
+    # If no data was passed (or the request was not JSON formatted), treat it like an empty JSON object
+    purchase_data = request.get_json(silent=True)
+    if purchase_data is None:
+        purchase_data = {}
+
+    try:
+        items = {int(book_id): amount for book_id, amount in dict(purchase_data.get('items', {})).items()}
+    except (TypeError, ValueError):
+        return {'message': 'Book IDs must be numbers'}, 400
+
+    # The amounts must be positive numbers
+    if len(items) == 0 or any(type(amount) is not int or amount <= 0 for amount in items.values()):
+        return {'message': 'Amounts must be positive integers'}, 400
+
+    # Books of other shard groups are not held by this server, so they cannot be bought together
+    response = misdirected(items)
+    if response is not None:
+        return response
+
+    return purchased(items, lambda: purchase_books(items))
+
+
+def purchase_books(items):
+    # Use the replication method to buy the books and make sure all other replicas get the updated books
+    try:
+        books = escrow.purchase_many(items) if escrow.enabled else replication.purchase_many(items)
+
+    # If any of the books does not exist, return an error message
+    except Replication.BookNotFoundError:
+        return {'message': 'Not found'}, 404
+
+    # If any of the books does not have enough copies, return a fail response
+    except Replication.OutOfStockError as error:
+        return {'message': 'Some books are out of stock', 'outOfStock': error.args[0]}, 422
+
+    # If the purchase failed, return a fail response
+    except Replication.OutdatedError:
+        return {'message': 'Purchase could not be processed because some items are not up to date'}, 409
+
+    # If not enough replicas acknowledged the purchase in time, return an unavailable response
+    except Replication.QuorumNotReachedError:
+        return {'message': 'Purchase could not be processed because not enough replicas responded'}, 503
+
+    # Invalidate cache
+    for book_id in items:
+        cache.invalidate_item(book_id)
+
+    # Otherwise, return the updated information of the books formatted with the schema object
+    return items_schema.jsonify(books)
+
+
 # Dump endpoint
+# Without pagination parameters, the whole table is returned as one list
 @app.route('/dump/', methods=['GET'])
 def dump():
-    return dump_schema.jsonify(Book.dump())
+    if is_paginated():
+        return paginated_response(Book.dump(), dump_schema)
+    return dump_schema.jsonify(Book.dump().all())
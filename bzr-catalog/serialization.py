@@ -0,0 +1,156 @@
+from flask_app import app
+from flask.json.provider import DefaultJSONProvider
+from collections.abc import Mapping
+from sqlalchemy.engine import Row
+from json.encoder import encode_basestring_ascii
+import json
+import operator
+
+# Books are formatted with marshmallow schemas, which look up the fields of the schema and dump every book into a
+# dict, which jsonify then encodes to JSON with its keys sorted
+# A compiled schema reads the fields of a book (a Core row, an ORM object or a dict) into a tuple with a single
+# getter, and formats them into a template of the JSON object made once from the field names, which gives the same
+# bytes as jsonify of the schema without building the dict
+# Values other than strings, integers, floats and None (and any setting of the JSON provider other than the default
+# compact output with sorted keys) are formatted by the schema and jsonify instead
+
+
+# Types of the values that the fields of a schema dump unchanged
+plain_types = {str, int, float, type(None)}
+
+
+# Encode a value as json.dumps does, or return None if it is not a string, an integer, a float or None
+def encode_value(value):
+    kind = type(value)
+    if kind is str:
+        return encode_basestring_ascii(value)
+    if kind is int:
+        return int.__repr__(value)
+    # NaN and infinite floats are formatted by json.dumps
+    if kind is float and value - value == 0:
+        return float.__repr__(value)
+    if value is None:
+        return 'null'
+    return None
+
+
+class CompiledSchema:
+
+    # Raised when a value cannot be formatted by the compiled schema, the schema formats the book instead
+    class Unsupported(Exception):
+        pass
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.many = schema.many
+        self.fields = list(schema.dump_fields)
+
+        # jsonify sorts the keys, while json.dumps of a dump keeps the order of the fields of the schema
+        self.sorted_fields = sorted(self.fields)
+        self.order = [self.fields.index(field) for field in self.sorted_fields]
+        self.sorted_template = self.template(self.sorted_fields, ',', ':')
+        self.ordered_template = self.template(self.fields, ', ', ': ')
+
+        self.attributes = self.getter(operator.attrgetter, self.fields)
+        self.items = self.getter(operator.itemgetter, self.fields)
+        self.positions = {}
+
+    # Template of the JSON object of the given fields, with a %s for every value
+    @staticmethod
+    def template(fields, item_separator, key_separator):
+        return '{' + item_separator.join(f'{json.dumps(field).replace("%", "%%")}{key_separator}%s'
+                                         for field in fields) + '}'
+
+    # Getter returning a tuple of the values of the fields, even for a single field
+    @staticmethod
+    def getter(kind, fields):
+        get = kind(*fields)
+        return get if len(fields) > 1 else lambda book: (get(book),)
+
+    # Values of the fields of a book, read by position from a Core row (the positions are found once for every list
+    # of columns the rows have), from the loaded attributes of an ORM object, or from a dict
+    def read(self, book):
+        try:
+            if type(book) is Row:
+                get = self.positions.get(tuple(book._parent._keys))
+                if get is None:
+                    get = self.position_getter(book)
+                return get(book)
+            if isinstance(book, Mapping):
+                return self.items(book)
+            try:
+                return self.items(book.__dict__)
+            except (AttributeError, KeyError):
+                return self.attributes(book)
+        except (AttributeError, KeyError, ValueError):
+            raise self.Unsupported()
+
+    def position_getter(self, row):
+        columns = tuple(row._parent._keys)
+        get = self.getter(operator.itemgetter, [columns.index(field) for field in self.fields])
+        self.positions[columns] = get
+        return get
+
+    def values(self, book):
+        encoded = tuple(map(encode_value, self.read(book)))
+        if None in encoded:
+            raise self.Unsupported()
+        return encoded
+
+    def encode_one(self, book):
+        values = self.values(book)
+        return self.sorted_template % tuple(values[index] for index in self.order)
+
+    # Whether the JSON provider of the application formats responses like the compiled templates
+    @staticmethod
+    def compact():
+        provider = app.json
+        return type(provider) is DefaultJSONProvider and provider.sort_keys and provider.ensure_ascii and \
+            (provider.compact or (provider.compact is None and not app.debug))
+
+    # Encode a book (or a list of books with many) as jsonify does, without the trailing newline
+    def encode(self, obj, many=None):
+        many = self.many if many is None else many
+        if not self.compact():
+            raise self.Unsupported()
+        if many:
+            return '[' + ','.join(self.encode_one(book) for book in obj) + ']'
+        return self.encode_one(obj)
+
+    # Same as jsonify of the schema
+    def jsonify(self, obj, many=None):
+        try:
+            body = self.encode(obj, many)
+        except self.Unsupported:
+            return self.schema.jsonify(obj, many=self.many if many is None else many)
+        return app.response_class(body + '\n', mimetype=app.json.mimetype)
+
+    # Same as the dump of the schema, a dict of the fields in the order of the schema
+    def dump(self, obj, many=None):
+        many = self.many if many is None else many
+        try:
+            if many:
+                return [self.dump_one(book) for book in obj]
+            return self.dump_one(obj)
+        except self.Unsupported:
+            return self.schema.dump(obj, many=many)
+
+    def dump_one(self, book):
+        values = self.read(book)
+        # Other values may be converted by the fields of the schema
+        if not all(type(value) in plain_types for value in values):
+            raise self.Unsupported()
+        return dict(zip(self.fields, values))
+
+    # Same as json.dumps of the dump of a single book, used for newline-delimited JSON
+    def dumps(self, book):
+        try:
+            return self.ordered_template % self.values(book)
+        except self.Unsupported:
+            return json.dumps(self.schema.dump(book, many=False))
+
+
+# Keyword arguments of an HTTP client request with a JSON body, encoded once so that it can be sent to many servers
+# (the json argument of requests encodes it again for every request)
+def json_body(data) -> dict:
+    return {'data': json.dumps(data, allow_nan=False).encode(), 'headers': {'Content-Type': 'application/json'}}
@@ -0,0 +1,176 @@
+from flask_app import app, SNAPSHOT_BOOTSTRAP, SNAPSHOT_COMPRESSION, STREAM_BATCH, IMPORT_BATCH
+from book import Book, LogRecord, LogOffset
+from database import db, backend
+from replication import replication
+from requests import RequestException
+from flask import request, Response, stream_with_context
+from sqlalchemy import select
+from bazar_common import http_client, metrics
+import json
+import threading
+import time
+import zlib
+
+# 30 second timeout for every chunk of the snapshot
+# 100 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_REP_SNAPSHOT variable)
+snapshot_endpoint = http_client.register_endpoint('rep.snapshot', 0.1, 30)
+
+
+# Copies all books of a catalog server to a server with a new database, which then catches up incrementally
+# A snapshot is a stream of newline-delimited JSON, compressed with gzip:
+#   the first line holds the offset of the last record of the replication log of the server
+#   and the offsets it applied from the logs of the other servers, the next lines hold the books,
+#   and the last line holds the number of books, so that a snapshot that was cut off is detected
+# The offsets are read before the books, so books that change while the snapshot is read are newer than the offsets
+# The new server catches up with the logs from these offsets, and skips the records of books it already holds
+# a newer version of (by their sequence numbers)
+class Snapshots:
+
+    def __init__(self, replication, enabled: bool, compression: int, batch_size: int):
+        self.replication = replication
+        self.enabled = enabled
+        self.compression = compression
+        self.batch_size = batch_size
+
+        # Counters of the snapshots
+        self.lock = threading.Lock()
+        self.stats = {
+            # Snapshots sent to other servers, and their bytes after compression
+            'sent': 0,
+            'bytes_sent': 0,
+            # Server this server was bootstrapped from, the number of books copied and the number of seconds it took
+            'restored_from': None,
+            'books_restored': 0,
+            'restore_seconds': None,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Generate the lines of a snapshot of the database, every batch of books as one string
+    def generate(self):
+        header = {
+            'offset': LogRecord.last_offset(),
+            'offsets': {offset.server: offset.offset for offset in LogOffset.query.all()},
+        }
+        yield json.dumps(header) + '\n'
+
+        statement = select(Book.__table__).order_by(Book.id)
+        result = db.session.execute(statement, execution_options={'yield_per': STREAM_BATCH})
+        count = 0
+        for books in result.partitions():
+            count += len(books)
+            yield ''.join(json.dumps(dict(book._mapping)) + '\n' for book in books)
+        yield json.dumps({'books': count}) + '\n'
+
+    # Compress the lines of a snapshot into a gzip stream
+    def compress(self, lines):
+        compressor = zlib.compressobj(self.compression, zlib.DEFLATED, 31)
+        for text in lines:
+            data = compressor.compress(text.encode())
+            if len(data) > 0:
+                self.count('bytes_sent', len(data))
+                yield data
+        data = compressor.flush()
+        self.count('bytes_sent', len(data))
+        yield data
+
+    # Copy the books of the first other server that answers into the (new) database, in a single transaction
+    # Returns whether the books were copied
+    def bootstrap(self) -> bool:
+        if not self.enabled:
+            return False
+
+        for server in self.replication.catalog_addresses:
+            try:
+                if self.restore_from(server):
+                    return True
+
+            # Try the next server if this one is not alive, or its snapshot was cut off
+            except (RequestException, ValueError):
+                db.session.rollback()
+                app.logger.warning(f'Could not copy the books of {server}', exc_info=True)
+        return False
+
+    def restore_from(self, server) -> bool:
+        start = time.monotonic()
+        response = http_client.get(f'{server}/rep/snapshot', snapshot_endpoint, stream=True)
+        with response:
+            if response.status_code != 200:
+                return False
+
+            # Lines are decompressed while they are received (Content-Encoding: gzip)
+            lines = response.iter_lines(chunk_size=64 * 1024)
+            header = json.loads(next(lines, b'null'))
+            if header is None:
+                raise ValueError('The snapshot is empty')
+
+            # The search index is built once all books are copied (or the copy failed)
+            backend.drop_search_index(db.session)
+            try:
+                restored = 0
+                batch = []
+                trailer = None
+                for line in lines:
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    if 'id' not in item:
+                        trailer = item
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        restored += self.insert(batch)
+                        batch = []
+                if len(batch) > 0:
+                    restored += self.insert(batch)
+
+                if trailer is None or trailer['books'] != restored:
+                    raise ValueError('The snapshot was cut off')
+
+                # Catch up with the logs of the other servers from the offsets of the snapshot
+                offsets = {**header['offsets'], server: header['offset']}
+                for address, offset in offsets.items():
+                    if address in self.replication.catalog_addresses:
+                        db.session.merge(LogOffset(server=address, offset=offset))
+                db.session.commit()
+            finally:
+                db.session.rollback()
+                backend.create_search_index(db.session)
+
+        with self.lock:
+            self.stats['restored_from'] = server
+            self.stats['books_restored'] = restored
+            self.stats['restore_seconds'] = round(time.monotonic() - start, 6)
+        app.logger.info(f'Copied {restored} books from {server}')
+        return True
+
+    # Add a batch of copied books, without recording them in the replication log, since they are not changes
+    def insert(self, books) -> int:
+        db.session.execute(Book.__table__.insert(), books)
+        return len(books)
+
+
+snapshots = Snapshots(replication, SNAPSHOT_BOOTSTRAP, SNAPSHOT_COMPRESSION, IMPORT_BATCH)
+
+
+# Stream a snapshot of all books, compressed with gzip if the requester accepts it
+@app.route('/rep/snapshot', methods=['GET'])
+def replication_snapshot():
+    snapshots.count('sent')
+    lines = stream_with_context(snapshots.generate())
+    if 'gzip' not in request.accept_encodings:
+        return Response(lines, mimetype='application/x-ndjson')
+    return Response(snapshots.compress(lines), mimetype='application/x-ndjson', headers={'Content-Encoding': 'gzip'})
+
+
+# Snapshot statistics endpoint
+@app.route('/stats/snapshot', methods=['GET'])
+def snapshot_stats():
+    with snapshots.lock:
+        return dict(snapshots.stats)
+
+
+metrics.register_stats('snapshot', snapshot_stats)
@@ -0,0 +1,115 @@
+from flask_app import app
+from sqlalchemy import text
+import os
+import threading
+import time
+import zlib
+
+# fcntl is only available on Unix, elsewhere the server always runs in a single process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Coordination between the processes of a server that runs several workers (see gunicorn.conf.py)
+# All worker processes share the database, so they use locks of the database (see backends.py):
+# lock files next to an SQLite database file, or advisory locks of a PostgreSQL server
+
+
+# Exclusive lock of a file, shared by all processes of the server
+# The lock is released when the process that holds it exits, even if it crashes
+class FileLock:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    # Returns whether the lock was acquired, it is always acquired if blocking is True
+    def acquire(self, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+
+        self.file = open(self.path, 'a')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# Exclusive lock of a PostgreSQL server, shared by all processes that use the same database, on any host
+# The lock is held by a database connection, and released when the connection is closed, even if the process crashes
+class AdvisoryLock:
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        # Advisory locks are identified by a number
+        self.key = zlib.crc32(name.encode())
+        self.connection = None
+
+    # Returns whether the lock was acquired, it is always acquired if blocking is True
+    def acquire(self, blocking: bool = True) -> bool:
+        # The connection does not keep a transaction open while it holds the lock
+        connection = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        if blocking:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': self.key})
+        elif not connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': self.key}).scalar():
+            connection.close()
+            return False
+        self.connection = connection
+        return True
+
+    def release(self):
+        if self.connection is not None:
+            self.connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.key})
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# Runs the background processes of the server (catch-up, anti-entropy) in exactly one worker process
+# Every worker tries to hold the leader lock, the one that gets it starts the processes
+# If the leader exits, the lock is released and one of the other workers takes over
+class Leader:
+
+    def __init__(self, lock, interval: float = 1.0):
+        self.lock = lock
+        self.interval = interval
+        self.thread = None
+
+    # Call the given function once this process becomes the leader
+    def start(self, become_leader):
+        if self.lock.acquire(blocking=False):
+            become_leader()
+            return
+
+        self.thread = threading.Thread(target=self.run, args=(become_leader,), name='leader', daemon=True)
+        self.thread.start()
+
+    def run(self, become_leader):
+        while not self.lock.acquire(blocking=False):
+            time.sleep(self.interval)
+
+        app.logger.info(f'Process {os.getpid()} runs the background processes')
+        become_leader()
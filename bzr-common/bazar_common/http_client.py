@@ -0,0 +1,219 @@
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from os import environ
+from bazar_common import metrics, tracing
+import contextvars
+import queue
+import threading
+import time
+import requests
+
+# Shared HTTP client used for all requests sent to other services
+# All requests go through one session, which keeps a pool of keep-alive connections for each host
+# The sizes of the pools and the retries are set by the service with configure, and init_app serves the statistics
+
+
+# Counters of the connection pools, shared between all hosts
+class PoolCounters:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {
+            # Number of requests sent (each one takes a connection from a pool)
+            'requests': 0,
+            # Number of times a pool had no free connection, so a new one was created
+            'pool_misses': 0,
+            # Number of requests sent on an already open connection (no new TCP handshake)
+            'connections_reused': 0,
+            # Number of extra requests sent by hedged reads, and number of times an extra request answered first
+            'hedged_requests': 0,
+            'hedge_wins': 0,
+        }
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+counters = PoolCounters()
+
+
+# Connection pool classes that count how their connections are used
+class CountingPoolMixin:
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if getattr(conn, 'sock', None) is not None:
+            counters.increment('connections_reused')
+        return conn
+
+    def _new_conn(self):
+        counters.increment('pool_misses')
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        counters.increment('requests')
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+# Transport adapter that creates counting connection pools
+class PooledAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+# Create the shared session
+session = requests.Session()
+adapter = None
+
+
+# Mount the adapter of the shared session, with pools for the given number of hosts of the given number of
+# connections each, and the number of times a request is retried when the connection could not be established
+# Only connection failures are retried, because the request did not reach the server
+# Read failures are not retried, since requests such as replication updates are not idempotent
+def configure(pool_hosts: int, pool_size: int, retries: int):
+    global adapter
+    retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=0.05,
+                  raise_on_status=False)
+    adapter = PooledAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+configure(10, 32, 0)
+
+
+# Drop the pooled connections inherited from the parent process, a connection must not be used by two processes
+def reset():
+    adapter.poolmanager.clear()
+
+
+# Timeouts (connection establishment, whole response) in seconds of each endpoint
+timeouts = {}
+
+
+# Register an endpoint with its default timeout
+# The timeout can be overridden with an environment variable named TIMEOUT_<NAME>, formatted as "connect,read"
+def register_endpoint(name, connect: float, read: float):
+    value = environ.get(f'TIMEOUT_{name.upper().replace(".", "_")}')
+    if value is not None and value.strip() != '':
+        connect, read = [float(part) for part in value.split(',')]
+    timeouts[name] = (connect, read)
+    return name
+
+
+# Send a request to an endpoint through the shared session using the timeout of that endpoint
+# The time until the response started and its status (or the error) are recorded in the metrics of the endpoint,
+# and in a span if the request being served is traced (see bazar_common/tracing.py)
+def request(method, url, endpoint, **kwargs):
+    span = tracing.start_client_span(endpoint, method, url)
+    if span is not None:
+        kwargs['headers'] = {**kwargs.get('headers', {}), 'traceparent': span.header()}
+
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=timeouts[endpoint], **kwargs)
+    except requests.RequestException as error:
+        metrics.outbound_total.inc(endpoint, type(error).__name__)
+        if span is not None:
+            span.end(type(error).__name__)
+        raise
+    finally:
+        metrics.outbound_seconds.observe(time.perf_counter() - start, endpoint)
+    metrics.outbound_total.inc(endpoint, response.status_code)
+    if span is not None:
+        span.end(response.status_code)
+    return response
+
+
+def get(url, endpoint, **kwargs):
+    return request('GET', url, endpoint, **kwargs)
+
+
+def post(url, endpoint, **kwargs):
+    return request('POST', url, endpoint, **kwargs)
+
+
+def put(url, endpoint, **kwargs):
+    return request('PUT', url, endpoint, **kwargs)
+
+
+def delete(url, endpoint, **kwargs):
+    return request('DELETE', url, endpoint, **kwargs)
+
+
+# Send a read request to the first URL, and to the next URL as well whenever no answer arrived after the delay
+# (or the previous request failed), the URLs should point to the same resource on different servers
+# Returns the first answer that is not a server error, the slower requests are left to finish in the background
+# Only reads may be hedged, since the request may be processed by more than one server
+def hedged_get(urls, endpoint, delay: float, **kwargs):
+    answers = queue.Queue()
+
+    def send(index):
+        try:
+            answers.put((index, get(urls[index], endpoint, **kwargs)))
+        except requests.RequestException as error:
+            answers.put((index, error))
+
+    # Send the request to the next URL
+    def send_next():
+        nonlocal sent
+        threading.Thread(target=contextvars.copy_context().run, args=(send, sent), name='hedge', daemon=True).start()
+        sent += 1
+        if sent > 1:
+            counters.increment('hedged_requests')
+
+    sent, received, answer = 0, 0, None
+    send_next()
+    while received < sent:
+        try:
+            index, answer = answers.get(timeout=delay if sent < len(urls) else None)
+        except queue.Empty:
+            send_next()
+            continue
+
+        received += 1
+        if not isinstance(answer, Exception) and answer.status_code < 500:
+            if index > 0:
+                counters.increment('hedge_wins')
+            return answer
+
+        # Do not wait for the delay if every request sent so far failed
+        if received == sent and sent < len(urls):
+            send_next()
+
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
+
+
+# Return the pool counters
+# Every request that did not need a new connection was served by a pooled connection
+def stats():
+    values = counters.snapshot()
+    values['pool_hits'] = max(0, values['requests'] - values['pool_misses'])
+    return values
+
+
+# Serve the HTTP client statistics endpoint (/stats/http)
+def init_app(app):
+    app.add_url_rule('/stats/http', 'http_stats', stats, methods=['GET'])
+    metrics.register_stats('http', stats)
@@ -0,0 +1,185 @@
+from flask import request, g, Response
+from bisect import bisect_left
+import threading
+import time
+
+# Metrics of the server in the Prometheus text format, served by the /metrics endpoint
+# Counters and histograms are updated while requests are served, so updating them only takes a lock and a dict lookup
+# Callback metrics read values that are already kept elsewhere (e.g. the statistics of the /stats endpoints)
+# only when the metrics are requested, so they cost nothing while requests are served
+# Metrics are kept in the memory of the process, so when the server runs several worker processes,
+# each request to /metrics is answered with the metrics of one of them
+
+# Upper bounds in seconds of the buckets of the latency histograms
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# All metrics of the process, in the order they are shown
+registry = []
+
+
+# A metric with a value for every combination of its label values
+# If a function is passed, it is called when the metrics are requested and returns the values
+# as a dict of label value tuples (or a single number if the metric has no labels)
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=(), function=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    # Values of the metric, keyed by their label value tuples
+    def collect(self):
+        if self.function is None:
+            with self.lock:
+                return dict(self.values)
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return values
+
+    # Lines of the metric in the text format
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for label_values, value in self.collect().items():
+            if isinstance(value, (int, float)):
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, value=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+# A histogram keeps the number of observed values in each bucket, and their sum
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=latency_buckets):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # The last count is of the values larger than every bucket, followed by the sum of the values
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self):
+        with self.lock:
+            return {label_values: list(counts) for label_values, counts in self.values.items()}
+
+    # Buckets are cumulative in the text format, each one counts the values lower than or equal to its bound
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        labels = self.labels + ('le',)
+        for label_values, counts in self.collect().items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                bucket_labels = format_labels(labels, label_values + (format_value(bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, label_values)} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, label_values)} {total}')
+        return lines
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+# Statistics functions of the /stats endpoints, keyed by their area
+stats_functions = {}
+
+
+# Show the numeric values of a statistics dict (e.g. the one returned by a /stats endpoint) as a gauge
+# labelled by the area and the name of the value, values which are not numbers are left out
+def register_stats(area, function):
+    stats_functions[area] = function
+
+
+def collect_stats():
+    return {(area, name): value
+            for area, function in stats_functions.items()
+            for name, value in function().items()}
+
+
+stats = Gauge('bazar_stats', 'Values of the /stats endpoints', ('area', 'name'), function=collect_stats)
+
+# Requests served by this server, by route (the rule of the URL, e.g. /query/item/<item_id>)
+requests_total = Counter('bazar_http_requests_total', 'Requests served', ('method', 'route', 'status'))
+request_seconds = Histogram('bazar_http_request_seconds', 'Time to handle a request, until its response starts',
+                            ('method', 'route'))
+
+# Requests sent to other servers, by endpoint (see http_client.register_endpoint)
+# The status is the status code of the response, or the name of the error if there was no response
+outbound_total = Counter('bazar_outbound_requests_total', 'Requests sent to other servers', ('endpoint', 'status'))
+outbound_seconds = Histogram('bazar_outbound_request_seconds', 'Time until the response of a request sent to another '
+                             'server started', ('endpoint',))
+
+# Other servers that could not be reached, by the operation that gave up on them
+peer_failures = Counter('bazar_peer_failures_total', 'Requests to other servers that could not reach them',
+                        ('peer', 'operation'))
+
+
+# Time and count every request served by the application, and serve the metrics endpoint (/metrics)
+def init_app(app):
+    app.before_request(start_timer)
+    app.after_request(count_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
+
+
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+# Count every request once its response is ready, requests that are not matched by any route are counted together
+def count_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_seconds.observe(time.perf_counter() - start, request.method, route)
+        requests_total.inc(request.method, route, response.status_code)
+    return response
+
+
+# Metrics endpoint
+def metrics_endpoint():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,40 @@
+from bisect import bisect
+import hashlib
+
+# Books are split across groups of catalog servers (shards) by their IDs, with consistent hashing
+# Every shard is placed at many points of a ring of hash values (virtual nodes), and a book belongs to the shard of
+# the first point after the hash of its ID, so adding a shard only moves the books of the points it takes over
+# The catalog servers of a shard only hold and replicate its books, and the order server sends the requests of a book
+# to its shard using the same ring, so both must be given the same shard names and number of virtual nodes
+
+
+# Position of a key on the ring
+def position(key) -> int:
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class Ring:
+
+    def __init__(self, shards, virtual_nodes: int = 64):
+        self.shards = list(shards)
+        points = sorted((position(f'{shard}#{index}'), shard) for shard in self.shards for index in range(virtual_nodes))
+        self.positions = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    # Name of the shard a book belongs to
+    def owner(self, book_id):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        index = bisect(self.positions, position(int(book_id))) % len(self.positions)
+        return self.owners[index]
+
+
+# Parse shard groups formatted as "<name>=<address> | <address>; <name>=<address>", in the order they are listed
+def parse_groups(value) -> dict:
+    groups = {}
+    for group in value.split(';'):
+        if group.strip() == '':
+            continue
+        name, addresses = group.split('=', 1)
+        groups[name.strip()] = [address.strip() for address in addresses.split('|') if address.strip() != '']
+    return groups
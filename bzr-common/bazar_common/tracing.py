@@ -0,0 +1,189 @@
+from flask import request, g
+from collections import deque
+from contextvars import ContextVar
+from bazar_common import metrics
+import json
+import os
+import random
+import threading
+import time
+
+# Distributed tracing of the requests served by the order and catalog servers
+# Every request served is a server span, and every request sent to another server through http_client is a client
+# span, a child of the span of the request being served
+# The trace is passed to other servers in the traceparent header (W3C Trace Context):
+#   00-<trace ID, 32 hex digits>-<ID of the parent span, 16 hex digits>-<flags, 01 if the trace is sampled>
+# Whether a trace is recorded is decided once by the first server (with the TRACE_SAMPLE probability),
+# and the other servers follow the flag of the header, so traces are recorded on every hop or on none
+# Spans of traces that are not sampled only pass the trace on and are not recorded, and with TRACE_SAMPLE=0
+# requests without a traceparent header are not traced at all
+# Recorded spans are kept in memory (see the /traces endpoint), and appended to a file as JSON lines if one is set
+# The settings of the service are passed to init_app, which registers the hooks and endpoints of the application
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'sampled', 'name', 'kind', 'start', 'start_time', 'attributes')
+
+    def __init__(self, trace_id, parent_id, sampled: bool, name, kind, **attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.name = name
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.start_time = time.time()
+        self.attributes = attributes
+
+    # Value of the traceparent header of the requests sent by this span
+    def header(self):
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    # Record the span with its status (status code of the response, or name of the error)
+    def end(self, status):
+        if self.sampled:
+            tracer.record({
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'service': tracer.service,
+                'name': self.name,
+                'kind': self.kind,
+                'start': self.start_time,
+                'duration': round(time.perf_counter() - self.start, 6),
+                'status': status,
+                **self.attributes,
+            })
+
+
+# Collects the recorded spans of the process
+# sample is the probability that a request without a trace is traced (0 to only follow the traces of other servers)
+class Tracer:
+
+    def __init__(self, service, sample: float, file, buffer_size: int):
+        self.service = service
+        self.sample = sample
+        self.file = file
+        self.output = None
+        self.output_pid = None
+        self.lock = threading.Lock()
+        self.spans = deque(maxlen=buffer_size)
+        self.stats = {
+            # Traces started by this server, and spans recorded
+            'traces_started': 0,
+            'traces_sampled': 0,
+            'spans': 0,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def record(self, span):
+        line = json.dumps(span) + '\n' if self.file is not None else None
+        with self.lock:
+            self.stats['spans'] += 1
+            self.spans.append(span)
+            if line is not None:
+                # Every worker process opens the file itself, the lines it appends are written whole
+                if self.output_pid != os.getpid():
+                    self.output = open(self.file, 'a', buffering=1)
+                    self.output_pid = os.getpid()
+                self.output.write(line)
+
+    # Recorded spans kept in memory, of a single trace if an ID is passed
+    def snapshot(self, trace_id=None):
+        with self.lock:
+            return [span for span in self.spans if trace_id is None or span['trace_id'] == trace_id]
+
+
+# Replaced by init_app with the settings of the service
+tracer = Tracer(None, 0, None, 10000)
+
+# Span of the request being served by the current thread (or of the request that started a background task)
+current_span = ContextVar('current_span', default=None)
+
+
+def current():
+    return current_span.get()
+
+
+# Make a span the current span of the calling context, returns a token to restore the previous one
+def activate(span):
+    return current_span.set(span)
+
+
+def deactivate(token):
+    current_span.reset(token)
+
+
+# Parse a traceparent header, returns the trace ID, the parent span ID and whether the trace is sampled
+def parse(header):
+    parts = header.split('-') if header is not None else []
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == '01'
+
+
+# Start the span of a request sent to another server, if the current request is traced
+# The caller adds the header of the span to the request, and ends the span
+def start_client_span(endpoint, method, url):
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace_id, parent.span_id, parent.sampled, endpoint, 'client', method=method, url=url)
+
+
+# Trace the requests served by the application, and serve the recorded spans (/traces) and the statistics
+def init_app(app, service, sample: float, file, buffer_size: int):
+    global tracer
+    tracer = Tracer(service, sample, file, buffer_size)
+    app.before_request(start_server_span)
+    app.after_request(end_server_span)
+    app.teardown_request(clear_server_span)
+    app.add_url_rule('/traces', 'traces', traces, methods=['GET'])
+    app.add_url_rule('/stats/tracing', 'tracing_stats', tracing_stats, methods=['GET'])
+    metrics.register_stats('tracing', tracing_stats)
+
+
+# Start the span of every request served, following the traceparent header of the request if it has one
+def start_server_span():
+    context = parse(request.headers.get('traceparent'))
+    if context is None:
+        if tracer.sample <= 0:
+            return
+        sampled = random.random() < tracer.sample
+        tracer.count('traces_started')
+        if sampled:
+            tracer.count('traces_sampled')
+        context = (os.urandom(16).hex(), None, sampled)
+
+    trace_id, parent_id, sampled = context
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    span = Span(trace_id, parent_id, sampled, route, 'server', method=request.method, host=request.host)
+    g.trace_span = span
+    g.trace_token = activate(span)
+
+
+def end_server_span(response):
+    span = g.pop('trace_span', None)
+    if span is not None:
+        span.end(response.status_code)
+    return response
+
+
+def clear_server_span(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        deactivate(token)
+
+
+# Recorded spans endpoint, ?trace_id= returns the spans of a single trace
+def traces():
+    return {'spans': tracer.snapshot(request.args.get('trace_id'))}
+
+
+# Tracing statistics endpoint
+def tracing_stats():
+    with tracer.lock:
+        return dict(tracer.stats)
@@ -6,6 +6,17 @@ import errorhandlers
 
 # Import the routes
 import routes
+from ledger import ledger
+
+from bazar_common import http_client
+
+
+# Start a worker process of gunicorn, after it loaded the application (see gunicorn.conf.py)
+# With preloading, the application was loaded by the parent process before forking the worker,
+# so the connections and the ledger writer it inherited are dropped
+def start_worker():
+    http_client.reset()
+    ledger.reset()
 
 
 # Run Flask application instance
@@ -0,0 +1,104 @@
+from bazar_common import http_client, metrics
+import random
+import requests
+import threading
+import time
+
+
+# Client-side load balancer of the reads sent to the catalog replicas
+# Every read goes to the less busy of two randomly chosen replicas (power of two choices),
+# where a replica is busier if more requests sent to it are still waiting for an answer
+# Replicas that fail several requests in a row are ejected, and are not chosen again until a cool-off time passed
+class Balancer:
+
+    class Replica:
+
+        def __init__(self, address):
+            self.address = address
+
+            # Number of requests sent to the replica that were not answered yet
+            self.outstanding = 0
+
+            # Number of requests that failed in a row, and the time until which the replica is ejected
+            self.failures = 0
+            self.ejected_until = 0.0
+
+            self.stats = {'requests': 0, 'failures': 0, 'ejections': 0}
+
+    def __init__(self, addresses, max_failures: int = 3, cool_off: float = 5.0):
+        self.replicas = [self.Replica(address) for address in addresses]
+        self.max_failures = max_failures
+        self.cool_off = cool_off
+        self.lock = threading.Lock()
+
+    # Choose a replica that was not tried yet, the lock must be held
+    # If every replica is ejected, the ejected replicas are chosen as well
+    def choose(self, tried=()) -> Replica:
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica not in tried]
+        healthy = [replica for replica in candidates if replica.ejected_until <= now]
+        if len(healthy) > 0:
+            candidates = healthy
+        return min(random.sample(candidates, min(2, len(candidates))), key=lambda replica: replica.outstanding)
+
+    # Choose a replica, and count the request sent to it
+    def acquire(self, tried=()) -> Replica:
+        with self.lock:
+            replica = self.choose(tried)
+            replica.outstanding += 1
+            replica.stats['requests'] += 1
+            return replica
+
+    # Record the outcome of a request sent to a replica
+    # A replica that keeps failing after its cool-off is ejected again at its next failure
+    def release(self, replica: Replica, success: bool):
+        with self.lock:
+            replica.outstanding -= 1
+            if success:
+                replica.failures = 0
+                return
+
+            replica.failures += 1
+            replica.stats['failures'] += 1
+            if replica.failures >= self.max_failures:
+                replica.ejected_until = time.monotonic() + self.cool_off
+                replica.stats['ejections'] += 1
+
+    # Send a read request to a replica chosen by the balancer
+    # Reads can be sent to any replica, so a read that fails is sent again to another replica, until none is left
+    def get(self, path, endpoint, **kwargs):
+        tried = []
+        while True:
+            replica = self.acquire(tried)
+            tried.append(replica)
+            try:
+                response = http_client.get(f'{replica.address}{path}', endpoint, **kwargs)
+            except requests.RequestException:
+                metrics.peer_failures.inc(replica.address, 'read')
+                self.release(replica, False)
+                if len(tried) == len(self.replicas):
+                    raise
+                continue
+
+            self.release(replica, response.status_code < 500)
+            if response.status_code < 500 or len(tried) == len(self.replicas):
+                return response
+
+    # Send a read request to the replica chosen by the balancer, and to the other replicas as well
+    # if it does not answer within the delay (see http_client.hedged_get)
+    # The other replicas are tried in order of health, then of outstanding requests
+    def hedged_get(self, path, endpoint, delay: float, **kwargs):
+        now = time.monotonic()
+        with self.lock:
+            replica = self.choose()
+            others = sorted([each for each in self.replicas if each is not replica],
+                            key=lambda each: (each.ejected_until > now, each.outstanding))
+        urls = [f'{each.address}{path}' for each in [replica] + others]
+        return http_client.hedged_get(urls, endpoint, delay, **kwargs)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {replica.address: {**replica.stats, 'outstanding': replica.outstanding,
+                                      'ejected': replica.ejected_until > now}
+                    for replica in self.replicas}
@@ -1,12 +1,101 @@
 from flask import Flask
+from bazar_common.sharding import parse_groups
 from os import environ
+from bazar_common import http_client, metrics, tracing
 
 # Flask application instance
 app = Flask(__name__)
 
 # Get addresses of catalog and front end servers from the environment variables
-CATALOG_ADDRESS = environ.get('http://192.168.1.13:5000')
-FRONT_END_ADDRESS = environ.get('http://192.168.1.15:5000')
+# e.g. CATALOG_ADDRESS='http://192.168.1.13:5000'
+#      FRONT_END_ADDRESS='http://192.168.1.15:5000'
+CATALOG_ADDRESS = environ.get('CATALOG_ADDRESS')
+FRONT_END_ADDRESS = environ.get('FRONT_END_ADDRESS')
+
+# Addresses of all catalog servers that book reads are spread across, CATALOG_ADDRESS is always one of them
+# Writes (updates and purchases) are always sent to CATALOG_ADDRESS
+# e.g. CATALOG_ADDRESSES='http://192.168.1.13:5000 | http://192.168.1.17:5000'
+CATALOG_ADDRESSES = [CATALOG_ADDRESS]
+for address in environ.get('CATALOG_ADDRESSES', '').split('|'):
+    if address.strip() != '' and address.strip() not in CATALOG_ADDRESSES:
+        CATALOG_ADDRESSES.append(address.strip())
+
+# Shard groups of the catalog servers, when the books are split across groups (see bazar_common/sharding.py)
+# Every group is named, and its addresses are separated by "|", the groups are separated by ";"
+# e.g. CATALOG_SHARDS='a=http://192.168.1.13:5000 | http://192.168.1.17:5000; b=http://192.168.1.18:5000'
+# The names must be the SHARDS of the catalog servers, and the writes of a book are sent to the first server of its
+# group, while its reads are spread across all of them
+# Without it, CATALOG_ADDRESS and CATALOG_ADDRESSES form a single group holding every book
+CATALOG_SHARDS = parse_groups(environ.get('CATALOG_SHARDS', ''))
+if len(CATALOG_SHARDS) == 0:
+    CATALOG_SHARDS = {'': CATALOG_ADDRESSES}
+
+# Number of points of every shard on the ring of book IDs, it must be the same as in the catalog servers
+SHARD_VIRTUAL_NODES = int(environ.get('SHARD_VIRTUAL_NODES', 64))
+
+# How purchases are sent to the catalog server:
+#   purchase: a single atomic purchase request (default)
+#   update: read the book, then update its quantity (for catalog servers without the purchase endpoint)
+BUY_MODE = environ.get('BUY_MODE', 'purchase')
+if BUY_MODE not in ('purchase', 'update'):
+    raise ValueError('BUY_MODE must be purchase or update')
+
+# Number of times a purchase is retried when the catalog server rejects it because of a concurrent update
+BUY_RETRIES = int(environ.get('BUY_RETRIES', 5))
+
+# Time to wait before retrying a purchase, in seconds
+# The n-th retry waits a random time between 0 and min(BUY_BACKOFF_MAX, BUY_BACKOFF * 2^n),
+# so buyers of the same book do not retry at the same moment again
+BUY_BACKOFF = float(environ.get('BUY_BACKOFF', 0.01))
+BUY_BACKOFF_MAX = float(environ.get('BUY_BACKOFF_MAX', 0.5))
+
+# Retries can add at most this fraction of extra purchase requests on top of the first attempts
+# Once the budget is spent, rejected purchases fail without retrying until more purchases succeed
+RETRY_BUDGET = float(environ.get('RETRY_BUDGET', 0.2))
+
+# Number of seconds to wait for a book read before sending it to the next catalog server as well (0 to never do it)
+HEDGE_DELAY = float(environ.get('HEDGE_DELAY', 0))
+
+# Number of requests in a row a catalog server must fail to be ejected from the reads,
+# and number of seconds it stays ejected
+EJECT_FAILURES = int(environ.get('EJECT_FAILURES', 3))
+EJECT_COOL_OFF = float(environ.get('EJECT_COOL_OFF', 5))
+
+# Order ledger settings (see ledger.py)
+# Name of the SQLite file every order is recorded in, in the service directory
+LEDGER_FILE = environ.get('LEDGER_FILE', 'ledger.sqlite')
+
+# With LEDGER_GROUP_COMMIT=1 (default), the orders recorded at the same time are written with a single commit
+# (and a single fsync), with 0 every order is committed on its own
+# At most LEDGER_BATCH orders are committed together, and the commit waits up to LEDGER_DELAY seconds for more
+# orders after the first one (0 to only commit the orders that arrived while the previous commit was written)
+LEDGER_GROUP_COMMIT = environ.get('LEDGER_GROUP_COMMIT', '1') != '0'
+LEDGER_BATCH = int(environ.get('LEDGER_BATCH', 256))
+LEDGER_DELAY = float(environ.get('LEDGER_DELAY', 0))
+
+# Number of seconds an order with an idempotency key is held by the request sending it to the catalog server
+# An order that has no response after it (the order service stopped while sending it, or its outcome is unknown)
+# is sent again by the next order with the same key, it must be longer than the time to place an order with its retries
+# With BUY_MODE=update, the catalog server cannot tell whether it already made the order, so the unknown outcome is
+# returned for the key after the lease instead
+LEDGER_LEASE = float(environ.get('LEDGER_LEASE', 30))
+
+# HTTP client settings for requests sent to other servers
+# Number of hosts to keep a connection pool for, and number of keep-alive connections kept for each host
+HTTP_POOL_HOSTS = int(environ.get('HTTP_POOL_HOSTS', 10))
+HTTP_POOL_SIZE = int(environ.get('HTTP_POOL_SIZE', 32))
+
+# Number of times a request is retried when the connection to the server could not be established
+HTTP_RETRIES = int(environ.get('HTTP_RETRIES', 0))
+
+# Request tracing settings (see bazar_common/tracing.py)
+# Probability that a request without a trace is traced (0 to only follow the traces of other servers),
+# file the spans are appended to (none by default), number of spans kept in memory,
+# and name of this service in the spans
+TRACE_SAMPLE = float(environ.get('TRACE_SAMPLE', 0))
+TRACE_FILE = environ.get('TRACE_FILE')
+TRACE_BUFFER = int(environ.get('TRACE_BUFFER', 10000))
+TRACE_SERVICE = environ.get('TRACE_SERVICE', 'order')
 
 
 # Get the flask environment settings from the environment variables
@@ -15,3 +104,14 @@ app.config['True'] = bool(environ.get('True'))
 
 # Get the application port from the environment variables
 port = int(environ.get('PORT', 5000))
+
+
+# Count and time the requests of the application, and serve them at /metrics
+metrics.init_app(app)
+
+# Trace the requests of the application (see bazar_common/tracing.py)
+tracing.init_app(app, TRACE_SERVICE, TRACE_SAMPLE, TRACE_FILE, TRACE_BUFFER)
+
+# Size the connection pools of the shared HTTP client, and serve its statistics at /stats/http
+http_client.configure(HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_RETRIES)
+http_client.init_app(app)
@@ -0,0 +1,39 @@
+# Production server settings, used with: gunicorn --config gunicorn.conf.py app:app
+# The settings are read from the environment variables, like the settings of the application (see flask_app.py)
+# Sending SIGHUP to the main gunicorn process replaces the workers gracefully, finishing the requests they serve
+from os import environ
+
+# Get the application port from the environment variables
+bind = f"0.0.0.0:{environ.get('PORT', 5000)}"
+
+# Number of worker processes, and number of threads serving requests in each worker
+workers = int(environ.get('WORKERS', 1))
+threads = int(environ.get('THREADS', 8))
+
+# Worker type, gevent serves every request in a greenlet instead of a thread, so a worker can wait for
+# thousands of catalog requests at the same time (the threads setting is not used)
+# Set WORKER_CLASS=gthread to serve requests with threads instead
+worker_class = environ.get('WORKER_CLASS', 'gevent')
+
+# Maximum number of requests served at the same time by a gevent worker
+# HTTP_POOL_SIZE limits the number of connections to the catalog server that are kept open between requests
+worker_connections = int(environ.get('WORKER_CONNECTIONS', 1000))
+
+# Load the application once in the main process before forking the workers (PRELOAD=1),
+# instead of loading it in every worker
+# gevent workers should not preload, the application must be loaded after gevent patched the standard library
+preload_app = environ.get('PRELOAD', '0') != '0'
+
+# Number of seconds a worker has to finish its requests when it is stopped or replaced
+graceful_timeout = int(environ.get('GRACEFUL_TIMEOUT', 30))
+
+# Replace every worker after it served this many requests (0 to never replace them), with some jitter
+# so that the workers are not all replaced at the same time
+max_requests = int(environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+
+# Drop the connections every worker inherited from the main process
+def post_worker_init(worker):
+    import app
+    app.start_worker()
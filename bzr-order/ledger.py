@@ -0,0 +1,372 @@
+from flask import request
+from flask_app import app, LEDGER_FILE, LEDGER_GROUP_COMMIT, LEDGER_BATCH, LEDGER_DELAY, LEDGER_LEASE
+from bazar_common import metrics
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Every order sent to the catalog servers is recorded in a SQLite table (the order ledger), with the response it got,
+# before the response is returned, so an order that was answered is never lost
+# An order can be given an idempotency key (Idempotency-Key header), which is recorded before the order is sent to
+# the catalog server: an order with a key that was already used is not sent again, and gets the recorded response
+# An order with a key that has no response is held by the request sending it for LEDGER_LEASE seconds from the time it
+# was created, after which the next order with the key takes it over and sends it again with the key, which the
+# catalog server uses to make the purchase only once (see ordered)
+schema = [
+    'CREATE TABLE IF NOT EXISTS orders ('
+    '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    '    idempotency_key TEXT UNIQUE,'
+    # Books of the order, as a JSON object of book IDs and number of copies
+    '    items TEXT NOT NULL,'
+    # Response of the order, the status is NULL while the order is sent to the catalog server, and stays NULL if
+    # its outcome is unknown
+    '    status INTEGER,'
+    '    response BLOB,'
+    '    content_type TEXT,'
+    '    created REAL NOT NULL,'
+    '    completed REAL'
+    ')',
+]
+
+
+# A statement waiting to be committed by the writer thread
+class Write:
+
+    def __init__(self, statement, parameters):
+        self.statement = statement
+        self.parameters = parameters
+        self.done = threading.Event()
+        self.result = None
+        self.changed = 0
+        self.error = None
+
+
+# Writes the orders to the ledger file
+# With group commit, the threads serving requests queue their statements, and a single writer thread commits all
+# queued statements in one transaction, so many orders share the cost of one fsync
+# Without it, every statement is committed on its own by the thread serving the request
+# Every statement runs in its own savepoint, so a statement that fails (a reused idempotency key) does not fail
+# the other statements of its transaction
+class Ledger:
+
+    def __init__(self, file, group_commit: bool, batch_size: int, delay: float):
+        self.file = file
+        self.group_commit = group_commit
+        self.batch_size = batch_size
+        self.delay = delay
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.writer = None
+        self.readers = threading.local()
+
+        # Held while writing without group commit, and while starting the writer thread
+        self.write_lock = threading.Lock()
+
+        # Counters of the ledger
+        self.lock = threading.Lock()
+        self.stats = {
+            # Orders recorded, and orders answered with the response recorded for their idempotency key
+            'orders': 0,
+            'replayed': 0,
+            # Orders rejected because the order with the same idempotency key was not answered yet
+            'in_progress': 0,
+            # Orders whose outcome is unknown, and orders without a response that were sent again after their lease
+            'unknown': 0,
+            'taken_over': 0,
+            # Statements written and transactions committed, their ratio is the number of orders per fsync
+            'writes': 0,
+            'commits': 0,
+        }
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Open a connection to the ledger file, creating the table if needed
+    # Every commit is written to disk before it returns (synchronous=FULL)
+    def connect(self):
+        connection = sqlite3.connect(self.file, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        for statement in schema:
+            connection.execute(statement)
+        return connection
+
+    # Drop the connections and the writer thread inherited from the parent process (see app.py)
+    def reset(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.writer = None
+        self.readers = threading.local()
+
+    def reader(self):
+        if getattr(self.readers, 'connection', None) is None:
+            self.readers.connection = self.connect()
+        return self.readers.connection
+
+    # Run a statement and commit it, returns the ID of the inserted row, or raises the error of the statement
+    def write(self, statement, parameters):
+        return self.run_write(statement, parameters).result
+
+    # Run a statement and commit it, returns the write with the ID of the inserted row and the number of changed rows
+    def run_write(self, statement, parameters):
+        if not self.group_commit:
+            with self.write_lock:
+                if self.writer is None:
+                    self.writer = self.connect()
+                write = Write(statement, parameters)
+                self.commit([write])
+        else:
+            self.start()
+            write = Write(statement, parameters)
+            self.queue.put(write)
+            write.done.wait()
+
+        if write.error is not None:
+            raise write.error
+        return write
+
+    # Start the writer thread of this process if it is not running
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.write_lock:
+            if self.thread is None:
+                self.writer = self.connect()
+                self.thread = threading.Thread(target=self.run, name='ledger', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.batch_size:
+                try:
+                    timeout = deadline - time.monotonic()
+                    batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit(batch)
+
+    # Commit statements in a single transaction, and wake up the threads waiting for them
+    def commit(self, batch):
+        try:
+            self.writer.execute('BEGIN IMMEDIATE')
+            for write in batch:
+                self.writer.execute('SAVEPOINT write')
+                try:
+                    cursor = self.writer.execute(write.statement, write.parameters)
+                    write.result = cursor.lastrowid
+                    write.changed = cursor.rowcount
+                except sqlite3.Error as error:
+                    self.writer.execute('ROLLBACK TO write')
+                    write.error = error
+                self.writer.execute('RELEASE write')
+            self.writer.execute('COMMIT')
+            self.count('writes', len(batch))
+            self.count('commits')
+        except sqlite3.Error as error:
+            app.logger.exception('Ledger commit failed')
+            if self.writer.in_transaction:
+                self.writer.execute('ROLLBACK')
+            for write in batch:
+                write.error = error
+        finally:
+            for write in batch:
+                write.done.set()
+
+    # Record an order that was answered, returns its ID
+    def record(self, items, response):
+        self.count('orders')
+        now = time.time()
+        return self.write('INSERT INTO orders (items, status, response, content_type, created, completed) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (json.dumps(items), response.status_code, response.get_data(), response.content_type,
+                           now, now))
+
+    # Record an order with an idempotency key before it is sent to the catalog server
+    # Returns the ID of the new order, or None if the key was already used
+    def begin(self, key, items):
+        try:
+            order_id = self.write('INSERT INTO orders (idempotency_key, items, created) VALUES (?, ?, ?)',
+                                  (key, json.dumps(items), time.time()))
+        except sqlite3.IntegrityError:
+            return None
+        self.count('orders')
+        return order_id
+
+    # Take over an order recorded with begin that has no response, once its lease has expired
+    # The order is created again at this time, which starts a new lease, returns False if another request took it first
+    def take_over(self, order):
+        if order['status'] is not None or time.time() < order['created'] + LEDGER_LEASE:
+            return False
+        taken = self.run_write('UPDATE orders SET created = ? WHERE id = ? AND status IS NULL AND created = ?',
+                               (time.time(), order['id'], order['created'])).changed == 1
+        if taken:
+            self.count('taken_over')
+        return taken
+
+    # Record the response of an order recorded with begin
+    def complete(self, order_id, response):
+        self.write('UPDATE orders SET status = ?, response = ?, content_type = ?, completed = ? WHERE id = ?',
+                   (response.status_code, response.get_data(), response.content_type, time.time(), order_id))
+
+    # Remove an order recorded with begin that was not made, so its idempotency key can be used again
+    def release(self, order_id):
+        self.write('DELETE FROM orders WHERE id = ?', (order_id,))
+
+    def get(self, order_id):
+        return self.reader().execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
+
+    def find(self, key):
+        return self.reader().execute('SELECT * FROM orders WHERE idempotency_key = ?', (key,)).fetchone()
+
+    # Orders after the given ID in order of their IDs, only the orders of a book if it is passed
+    def history(self, after_id, limit, book_id=None):
+        statement = 'SELECT * FROM orders WHERE id > ?'
+        parameters = [after_id]
+        if book_id is not None:
+            statement += ' AND EXISTS (SELECT 1 FROM json_each(orders.items) WHERE json_each.key = ?)'
+            parameters.append(str(book_id))
+        statement += ' ORDER BY id LIMIT ?'
+        parameters.append(limit)
+        return self.reader().execute(statement, parameters).fetchall()
+
+
+ledger = Ledger(os.path.join(os.path.dirname(os.path.abspath(__file__)), LEDGER_FILE), LEDGER_GROUP_COMMIT,
+                LEDGER_BATCH, LEDGER_DELAY)
+
+
+# Statuses of the orders whose outcome is unknown, returned when the catalog server could not be reached or did not
+# answer in time
+unknown_statuses = {504}
+
+
+# Response recorded for an order
+def recorded_response(order):
+    return app.response_class(order['response'], status=order['status'], content_type=order['content_type'])
+
+
+# Place an order and record it in the ledger, returns the response of the order
+# place sends the order to the catalog server with the idempotency key of the order (None without a key),
+# and returns a response tuple
+# With an Idempotency-Key header, an order with the same key is only placed once, and every later order with the key
+# gets the response of the first one
+# Orders that were rejected because of concurrent updates are not recorded, since nothing was bought,
+# so they can be sent again with the same key
+# Orders whose outcome is unknown (the catalog server could not be reached or did not answer in time, so the books may
+# have been bought) are left without a response instead of returning the timeout for the key forever: the key is
+# rejected as in progress until its lease expires, then the next order with the key sends it again
+# The catalog server makes a purchase with a key only once, and returns the response of the first attempt
+# (see PurchaseKey of the catalog service), so an order is only sent again if resend is True, i.e. its key is sent with
+# it, otherwise the unknown outcome is returned for the key rather than buying the books again
+# Every other response is returned for the key from then on
+def ordered(items, place, resend=True):
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        response = app.make_response(place(None))
+        if response.status_code != 409:
+            ledger.record(items, response)
+        return response
+
+    order_id = ledger.begin(key, items)
+    if order_id is None:
+        order = ledger.find(key)
+        if order is None:
+            return {'message': 'The order with this idempotency key could not be recorded, please try again'}, 503
+        if json.loads(order['items']) != items:
+            return {'message': 'Idempotency key was already used for another order'}, 422
+        if order['status'] is not None:
+            ledger.count('replayed')
+            response = recorded_response(order)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if not resend and time.time() >= order['created'] + LEDGER_LEASE:
+            ledger.count('unknown')
+            return {'message': 'The outcome of the order with this idempotency key is unknown'}, 504
+        if not ledger.take_over(order):
+            ledger.count('in_progress')
+            return {'message': 'The order with this idempotency key is in progress'}, 409
+        order_id = order['id']
+
+    try:
+        response = app.make_response(place(key))
+    except Exception:
+        ledger.release(order_id)
+        raise
+
+    if response.status_code == 409:
+        ledger.release(order_id)
+    elif response.status_code in unknown_statuses:
+        ledger.count('unknown')
+    else:
+        ledger.complete(order_id, response)
+    return response
+
+
+# Order history endpoint
+# Orders are returned in the order they were recorded, and can be limited to the orders of a book (?book_id=)
+# Pages are selected with ?after_id=<last ID of the previous page>&limit=<number of orders> (100 by default),
+# if there are more orders after a page, the X-Next-After-Id header holds the after_id of the next page
+@app.route('/orders', methods=['GET'])
+def orders():
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = int(request.args.get('limit', 100))
+        book_id = int(request.args['book_id']) if 'book_id' in request.args else None
+    except ValueError:
+        return {'message': 'after_id, limit and book_id must be numbers'}, 400
+
+    if limit <= 0:
+        return {'message': 'limit must be positive'}, 400
+
+    page = ledger.history(after_id, limit + 1, book_id)
+    response = app.response_class(json.dumps([order_json(order) for order in page[:limit]]),
+                                  mimetype='application/json')
+    if len(page) > limit:
+        response.headers['X-Next-After-Id'] = str(page[limit - 1]['id'])
+    return response
+
+
+# Order endpoint, by the ID of the order or by its idempotency key (/orders/key/<key>)
+@app.route('/orders/<int:order_id>', methods=['GET'])
+def order_by_id(order_id):
+    order = ledger.get(order_id)
+    if order is None:
+        return {'message': 'Order not found'}, 404
+    return order_json(order)
+
+
+@app.route('/orders/key/<key>', methods=['GET'])
+def order_by_key(key):
+    order = ledger.find(key)
+    if order is None:
+        return {'message': 'Order not found'}, 404
+    return order_json(order)
+
+
+# Format a recorded order, with its response parsed if it is JSON
+def order_json(order):
+    response = order['response']
+    if response is not None and order['content_type'] == 'application/json':
+        response = json.loads(response)
+    elif response is not None:
+        response = bytes(response).decode(errors='replace')
+    return {'id': order['id'], 'idempotencyKey': order['idempotency_key'], 'items': json.loads(order['items']),
+            'status': order['status'], 'response': response, 'created': order['created'],
+            'completed': order['completed']}
+
+
+# Ledger statistics endpoint
+@app.route('/stats/ledger', methods=['GET'])
+def ledger_stats():
+    with ledger.lock:
+        return dict(ledger.stats)
+
+
+metrics.register_stats('ledger', ledger_stats)
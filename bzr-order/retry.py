@@ -0,0 +1,33 @@
+import random
+import threading
+
+
+# Limits the retries of a process to a fraction of its first attempts
+# Every first attempt deposits a fraction of a token, and every retry withdraws a whole token
+# When a catalog server keeps rejecting requests, retries stop instead of multiplying its load
+class RetryBudget:
+
+    def __init__(self, ratio: float, min_tokens: float = 10, max_tokens: float = 100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+
+        # A few retries are always allowed, even before any attempt was made
+        self.tokens = min_tokens
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    # Returns whether a retry is allowed
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Time to wait before the retry with the given number (starting from 0), exponential backoff with full jitter
+def backoff(retry: int, base: float, maximum: float) -> float:
+    return random.uniform(0, min(maximum, base * 2 ** retry))
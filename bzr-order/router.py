@@ -0,0 +1,48 @@
+from balancer import Balancer
+from bazar_common.sharding import Ring
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import requests
+
+
+# Routes the requests of a book to the shard group of catalog servers that holds it (see bazar_common/sharding.py)
+# Writes of a book are sent to the first server of its group, and reads are balanced across the servers of the group
+# Queries of many books are sent to every group at the same time (scatter-gather)
+class Router:
+
+    class Group:
+
+        def __init__(self, name, addresses, max_failures: int, cool_off: float):
+            self.name = name
+            self.primary = addresses[0]
+            self.balancer = Balancer(addresses, max_failures, cool_off)
+
+    def __init__(self, groups: dict, virtual_nodes: int, max_failures: int = 3, cool_off: float = 5.0):
+        self.groups = {name: self.Group(name, addresses, max_failures, cool_off) for name, addresses in groups.items()}
+        self.ring = Ring(list(groups), virtual_nodes)
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(groups), thread_name_prefix='scatter')
+
+    # Group of the servers holding a book
+    def group(self, book_id) -> Group:
+        return self.groups[self.ring.owner(book_id)]
+
+    # Send a read request to every group at the same time, balanced across the servers of each group
+    # Returns the response of every group by its name, or the error if none of its servers answered
+    def scatter(self, path, endpoint, **kwargs) -> dict:
+        futures = {name: self.executor.submit(contextvars.copy_context().run, group.balancer.get, path, endpoint,
+                                              **kwargs)
+                   for name, group in self.groups.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except requests.RequestException as error:
+                results[name] = error
+        return results
+
+    # Balancer statistics of the servers of all groups
+    def snapshot(self):
+        stats = {}
+        for group in self.groups.values():
+            stats.update(group.balancer.snapshot())
+        return stats
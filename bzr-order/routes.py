@@ -1,59 +1,352 @@
-from flask_app import app, CATALOG_ADDRESS
+from flask import request
+from flask_app import app, CATALOG_SHARDS, SHARD_VIRTUAL_NODES, BUY_MODE, BUY_RETRIES, BUY_BACKOFF, BUY_BACKOFF_MAX, \
+    RETRY_BUDGET, HEDGE_DELAY, EJECT_FAILURES, EJECT_COOL_OFF
+from router import Router
+from ledger import ordered
+from retry import RetryBudget, backoff
+from bazar_common import http_client, metrics
+import json
 import requests
+import threading
+import time
 
 # 1.5 second timeout for all connection
 # 150 millisecond timeout for connection establishment
 # (assuming that the maximum time for an operation was calculated)
-timeout = (0.15, 1.5)
+# Each one can be overridden with the TIMEOUT_CATALOG_QUERY, TIMEOUT_CATALOG_UPDATE and TIMEOUT_CATALOG_PURCHASE
+# variables
+query_endpoint = http_client.register_endpoint('catalog.query', 0.15, 1.5)
+update_endpoint = http_client.register_endpoint('catalog.update', 0.15, 1.5)
+purchase_endpoint = http_client.register_endpoint('catalog.purchase', 0.15, 1.5)
+
+# 10 second timeout for every page of books
+# 150 millisecond timeout for connection establishment
+# (can be overridden with the TIMEOUT_CATALOG_DUMP variable)
+dump_endpoint = http_client.register_endpoint('catalog.dump', 0.15, 10)
+
+# Counters of buy requests
+buy_stats_lock = threading.Lock()
+buy_stats = {
+    # Number of purchase attempts sent to the catalog server
+    'attempts': 0,
+    # Number of attempts that were rejected because of a concurrent update and retried
+    'retries': 0,
+    # Number of rejected attempts that were not retried because the retry budget was spent
+    'budget_exhausted': 0,
+}
+
+# Retry budget shared by all buy requests of this process
+retry_budget = RetryBudget(RETRY_BUDGET)
+
+# Router of the requests of every book to its shard group of catalog servers,
+# with a balancer of the book reads across the servers of each group
+router = Router(CATALOG_SHARDS, SHARD_VIRTUAL_NODES, EJECT_FAILURES, EJECT_COOL_OFF)
+
+
+def count(name):
+    with buy_stats_lock:
+        buy_stats[name] += 1
+
+
+# Headers of a purchase sent to the catalog server with the idempotency key of its order, the catalog server only makes
+# a purchase with the key once (see PurchaseKey of the catalog service)
+def purchase_headers(key):
+    return {'Idempotency-Key': key} if key is not None else None
+
+
+# Buy a book by sending an atomic purchase request to the catalog server
+# Returns a response tuple, or None if the purchase was rejected because of a concurrent update
+def buy_with_purchase(book_id, key=None):
+    count('attempts')
+    try:
+        buy_response = http_client.put(f'{router.group(book_id).primary}/purchase/{book_id}', purchase_endpoint,
+                                       headers=purchase_headers(key))
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
+
+    # If the response status is 404 not found, override the error message
+    if buy_response.status_code == 404:
+        return {'message': 'Book with the specified ID does not exist'}, 404
+
+    # If the book does not have any copies left, return that the book is out of stock
+    elif buy_response.status_code == 422:
+        return {'success': False, 'message': 'Book with the specified ID is out of stock'}, 200
+
+    # If the purchase request was issued on a non-updated book, it should be retried
+    elif buy_response.status_code == 409:
+        return None
+
+    # If any other error occurs while purchasing, return the error as-is
+    elif buy_response.status_code != 200:
+        return buy_response.content, buy_response.status_code, buy_response.headers.items()
+
+    return {'success': True, 'message': 'Book with the specified ID purchased'}, 200
+
+
+# Buy a book by reading its quantity and then updating it on the catalog server
+# Returns a response tuple, or None if the update was rejected because of a concurrent update
+# The update holds the new quantity rather than the purchase, so the catalog server cannot tell whether it already
+# made it, and the idempotency key of the order is not sent
+def buy_with_update(book_id, key=None):
+    count('attempts')
+    group = router.group(book_id)
+
+    # Query the book from one of the catalog servers of its group
+    # If it is slow to answer, the query is sent to another catalog server as well
+    try:
+        if HEDGE_DELAY > 0 and len(group.balancer.replicas) > 1:
+            book_response = group.balancer.hedged_get(f'/query/item/{book_id}', query_endpoint, HEDGE_DELAY)
+        else:
+            book_response = group.balancer.get(f'/query/item/{book_id}', query_endpoint)
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
+
+    # If the response status is 404 not found, override the error message
+    if book_response.status_code == 404:
+        return {'message': 'Book with the specified ID does not exist'}, 404
+
+    # If any other non-OK response is received, return it as-is
+    elif book_response.status_code != 200:
+        return book_response.content, book_response.status_code, book_response.headers.items()
+
+    # Extract the book information from the response
+    book = book_response.json()
+
+    # If the quantity is 0, return that the book is out of stock
+    if book['quantity'] <= 0:
+        return {'success': False, 'message': 'Book with the specified ID is out of stock'}, 200
+
+    # Otherwise, update the book quantity on the catalog server using the update message
+    try:
+        buy_response = http_client.put(f'{group.primary}/update/{book_id}', update_endpoint,
+                                       json={'quantity': book['quantity'] - 1})
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
+
+    # If the buy request was issued on a non-updated book, it should be retried
+    if buy_response.status_code == 409:
+        return None
+
+    # If any error occurs while updating, return the error as-is
+    elif buy_response.status_code != 200:
+        return buy_response.text, buy_response.status_code, buy_response.headers.items()
+
+    return {'success': True, 'message': 'Book with the specified ID purchased'}, 200
+
+
+# Define buy methods, selected by the BUY_MODE setting
+buy_methods = {
+    'purchase': buy_with_purchase,
+    'update': buy_with_update,
+}
+
+
+# Call a buy function until the catalog server stops rejecting it because of concurrent updates
+# The catalog server updates its copy of the book when it rejects a purchase, so a retry should succeed
+# Retries wait for a random backoff, and are limited by BUY_RETRIES and by the retry budget
+# Returns a response tuple, or None if every attempt was rejected
+def retry_buy(buy_function):
+    retry_budget.deposit()
+    for attempt in range(BUY_RETRIES + 1):
+        response = buy_function()
+        if response is not None:
+            return response
+
+        if attempt == BUY_RETRIES:
+            break
+
+        if not retry_budget.withdraw():
+            count('budget_exhausted')
+            break
+
+        count('retries')
+        time.sleep(backoff(attempt, BUY_BACKOFF, BUY_BACKOFF_MAX))
+
+    return None
 
 
 # Buy endpoint
+# The purchase is recorded in the order ledger, and an Idempotency-Key header makes retries of it safe (see ledger.py)
 @app.route('/buy/<book_id>', methods=['PUT'])
 def buy(book_id):
     # If the ID is not a number, reject the purchase
     if not book_id.isnumeric():
         return {'message': 'Book ID must be a number'}, 422
 
-    while True:
-        # Query the book from the catalog server
-        try:
-            book_response = requests.get(f'{CATALOG_ADDRESS}/query/item/{book_id}', timeout=timeout)
-        except requests.RequestException:
-            return {'message': 'Could not connect to the catalog server'}, 504
+    return ordered({book_id: 1}, lambda key: place_buy(book_id, key), resend=BUY_MODE == 'purchase')
 
-        # If the response status is 404 not found, override the error message
-        if book_response.status_code == 404:
-            return {'message': 'Book with the specified ID does not exist'}, 404
 
-        # If any other non-OK response is received, return it as-is
-        elif book_response.status_code != 200:
-            return book_response.content, book_response.status_code, book_response.headers.items()
+def place_buy(book_id, key):
+    response = retry_buy(lambda: buy_methods[BUY_MODE](book_id, key))
+    if response is not None:
+        return response
 
-        # Extract the book information from the response
-        book = book_response.json()
+    return {'message': 'Book could not be purchased because of concurrent updates, please try again'}, 409
 
-        # If the quantity is 0, return that the book is out of stock
-        if book['quantity'] <= 0:
-            return {'success': False, 'message': 'Book with the specified ID is out of stock'}
 
-        # Otherwise, update the book quantity on the catalog server using the update message
-        try:
-            buy_response = requests.put(f'{CATALOG_ADDRESS}/update/{book_id}', json={'quantity': book['quantity'] - 1},
-                                        timeout=timeout)
-        except requests.RequestException:
-            return {'message': 'Could not connect to the catalog server'}, 504
+# Buy many books at once by sending a single bulk purchase request to the catalog server
+# Returns a response tuple, or None if the purchase was rejected because of a concurrent update
+def buy_many_with_purchase(items, key=None):
+    count('attempts')
+    group = router.group(next(iter(items)))
+    try:
+        buy_response = http_client.put(f'{group.primary}/purchase', purchase_endpoint, json={'items': items},
+                                       headers=purchase_headers(key))
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
 
-        # If the buy request was issued on a non-updated book, retry
-        if buy_response.status_code == 409:
-            continue
+    # If the response status is 404 not found, override the error message
+    if buy_response.status_code == 404:
+        return {'message': 'Some books with the specified IDs do not exist'}, 404
 
-        # If any error occurs while updating, return the error as-is
-        elif buy_response.status_code != 200:
-            return buy_response.text, buy_response.status_code, buy_response.headers.items()
+    # If some books do not have enough copies left, return which books are out of stock
+    elif buy_response.status_code == 422:
+        return {'success': False, 'message': 'Some books are out of stock',
+                'outOfStock': buy_response.json()['outOfStock']}, 200
+
+    # If the purchase request was issued on non-updated books, it should be retried
+    elif buy_response.status_code == 409:
+        return None
+
+    # If any other error occurs while purchasing, return the error as-is
+    elif buy_response.status_code != 200:
+        return buy_response.content, buy_response.status_code, buy_response.headers.items()
+
+    return {'success': True, 'message': 'Books with the specified IDs purchased'}, 200
+
+
+# Bulk buy endpoint
+# The books are passed as {"items": {"<book ID>": <number of copies>, ...}}
+# Either all books are bought, or none of them, so the books must belong to the same shard group
+# The purchase is recorded in the order ledger like a single buy
+# This always uses the bulk purchase request of the catalog server, regardless of BUY_MODE
+@app.route('/buy', methods=['PUT'])
+def buy_many():
+    # If no data was passed (or the request was not JSON formatted), treat it like an empty JSON object
+    buy_data = request.get_json(silent=True)
+    if buy_data is None:
+        buy_data = {}
+
+    items = buy_data.get('items')
+    if type(items) is not dict or len(items) == 0:
+        return {'message': 'Books must be passed as an object of book IDs and number of copies'}, 422
+
+    # If any ID is not a number, reject the purchase
+    if not all(str(book_id).isnumeric() for book_id in items):
+        return {'message': 'Book IDs must be numbers'}, 422
+
+    # If any number of copies is not a positive number, reject the purchase
+    if not all(type(amount) is int and amount > 0 for amount in items.values()):
+        return {'message': 'Number of copies must be a positive number'}, 422
+
+    # A purchase is atomic on the servers of a single shard group only
+    if len({router.ring.owner(book_id) for book_id in items}) > 1:
+        return {'message': 'Books of different shards cannot be bought together'}, 422
+
+    return ordered(items, lambda key: place_buy_many(items, key))
+
+
+def place_buy_many(items, key):
+    response = retry_buy(lambda: buy_many_with_purchase(items, key))
+    if response is not None:
+        return response
+
+    return {'message': 'Books could not be purchased because of concurrent updates, please try again'}, 409
+
+
+# Return the response of a catalog server as-is
+def relay(response):
+    return response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type')}
+
+
+# Query-by-item endpoint, sent to a catalog server of the shard group of the book
+# The consistency level of the read (?consistency=) is passed on to the catalog server
+@app.route('/query/item/<book_id>', methods=['GET'])
+def query_item(book_id):
+    if not book_id.isnumeric():
+        return {'message': 'Book ID must be a number'}, 422
+
+    try:
+        return relay(router.group(book_id).balancer.get(f'/query/item/{book_id}', query_endpoint, params=request.args))
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
+
+
+# Update endpoint, sent to the first catalog server of the shard group of the book
+@app.route('/update/<book_id>', methods=['PUT'])
+def update_item(book_id):
+    if not book_id.isnumeric():
+        return {'message': 'Book ID must be a number'}, 422
+
+    try:
+        return relay(http_client.put(f'{router.group(book_id).primary}/update/{book_id}', update_endpoint,
+                                     json=request.get_json(silent=True)))
+    except requests.RequestException:
+        return {'message': 'Could not connect to the catalog server'}, 504
+
+
+# Send a query of many books to every shard group, and merge the books of all groups in order of ID
+# Pages are requested from every group with the same after_id and limit, and a group that has more books than the
+# page returns the after_id of its next page, so the merged page ends at the lowest of these IDs,
+# since the books after it may not have been returned by every group yet
+def gather(path, endpoint):
+    if request.args.get('stream', '0') != '0':
+        return {'message': 'Streams are not supported across shards, use pages (after_id and limit)'}, 400
+
+    results = router.scatter(path, endpoint, params=request.args)
+    failed = [name for name, response in results.items()
+              if isinstance(response, Exception) or response.status_code != 200]
+    if len(failed) > 0:
+        first = results[failed[0]]
+        if len(failed) < len(results) or isinstance(first, Exception):
+            return {'message': 'Some shards could not be queried', 'shards': failed}, 504
+        return relay(first)
+
+    books = sorted((book for response in results.values() for book in response.json()), key=lambda book: book['id'])
+    next_ids = [int(response.headers['X-Next-After-Id']) for response in results.values()
+                if 'X-Next-After-Id' in response.headers]
+    headers = {}
+    if len(next_ids) > 0:
+        books = [book for book in books if book['id'] <= min(next_ids)]
+        headers['X-Next-After-Id'] = str(min(next_ids))
+
+    limit = int(request.args.get('limit', 0)) if request.args.get('limit', '0').isnumeric() else 0
+    if 0 < limit < len(books):
+        books = books[:limit]
+        headers['X-Next-After-Id'] = str(books[-1]['id'])
+
+    return app.response_class(json.dumps(books), mimetype='application/json', headers=headers)
+
+
+# Query-by-topic and query-by-title endpoints, sent to every shard group
+@app.route('/query/<method>/<param>', methods=['GET'])
+def query_many(method, param):
+    return gather(f'/query/{method}/{param}', query_endpoint)
+
+
+# Dump endpoint, sent to every shard group
+@app.route('/dump/', methods=['GET'])
+def dump():
+    return gather('/dump/', dump_endpoint)
+
+
+# Buy statistics endpoint
+@app.route('/stats/buy', methods=['GET'])
+def stats_buy():
+    with buy_stats_lock:
+        return dict(buy_stats)
+
+
+# Balancer statistics endpoint
+@app.route('/stats/balancer', methods=['GET'])
+def stats_balancer():
+    return router.snapshot()
 
-        else:
-            break
 
-    # Otherwise, return a successful purchase message
-    return {'success': True, 'message': 'Book with the specified ID purchased'}
+metrics.register_stats('buy', stats_buy)
 
+# State of every catalog server the reads are balanced across
+metrics.Gauge('bazar_balancer_replica', 'State of the catalog servers the reads are balanced across',
+              ('replica', 'name'),
+              function=lambda: {(address, name): value
+                                for address, stats in router.snapshot().items() for name, value in stats.items()})
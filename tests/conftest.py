@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The tests start the services with the helpers of the benchmarks (see benchmarks/support.py), which also make the
+# modules shared by the services (bzr-common) importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from support import load_catalog, start_catalog, free_port, seed_books, StandIn
+
+
+# Front end server of all catalog servers of the tests, which accepts every invalidation
+@pytest.fixture(scope='session')
+def front_end():
+    return StandIn().address
+
+
+# The catalog service loaded in this process with a SQLite database, holding 10 books of seed_books
+# A process can only load the catalog service once, so every test that uses it shares it
+@pytest.fixture(scope='session')
+def catalog():
+    app = load_catalog(SNAPSHOT_BOOTSTRAP='0')
+    from database import backend
+    seed_books(backend.url.database, 10)
+    return app
+
+
+# Start a group of catalog servers that replicate to each other, every one of them with the same books
+# (quantity 100, IDs from 1000, see seed_books), environment variables can be passed to every server
+# Returns the addresses and the database files of the servers, the servers are stopped after the test
+@pytest.fixture
+def catalog_group(front_end):
+    processes = []
+
+    def start(replicas, books=10, **environment):
+        addresses = [f'http://127.0.0.1:{free_port()}' for _ in range(replicas)]
+        files = []
+        for address in addresses:
+            file = os.path.join(tempfile.mkdtemp(prefix='bzr-test-'), 'db.sqlite')
+            port = int(address.rsplit(':', 1)[1])
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       SNAPSHOT_BOOTSTRAP='0')
+            process.terminate()
+            process.wait()
+            seed_books(file, books)
+            files.append(file)
+
+            others = '|'.join(other for other in addresses if other != address)
+            process, _ = start_catalog(port=port, DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                       CATALOG_ADDRESSES=others, SELF_ADDRESS=address, **environment)
+            processes.append(process)
+        return addresses, files
+
+    yield start
+
+    for process in processes:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from sqlalchemy import event, text
+from support import start_catalog, seed_books, Blackhole, kept_alive
+
+buckets = 16
+
+
+# Change a book directly in the database file of a running server, without replicating it
+# The change is recorded in the log like a change copied from another server, which is not sent to other servers
+def set_book(file, book_id, quantity, sequence_number):
+    database = sqlite3.connect(file)
+    with database:
+        database.execute('INSERT INTO book (id, title, topic, quantity, price, sequence_number) '
+                         'VALUES (?, ?, ?, ?, 10.0, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET quantity = excluded.quantity, '
+                         'sequence_number = excluded.sequence_number',
+                         (book_id, f'Book {book_id}', 'Topic', quantity, sequence_number))
+        database.execute('INSERT INTO replication_log (book_id, sequence_number, title, topic, quantity, price, '
+                         'replicated) VALUES (?, ?, ?, ?, ?, 10.0, 1)',
+                         (book_id, sequence_number, f'Book {book_id}', 'Topic', quantity))
+    database.close()
+
+
+def get_book(file, book_id):
+    database = sqlite3.connect(file)
+    row = database.execute('SELECT quantity, sequence_number FROM book WHERE id = ?', (book_id,)).fetchone()
+    database.close()
+    return row
+
+
+def digest(address):
+    return requests.get(f'{address}/rep/digest', params={'buckets': buckets}).json()['digest']
+
+
+def test_digest_differs_only_in_the_bucket_of_a_changed_book(catalog_group):
+    addresses, files = catalog_group(2, books=50)
+    assert digest(addresses[0]) == digest(addresses[1])
+
+    set_book(files[1], 1003, 7, 5)
+    first, second = digest(addresses[0]), digest(addresses[1])
+    assert len(first) == buckets
+    assert [bucket for bucket in range(buckets) if first[bucket] != second[bucket]] == [1003 % buckets]
+
+
+def test_digest_is_updated_from_the_log(catalog):
+    from anti_entropy import Digest
+    from database import db
+    from book import Book
+
+    with catalog.app_context():
+        kept = Digest(buckets)
+        first = kept.get()
+
+        Book.purchase(1005)
+        Book.update(1006, quantity=3)
+        Book.insert_many([{'id': 2001, 'title': 'New book', 'topic': 'New topic', 'quantity': 1, 'price': 1.0,
+                           'sequence_number': 0}])
+
+        statements = []
+
+        def count(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            second = kept.get()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        # Only the changes are read, and the digest is the same as a digest of the whole table
+        assert not any('FROM book' in statement for statement in statements)
+        assert kept.rebuilds == 1
+        assert second == Digest(buckets).get()
+        assert [bucket for bucket in range(buckets) if first[bucket] != second[bucket]] == \
+            sorted({1005 % buckets, 1006 % buckets, 2001 % buckets})
+
+        # The books of a bucket are found with the index of the buckets of the server
+        statement = Book.query.filter(Book.bucket(256).in_([0, 1])).statement
+        plan = db.session.execute(text('EXPLAIN QUERY PLAN ' +
+                                       str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))))
+        assert 'book_bucket_256' in '\n'.join(row[-1] for row in plan)
+
+
+def test_rows_returns_every_book_of_the_buckets(catalog_group):
+    [address], files = catalog_group(1, books=50)
+    set_book(files[0], 1003, 7, 5)
+
+    response = requests.get(f'{address}/rep/rows', params={'buckets': buckets, 'ids': f'{1003 % buckets},0'})
+    assert response.status_code == 200
+    books = {book['id']: book for book in response.json()['books']}
+    assert sorted(books) == [id for id in range(1000, 1050) if id % buckets in (1003 % buckets, 0)]
+    assert books[1003]['quantity'] == 7
+    assert books[1003]['sequence_number'] == 5
+
+
+def test_only_newer_books_are_pulled(catalog_group):
+    addresses, files = catalog_group(2, books=50, ANTI_ENTROPY_INTERVAL='0.2', ANTI_ENTROPY_BUCKETS=str(buckets))
+
+    # Each server holds a newer version of one book, and the second server holds a book the first one does not
+    set_book(files[0], 1004, 3, 9)
+    set_book(files[1], 1004, 8, 2)
+    set_book(files[1], 1003, 7, 5)
+    set_book(files[1], 2000, 1, 1)
+
+    deadline = time.time() + 20
+    while time.time() < deadline and digest(addresses[0]) != digest(addresses[1]):
+        time.sleep(0.1)
+
+    for file in files:
+        assert get_book(file, 1003) == (7, 5)
+        assert get_book(file, 1004) == (3, 9)
+        assert get_book(file, 2000) == (1, 1)
+    assert requests.get(f'{addresses[0]}/stats/anti-entropy').json()['rows_pulled'] == 2
+    assert requests.get(f'{addresses[1]}/stats/anti-entropy').json()['rows_pulled'] == 1
+
+
+def test_reads_do_not_wait_for_other_servers_in_any_worker(front_end):
+    # The other server never answers, a read that asks it waits for the timeout of the request
+    blackhole = Blackhole()
+    kept_alive.append(blackhole)
+
+    file = os.path.join(tempfile.mkdtemp(prefix='bzr-test-'), 'db.sqlite')
+    process, _ = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end, SNAPSHOT_BOOTSTRAP='0')
+    process.terminate()
+    process.wait()
+    seed_books(file, 30)
+    process, address = start_catalog(server='gunicorn', DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                     CATALOG_ADDRESSES=blackhole.address, ANTI_ENTROPY_INTERVAL='60',
+                                     WORKERS='2', THREADS='1')
+
+    def read(book_id):
+        start = time.monotonic()
+        assert requests.get(f'{address}/query/item/{book_id}').status_code == 200
+        return time.monotonic() - start
+
+    try:
+        # A worker with a single thread serves one request at a time, so concurrent reads are served by both workers
+        # The first reads of each worker are slower and are not measured
+        with ThreadPoolExecutor(2) as executor:
+            list(executor.map(read, range(1020, 1030)))
+
+            # Every book is read once, so none of the reads is served from the response cache
+            assert max(executor.map(read, range(1000, 1020))) < 0.5
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+import requests
+from support import start_catalog, seed_books, Blackhole, kept_alive
+
+
+def quorum_read(address, book_id):
+    return requests.get(f'{address}/query/item/{book_id}', params={'consistency': 'quorum'})
+
+
+def test_quorum_read_adds_a_book_missing_locally(catalog_group):
+    addresses, files = catalog_group(2, books=1)
+
+    # A book that only the second server holds
+    database = sqlite3.connect(files[1])
+    with database:
+        database.execute("INSERT INTO book (id, title, topic, quantity, price, sequence_number) "
+                         "VALUES (2000, 'New book', 'New topic', 3, 5.0, 4)")
+    database.close()
+
+    response = quorum_read(addresses[0], 2000)
+    assert response.status_code == 200
+    assert response.json()['quantity'] == 3
+
+    database = sqlite3.connect(files[0])
+    assert database.execute('SELECT quantity, sequence_number FROM book WHERE id = 2000').fetchone() == (3, 4)
+    database.close()
+
+    assert quorum_read(addresses[0], 3000).status_code == 404
+
+
+def test_quorum_read_counts_servers_without_the_book(catalog_group, front_end):
+    # The other servers are one without the book and one that never answers
+    [peer], _ = catalog_group(1, books=0)
+    blackhole = Blackhole()
+    kept_alive.append(blackhole)
+
+    file = os.path.join(tempfile.mkdtemp(prefix='bzr-test-'), 'db.sqlite')
+    process, _ = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end, SNAPSHOT_BOOTSTRAP='0')
+    process.terminate()
+    process.wait()
+    seed_books(file, 1)
+    process, address = start_catalog(DATABASE_FILE=file, FRONT_END_ADDRESS=front_end,
+                                     CATALOG_ADDRESSES=f'{peer}|{blackhole.address}')
+    try:
+        # The answer of the server without the book makes a majority, without waiting for the other server
+        start = time.monotonic()
+        response = quorum_read(address, 1000)
+        assert time.monotonic() - start < 0.5
+        assert response.status_code == 200
+        assert response.json()['quantity'] == 100
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_check_of_a_book_missing_locally_is_not_found(catalog_group):
+    [address], _ = catalog_group(1, books=1)
+
+    response = requests.get(f'{address}/rep/check/2000', json={'sequence_number': 0})
+    assert response.status_code == 404
+    assert requests.get(f'{address}/rep/check/1000', json={'sequence_number': 0}).status_code == 200
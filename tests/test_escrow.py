@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+import random
+import sqlite3
+import time
+
+import requests
+
+# Stock of every book added by seed_books
+stock = 100
+
+
+# Buy random books from one server until all of them are out of stock on that server
+# Returns the number of copies bought of every book
+def buy_until_sold_out(address, book_ids, deadline):
+    bought = {book_id: 0 for book_id in book_ids}
+    left = list(book_ids)
+    with requests.Session() as session:
+        while len(left) > 0 and time.time() < deadline:
+            book_id = random.choice(left)
+            response = session.put(f'{address}/purchase/{book_id}')
+            if response.status_code == 200:
+                bought[book_id] += 1
+            elif response.status_code == 422:
+                left.remove(book_id)
+            else:
+                assert response.status_code == 200, response.text
+    return bought
+
+
+def test_concurrent_purchases_never_oversell(catalog_group):
+    addresses, files = catalog_group(3, books=3, ESCROW='1', ESCROW_INTERVAL='0.2')
+    book_ids = [1000, 1001, 1002]
+
+    deadline = time.time() + 60
+    with ThreadPoolExecutor(max_workers=4 * len(addresses)) as executor:
+        futures = [executor.submit(buy_until_sold_out, address, book_ids, deadline)
+                   for address in addresses for _ in range(4)]
+        results = [future.result() for future in futures]
+    bought = {book_id: sum(result[book_id] for result in results) for book_id in book_ids}
+
+    # Copies recorded as sold by every server
+    recorded = {book_id: 0 for book_id in book_ids}
+    for file in files:
+        database = sqlite3.connect(file)
+        for book_id, sold in database.execute('SELECT book_id, sold FROM escrow_share'):
+            recorded[book_id] += sold
+        database.close()
+
+    for book_id in book_ids:
+        assert 0 < bought[book_id] <= stock
+        assert recorded[book_id] == bought[book_id]
+
+
+def test_purchase_is_visible_in_reads(catalog_group):
+    [address], _ = catalog_group(1, books=1, ESCROW='1')
+
+    assert requests.get(f'{address}/query/item/1000').json()['quantity'] == stock
+    assert requests.get(f'{address}/query/item/1000', params={'consistency': 'local'}).json()['quantity'] == stock
+
+    assert requests.put(f'{address}/purchase/1000').status_code == 200
+    assert requests.get(f'{address}/query/item/1000').json()['quantity'] == stock - 1
+    assert requests.get(f'{address}/query/item/1000', params={'consistency': 'local'}).json()['quantity'] == stock - 1
+
+
+def test_restock_to_the_same_quantity_splits_again(catalog_group):
+    addresses, _ = catalog_group(2, books=1, ESCROW='1', ESCROW_INTERVAL='0')
+
+    # The first server sells its own copy, then the copy it borrows from the other server
+    assert requests.put(f'{addresses[0]}/update/1000', json={'quantity': 2}).status_code == 200
+    assert requests.put(f'{addresses[0]}/purchase/1000').status_code == 200
+    assert requests.put(f'{addresses[0]}/purchase/1000').status_code == 200
+    for address in addresses:
+        assert requests.put(f'{address}/purchase/1000').status_code == 422
+
+    # The book is restocked to the quantity its shares were split from, every server gets its share again
+    assert requests.put(f'{addresses[0]}/update/1000', json={'quantity': 2}).status_code == 200
+    for address in addresses:
+        assert requests.put(f'{address}/purchase/1000').status_code == 200
@@ -0,0 +1,131 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import pytest
+import requests
+from support import start_service, free_port, StandIn
+
+
+# Start an order server whose writes are sent to the given catalog address, with its ledger in a temporary file
+# Returns the address and the ledger file of the server, the server is stopped after the test
+@pytest.fixture
+def order_server():
+    processes = []
+
+    def start(catalog_address, **environment):
+        file = os.path.join(tempfile.mkdtemp(prefix='bzr-test-'), 'ledger.sqlite')
+        process, address = start_service('bzr-order', CATALOG_ADDRESS=catalog_address, LEDGER_FILE=file,
+                                         **environment)
+        processes.append(process)
+        return address, file
+
+    yield start
+
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def buy(address, key):
+    return requests.put(f'{address}/buy/1000', headers={'Idempotency-Key': key})
+
+
+def quantity(file, book_id):
+    database = sqlite3.connect(file)
+    row = database.execute('SELECT quantity FROM book WHERE id = ?', (book_id,)).fetchone()
+    database.close()
+    return row[0]
+
+
+def test_unknown_outcome_is_not_bought_twice(order_server, catalog_group):
+    [catalog_address], [file] = catalog_group(1, books=1)
+    address, _ = order_server(catalog_address, LEDGER_LEASE='1', TIMEOUT_CATALOG_PURCHASE='0.15,0.5')
+
+    # The database is locked while the first order is sent, so the catalog server makes the purchase after the order
+    # server timed out
+    database = sqlite3.connect(file, isolation_level=None)
+    database.execute('BEGIN IMMEDIATE')
+    assert buy(address, 'first').status_code == 504
+    database.execute('COMMIT')
+    database.close()
+    assert requests.get(f'{address}/orders/key/first').json()['status'] is None
+
+    # The timeout is not replayed, the key is in progress until its lease expires, then the order is sent again and
+    # the catalog server returns the response of the purchase it made
+    assert buy(address, 'first').status_code == 409
+    time.sleep(1.2)
+    response = buy(address, 'first')
+    assert response.status_code == 200
+    assert response.json()['success']
+    assert quantity(file, 1000) == 99
+
+    stats = requests.get(f'{address}/stats/ledger').json()
+    assert stats['unknown'] == 1
+    assert stats['taken_over'] == 1
+
+
+def test_unknown_outcome_of_an_update_is_not_sent_again(order_server):
+    # Nothing listens on the catalog address, so every order times out
+    address, _ = order_server(f'http://127.0.0.1:{free_port()}', LEDGER_LEASE='1', BUY_MODE='update')
+
+    assert buy(address, 'first').status_code == 504
+    time.sleep(1.2)
+    response = buy(address, 'first')
+    assert response.status_code == 504
+    assert 'Idempotent-Replayed' not in response.headers
+
+    stats = requests.get(f'{address}/stats/ledger').json()
+    assert stats['unknown'] == 2
+    assert stats['taken_over'] == 0
+
+
+def test_purchase_with_a_key_is_made_once(catalog_group):
+    [address], [file] = catalog_group(1, books=2)
+
+    def purchase(key, items):
+        return requests.put(f'{address}/purchase', json={'items': items}, headers={'Idempotency-Key': key})
+
+    first = requests.put(f'{address}/purchase/1000', headers={'Idempotency-Key': 'first'})
+    assert first.status_code == 200
+    response = requests.put(f'{address}/purchase/1000', headers={'Idempotency-Key': 'first'})
+    assert response.status_code == 200
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert response.json() == first.json()
+    assert quantity(file, 1000) == 99
+
+    assert purchase('second', {'1000': 1, '1001': 2}).status_code == 200
+    assert purchase('second', {'1000': 1, '1001': 2}).headers['Idempotent-Replayed'] == 'true'
+    assert purchase('second', {'1001': 1}).status_code == 422
+    assert (quantity(file, 1000), quantity(file, 1001)) == (98, 98)
+
+    # A purchase rejected because the books are out of stock gets the same answer for its key
+    assert purchase('third', {'1001': 99}).status_code == 422
+    assert purchase('third', {'1001': 99}).headers['Idempotent-Replayed'] == 'true'
+
+
+def test_order_left_without_a_response_is_taken_over_after_the_lease(order_server):
+    address, file = order_server(StandIn().address)
+
+    # An order without a key creates the ledger table
+    assert requests.put(f'{address}/buy/1000').status_code == 200
+
+    # An order of a server that stopped while sending it
+    database = sqlite3.connect(file)
+    with database:
+        database.execute('INSERT INTO orders (idempotency_key, items, created) VALUES (?, ?, ?)',
+                         ('crashed', json.dumps({'1000': 1}), time.time()))
+    assert buy(address, 'crashed').status_code == 409
+
+    with database:
+        database.execute('UPDATE orders SET created = ? WHERE idempotency_key = ?', (time.time() - 60, 'crashed'))
+    database.close()
+    response = buy(address, 'crashed')
+    assert response.status_code == 200
+    assert response.json()['success']
+
+    response = buy(address, 'crashed')
+    assert response.status_code == 200
+    assert response.headers['Idempotent-Replayed'] == 'true'
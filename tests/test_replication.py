@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import subprocess
+import sys
+
+import requests
+from support import root_dir, common_dir
+
+# Stock of every book added by seed_books
+stock = 100
+
+
+# Buy a book a number of times from one server, returns the number of successful purchases
+def buy(address, book_id, times):
+    bought = 0
+    with requests.Session() as session:
+        for _ in range(times):
+            response = session.put(f'{address}/purchase/{book_id}')
+            assert response.status_code in (200, 409, 503), response.text
+            if response.status_code == 200:
+                bought += 1
+    return bought
+
+
+# Newest copy of a book among the database files of the servers, as (sequence number, quantity)
+def newest(files, book_id):
+    copies = []
+    for file in files:
+        database = sqlite3.connect(file)
+        copies.append(database.execute('SELECT sequence_number, quantity FROM book WHERE id = ?',
+                                       (book_id,)).fetchone())
+        database.close()
+    # Copies with the same version must be the same
+    for copy in copies:
+        assert all(other[1] == copy[1] for other in copies if other[0] == copy[0])
+    return max(copies)
+
+
+def test_concurrent_purchases_on_two_servers_are_not_lost(catalog_group):
+    addresses, files = catalog_group(2, books=1)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(buy, address, 1000, 10) for address in addresses for _ in range(4)]
+        bought = sum(future.result() for future in futures)
+
+    assert bought > 0
+    assert newest(files, 1000)[1] == stock - bought
+
+
+def test_unknown_buy_mode_is_rejected_at_startup():
+    environment = {**os.environ, 'BUY_MODE': 'purchases', 'PYTHONPATH': common_dir}
+    result = subprocess.run([sys.executable, '-c', 'import flask_app'], cwd=os.path.join(root_dir, 'bzr-order'),
+                            env=environment, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert 'BUY_MODE must be purchase or update' in result.stderr
+
+
+# Number of books the server tracks as up-to-date, read from its metrics
+def updated_ids(address):
+    for line in requests.get(f'{address}/metrics').text.splitlines():
+        if line.startswith('bazar_replication_updated_ids '):
+            return float(line.split()[1])
+
+
+def test_books_are_tracked_by_their_ids(catalog_group):
+    addresses, _ = catalog_group(2, books=1)
+
+    assert requests.get(f'{addresses[0]}/query/item/1000').status_code == 200
+    assert requests.put(f'{addresses[0]}/purchase/1000').status_code == 200
+    assert requests.put(f'{addresses[0]}/update/1000', json={'quantity': 50}).status_code == 200
+    assert requests.put(f'{addresses[0]}/purchase', json={'items': {'1000': 1}}).status_code == 200
+    assert updated_ids(addresses[0]) == 1
+
+    assert requests.put(f'{addresses[0]}/purchase/book').status_code == 404
@@ -0,0 +1,78 @@
+import json
+import sqlite3
+import time
+
+import requests
+from sqlalchemy import event
+
+
+def test_changes_after_reads_every_change_with_one_query(catalog):
+    from database import db
+    from book import Book, LogRecord
+
+    with catalog.app_context():
+        # The seeded books have no records, the first record of a book is taken as a new book
+        Book.purchase(1002)
+        Book.purchase(1003)
+        offset = LogRecord.last_offset()
+        Book.purchase(1002)
+        Book.update(1003, title='Another title')
+        Book.update(1003, quantity=5)
+        Book.insert_many([{'id': 2000, 'title': 'New book', 'topic': 'New topic', 'quantity': 1, 'price': 1.0,
+                           'sequence_number': 0}])
+
+        statements = []
+
+        def count(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            changes = LogRecord.changes_after(offset)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+    assert changes == [(1002, False), (1003, True), (1003, False), (2000, True)]
+    assert len(statements) == 1
+
+
+def log(address):
+    response = requests.get(f'{address}/rep/log')
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline and not condition():
+        time.sleep(0.1)
+    return condition()
+
+
+def test_changes_copied_from_other_servers_are_not_sent_back(catalog_group):
+    addresses, files = catalog_group(2, books=1)
+
+    assert requests.put(f'{addresses[0]}/update/1000', json={'quantity': 5}).status_code == 200
+    assert [(record['book_id'], record['quantity']) for record in log(addresses[0])] == [(1000, 5)]
+
+    # The other server recorded the change it received, but does not send it
+    database = sqlite3.connect(files[1])
+    assert database.execute('SELECT quantity, replicated FROM replication_log').fetchall() == [(5, 1)]
+    database.close()
+    assert log(addresses[1]) == []
+
+
+def test_records_read_by_every_other_server_are_truncated(catalog_group):
+    addresses, files = catalog_group(2, books=1, REPLICATION_LOG_INTERVAL='0.2')
+
+    for quantity in range(150):
+        assert requests.put(f'{addresses[0]}/update/1000', json={'quantity': quantity}).status_code == 200
+
+    # The last records are kept for the response caches (see response_cache.py)
+    for address in addresses:
+        assert wait_for(lambda: requests.get(f'{address}/stats/replication-log').json()['records_truncated'] == 50)
+    for file in files:
+        database = sqlite3.connect(file)
+        assert database.execute('SELECT MIN(id), MAX(id) FROM replication_log').fetchone() == (51, 150)
+        assert database.execute('SELECT quantity FROM book WHERE id = 1000').fetchone() == (149,)
+        database.close()
+    assert [record['id'] for record in log(addresses[0])] == list(range(51, 151))